@@ -0,0 +1,271 @@
+import socket
+import threading
+import argparse
+import time
+from urllib.parse import urlparse
+
+from chat_protocol import FRAMING_BINARY, FrameDecoder, ProtocolError, encode_frame
+
+# Publish/subscribe bus that lets several chat server nodes push to each other's
+# users. Each node subscribes to the channels it can deliver on (one per connected
+# user, plus the broadcast channel) and publishes pushes for anyone it doesn't hold.
+# Delivery is best effort: chat messages are stored before they are pushed, so a
+# push lost on the bus still reaches the user with their offline backlog.
+#
+# Two implementations share the same node-side interface (subscribe, unsubscribe,
+# publish, close, with a handler(channel, payload) callback for deliveries):
+#   LocalBus   nodes living in one process, attached to a LocalBroker
+#   SocketBus  nodes in separate processes, attached to a broker started with
+#              run_broker() / `python chat_bus.py` (or serve_broker() on a socket
+#              from open_broker_socket()), over a loopback TCP socket
+
+# Default address of the socket broker
+BROKER_HOST = '127.0.0.1'
+BROKER_PORT = 9998
+
+# Seconds between attempts to reach the broker after losing it
+BROKER_RECONNECT_DELAY = 2
+
+# Routes published payloads to every other subscriber of the channel
+class LocalBroker:
+    def __init__(self):
+        self.subscriptions = {}  # {channel: set of subscribers}
+        self.lock = threading.Lock()
+
+    def subscribe(self, subscriber, channel):
+        with self.lock:
+            self.subscriptions.setdefault(channel, set()).add(subscriber)
+
+    def unsubscribe(self, subscriber, channel):
+        with self.lock:
+            subscribers = self.subscriptions.get(channel)
+            if subscribers:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.subscriptions[channel]
+
+    def unsubscribe_all(self, subscriber):
+        with self.lock:
+            for channel in [c for c, subs in self.subscriptions.items() if subscriber in subs]:
+                self.subscriptions[channel].discard(subscriber)
+                if not self.subscriptions[channel]:
+                    del self.subscriptions[channel]
+
+    def publish(self, sender, channel, payload):
+        with self.lock:
+            subscribers = list(self.subscriptions.get(channel, ()))
+        for subscriber in subscribers:
+            # A node never hears its own publications back
+            if subscriber is sender:
+                continue
+            try:
+                subscriber.deliver(channel, payload)
+            except Exception as e:
+                print(f"Bus delivery on {channel} failed: {e}")
+
+# A node attached to a broker in the same process
+class LocalBus:
+    def __init__(self, handler, broker=None):
+        self.handler = handler
+        self.broker = broker or LocalBroker()
+
+    def subscribe(self, channel):
+        self.broker.subscribe(self, channel)
+
+    def unsubscribe(self, channel):
+        self.broker.unsubscribe(self, channel)
+
+    def publish(self, channel, payload):
+        self.broker.publish(self, channel, payload)
+
+    def deliver(self, channel, payload):
+        self.handler(channel, payload)
+
+    def close(self):
+        self.broker.unsubscribe_all(self)
+
+# A node attached to a socket broker. Subscriptions are remembered and replayed
+# whenever the connection to the broker is re-established.
+class SocketBus:
+    def __init__(self, handler, host=BROKER_HOST, port=BROKER_PORT):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.channels = set()
+        self.socket = None
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True, name='kawaii-bus')
+        self.thread.start()
+
+    def subscribe(self, channel):
+        with self.lock:
+            self.channels.add(channel)
+        self.send({'op': 'sub', 'channel': channel})
+
+    def unsubscribe(self, channel):
+        with self.lock:
+            self.channels.discard(channel)
+        self.send({'op': 'unsub', 'channel': channel})
+
+    def publish(self, channel, payload):
+        self.send({'op': 'pub', 'channel': channel, 'payload': payload})
+
+    # Send an op to the broker; dropped while disconnected (subscriptions are replayed on reconnect)
+    def send(self, op):
+        data = encode_frame(op, FRAMING_BINARY)
+        with self.lock:
+            if self.socket is None:
+                return False
+            try:
+                self.socket.sendall(data)
+                return True
+            except OSError as e:
+                print(f"Lost connection to bus broker: {e}")
+                self.drop_connection()
+                return False
+
+    def drop_connection(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket = None
+
+    def connect(self):
+        connection = socket.create_connection((self.host, self.port))
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.lock:
+            for channel in self.channels:
+                connection.sendall(encode_frame({'op': 'sub', 'channel': channel}, FRAMING_BINARY))
+            self.socket = connection
+        print(f"Connected to bus broker at {self.host}:{self.port}")
+        return connection
+
+    def run(self):
+        while not self.closed:
+            try:
+                connection = self.connect()
+            except OSError as e:
+                print(f"Could not reach bus broker at {self.host}:{self.port}: {e}")
+                time.sleep(BROKER_RECONNECT_DELAY)
+                continue
+
+            decoder = FrameDecoder(FRAMING_BINARY)
+            try:
+                while True:
+                    data = connection.recv(65536)
+                    if not data:
+                        break
+                    decoder.feed(data)
+                    while True:
+                        message = decoder.next_message()
+                        if message is None:
+                            break
+                        try:
+                            self.handler(message.get('channel'), message.get('payload'))
+                        except Exception as e:
+                            print(f"Error handling bus message: {e}")
+            except (OSError, ProtocolError) as e:
+                print(f"Bus connection error: {e}")
+
+            with self.lock:
+                if self.socket is connection:
+                    self.socket = None
+            try:
+                connection.close()
+            except OSError:
+                pass
+            if not self.closed:
+                time.sleep(BROKER_RECONNECT_DELAY)
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            if self.socket is not None:
+                self.drop_connection()
+
+# One node connected to the socket broker, as seen from the broker
+class BrokerClient:
+    def __init__(self, connection, address):
+        self.connection = connection
+        self.address = address
+        self.send_lock = threading.Lock()
+
+    def deliver(self, channel, payload):
+        data = encode_frame({'channel': channel, 'payload': payload}, FRAMING_BINARY)
+        with self.send_lock:
+            self.connection.sendall(data)
+
+def serve_broker_client(broker, connection, address):
+    client = BrokerClient(connection, address)
+    decoder = FrameDecoder(FRAMING_BINARY)
+    print(f"Bus node connected from {address}")
+    try:
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                break
+            decoder.feed(data)
+            while True:
+                op = decoder.next_message()
+                if op is None:
+                    break
+                if op.get('op') == 'sub':
+                    broker.subscribe(client, op.get('channel'))
+                elif op.get('op') == 'unsub':
+                    broker.unsubscribe(client, op.get('channel'))
+                elif op.get('op') == 'pub':
+                    broker.publish(client, op.get('channel'), op.get('payload'))
+    except (OSError, ProtocolError) as e:
+        print(f"Bus node {address} error: {e}")
+    finally:
+        broker.unsubscribe_all(client)
+        connection.close()
+        print(f"Bus node disconnected from {address}")
+
+# Listening socket for a broker; port 0 picks a free one (see getsockname())
+def open_broker_socket(host=BROKER_HOST, port=BROKER_PORT):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        server_socket.bind((host, port))
+        server_socket.listen(128)
+    except OSError:
+        server_socket.close()
+        raise
+    return server_socket
+
+# Run the socket broker (blocks). Bind it to loopback: it has no authentication.
+def run_broker(host=BROKER_HOST, port=BROKER_PORT):
+    serve_broker(open_broker_socket(host, port))
+
+def serve_broker(server_socket):
+    broker = LocalBroker()
+    host, port = server_socket.getsockname()[:2]
+    print(f"KawaiiChat bus broker started on {host}:{port}")
+    try:
+        while True:
+            connection, address = server_socket.accept()
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=serve_broker_client, args=(broker, connection, address), daemon=True).start()
+    finally:
+        server_socket.close()
+
+# Build a node-side bus from a URL: None or 'local' for a single-process bus,
+# 'tcp://host:port' for a socket broker
+def connect_bus(url, handler):
+    if not url or url == 'local':
+        return LocalBus(handler)
+
+    parsed = urlparse(url)
+    if parsed.scheme != 'tcp':
+        raise ValueError(f"Unsupported bus URL {url!r}")
+    return SocketBus(handler, parsed.hostname or BROKER_HOST, parsed.port or BROKER_PORT)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="KawaiiChat pub/sub bus broker")
+    parser.add_argument('--host', default=BROKER_HOST, help="address to listen on")
+    parser.add_argument('--port', type=int, default=BROKER_PORT, help="port to listen on")
+    args = parser.parse_args()
+    run_broker(args.host, args.port)
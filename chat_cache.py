@@ -0,0 +1,157 @@
+import threading
+from collections import OrderedDict
+
+# In-memory cache of the newest messages of recently viewed conversations, in
+# front of the history query. Each entry holds a conversation's tail in seq order,
+# in the shape get_chat_history_page returns, plus whether it is the whole
+# conversation. Writers keep cached tails current (write-through) rather than
+# invalidating them, so switching back and forth between chats stays in memory.
+# Least recently used conversations are evicted past max_conversations.
+#
+# A tail loaded from the database can be overtaken by a write that commits while
+# the query runs. Loads go through begin_fill()/finish_fill(): any write to the
+# conversation in between cancels the fill and the loaded page is not kept.
+
+# Receipts only move a message forward through these
+STATUS_ORDER = ('sent', 'delivered', 'read')
+
+def conversation_key(user1_id, user2_id):
+    return (user1_id, user2_id) if user1_id <= user2_id else (user2_id, user1_id)
+
+def message_position(message):
+    return (message['sent_at'], message['id'])
+
+class ConversationCache:
+    def __init__(self, max_conversations, tail_size):
+        self.max_conversations = max_conversations
+        self.tail_size = tail_size
+        self.enabled = max_conversations > 0 and tail_size > 0
+        self.entries = OrderedDict()  # {conversation key: [messages oldest first, complete]}
+        self.fills = {}  # {conversation key: token of the load in progress}
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'fills': 0, 'stale_fills': 0, 'evictions': 0}
+
+    # Only pages that fit in a cached tail are served from it
+    def cacheable(self, limit):
+        return self.enabled and limit <= self.tail_size
+
+    # The newest 'limit' messages and whether older ones exist, or None on a miss
+    def tail(self, user1_id, user2_id, limit):
+        key = conversation_key(user1_id, user2_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            messages, complete = entry
+            # Copies: receipts update cached messages while the page is being sent
+            return [dict(message) for message in messages[-limit:]], len(messages) > limit or not complete
+
+    def begin_fill(self, user1_id, user2_id):
+        token = object()
+        with self.lock:
+            self.fills[conversation_key(user1_id, user2_id)] = token
+        return token
+
+    # Messages with a seq above after_seq (at most limit of them) and whether newer
+    # ones follow, or None when the cached tail doesn't reach back to after_seq
+    def since(self, user1_id, user2_id, after_seq, limit):
+        key = conversation_key(user1_id, user2_id)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or not (entry[1] or entry[0][0]['seq'] <= after_seq + 1):
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            newer = [message for message in entry[0] if message['seq'] > after_seq]
+            return [dict(message) for message in newer[:limit]], len(newer) > limit
+
+    # Keep a tail loaded after begin_fill, unless a write got in first. Empty results
+    # are not kept: the backends return nothing on errors too.
+    def finish_fill(self, user1_id, user2_id, token, messages, has_more):
+        key = conversation_key(user1_id, user2_id)
+        with self.lock:
+            if self.fills.get(key) is not token:
+                self.counters['stale_fills'] += 1
+                return
+            del self.fills[key]
+            if not messages:
+                return
+            self.entries[key] = [[dict(message) for message in messages[-self.tail_size:]],
+                                 not has_more and len(messages) <= self.tail_size]
+            self.entries.move_to_end(key)
+            self.counters['fills'] += 1
+            while len(self.entries) > self.max_conversations:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    # Write-through of newly stored messages, in history shape
+    def add(self, messages):
+        with self.lock:
+            for message in messages:
+                key = conversation_key(message['sender_id'], message['receiver_id'])
+                self.fills.pop(key, None)
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                cached = entry[0]
+                if any(m['id'] == message['id'] for m in cached):
+                    continue
+                # Usually the newest, but batches can complete out of order
+                index = len(cached)
+                while index and cached[index - 1]['seq'] > message['seq']:
+                    index -= 1
+                cached.insert(index, dict(message))
+                if len(cached) > self.tail_size:
+                    del cached[:len(cached) - self.tail_size]
+                    entry[1] = False
+
+    # Apply status changes: [(sender id, receiver id, message id)]
+    def set_status(self, changes, status):
+        rank = STATUS_ORDER.index(status)
+        grouped = {}
+        for sender_id, receiver_id, message_id in changes:
+            grouped.setdefault(conversation_key(sender_id, receiver_id), set()).add(message_id)
+        with self.lock:
+            for key, message_ids in grouped.items():
+                self.fills.pop(key, None)
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                for message in entry[0]:
+                    if message['id'] in message_ids and STATUS_ORDER.index(message['status']) < rank:
+                        message['status'] = status
+
+    # Apply read marks: [(sender id, receiver id, (sent_at datetime, id))]
+    def mark_read(self, mark_changes):
+        with self.lock:
+            for sender_id, receiver_id, position in mark_changes:
+                key = conversation_key(sender_id, receiver_id)
+                self.fills.pop(key, None)
+                entry = self.entries.get(key)
+                if entry is None:
+                    continue
+                until = (position[0].isoformat(), position[1])
+                for message in entry[0]:
+                    if message['sender_id'] == sender_id and message_position(message) <= until:
+                        message['status'] = 'read'
+
+    def forget(self, user1_id, user2_id):
+        key = conversation_key(user1_id, user2_id)
+        with self.lock:
+            self.fills.pop(key, None)
+            self.entries.pop(key, None)
+
+    # Drop every conversation of a user, e.g. after their name changed
+    def forget_user(self, user_id):
+        with self.lock:
+            for key in [key for key in self.entries if user_id in key]:
+                del self.entries[key]
+            for key in [key for key in self.fills if user_id in key]:
+                del self.fills[key]
+
+    def size(self):
+        return len(self.entries)
@@ -0,0 +1,238 @@
+import json
+import zlib
+import struct
+import base64
+
+# Wire protocol shared by socket_server.py and kawaii_chat_client.py.
+#
+# Version 1 is newline-delimited JSON. A version 2 client opens with a 'hello'
+# message (still newline JSON) listing the framings it supports; the server
+# answers with 'hello_response' naming the one it picked, and from the next
+# frame on both sides use it. Old servers ignore 'hello', so clients fall back
+# to newline JSON when no answer arrives.
+PROTOCOL_VERSION = 2
+
+FRAMING_NEWLINE = 'newline'
+FRAMING_BINARY = 'binary'
+SUPPORTED_FRAMINGS = [FRAMING_BINARY, FRAMING_NEWLINE]
+
+# Optional stream compression, negotiated in the same hello exchange. Each direction
+# keeps one zlib stream for the life of the connection, so repeated ids and names
+# compress against everything sent before. Only binary frames can be compressed,
+# and only those above COMPRESSION_THRESHOLD bytes are.
+COMPRESSION_ZLIB = 'zlib'
+SUPPORTED_COMPRESSION = [COMPRESSION_ZLIB]
+COMPRESSION_THRESHOLD = 512
+COMPRESSION_LEVEL = 6
+
+# Binary frame: 4-byte big-endian body length and a flags byte, then the body.
+# Body: attachment count (1 byte), JSON length (4 bytes), compact JSON, then each
+# attachment as a 4-byte length and its raw bytes. Top-level bytes values of a
+# message travel as attachments and are referenced from the JSON as {"$bin": n},
+# so images never get base64-inflated.
+FRAME_HEADER = struct.Struct('!IB')
+FLAG_COMPRESSED = 0x01
+BODY_HEADER = struct.Struct('!BI')
+ATTACHMENT_HEADER = struct.Struct('!I')
+
+# Avatars are addressed by the SHA-256 of the uploaded image. Besides the original,
+# the server keeps square PNG thumbnails at these named sizes (pixels per side).
+AVATAR_ORIGINAL = 'original'
+AVATAR_SIZES = {
+    'contact': 40,
+    'header': 64,
+}
+
+# Largest frame (or newline JSON line) either side will buffer
+MAX_FRAME_BYTES = 16 * 1024 * 1024
+
+class ProtocolError(Exception):
+    pass
+
+# Pick the framing to use from the list a client offered
+def choose_framing(offered):
+    for framing in SUPPORTED_FRAMINGS:
+        if framing in (offered or []):
+            return framing
+    return FRAMING_NEWLINE
+
+# Pick the compression to use, only possible on top of binary framing
+def choose_compression(offered, framing):
+    if framing != FRAMING_BINARY:
+        return None
+    for compression in SUPPORTED_COMPRESSION:
+        if compression in (offered or []):
+            return compression
+    return None
+
+# Newline JSON has no room for raw bytes, so they are sent as base64 text
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+# Accept a binary field that arrived either raw (binary framing) or as base64 text (newline JSON)
+def as_bytes(value):
+    if value is None or isinstance(value, bytes):
+        return value
+    if isinstance(value, bytearray):
+        return bytes(value)
+    return base64.b64decode(value)
+
+# Serialize a message into the body of a binary frame
+def encode_body(payload):
+    attachments = []
+    document = {}
+    for key, value in payload.items():
+        if isinstance(value, (bytes, bytearray)):
+            document[key] = {'$bin': len(attachments)}
+            attachments.append(bytes(value))
+        else:
+            document[key] = value
+
+    json_bytes = json.dumps(document, separators=(',', ':'), default=_json_default).encode('utf-8')
+    parts = [BODY_HEADER.pack(len(attachments), len(json_bytes)), json_bytes]
+    for attachment in attachments:
+        parts.append(ATTACHMENT_HEADER.pack(len(attachment)))
+        parts.append(attachment)
+    return b''.join(parts)
+
+# Parse the body of a binary frame back into a message
+def decode_body(body):
+    body = memoryview(body)
+    if len(body) < BODY_HEADER.size:
+        raise ProtocolError("Truncated frame body")
+    count, json_length = BODY_HEADER.unpack_from(body)
+    offset = BODY_HEADER.size
+    message = json.loads(bytes(body[offset:offset + json_length]))
+    offset += json_length
+
+    attachments = []
+    for _ in range(count):
+        if offset + ATTACHMENT_HEADER.size > len(body):
+            raise ProtocolError("Truncated attachment header")
+        (length,) = ATTACHMENT_HEADER.unpack_from(body, offset)
+        offset += ATTACHMENT_HEADER.size
+        attachments.append(bytes(body[offset:offset + length]))
+        offset += length
+
+    if attachments:
+        if not isinstance(message, dict):
+            raise ProtocolError("Attachments on a frame that is not an object")
+        for key, value in message.items():
+            if isinstance(value, dict) and set(value) == {'$bin'}:
+                index = value['$bin']
+                # The index comes from the peer: anything but a valid position is malformed
+                if type(index) is not int or not 0 <= index < len(attachments):
+                    raise ProtocolError(f"Bad attachment reference {index!r}")
+                message[key] = attachments[index]
+    return message
+
+# Wrap an already-serialized body in a binary frame header
+def frame_body(body, flags=0):
+    return FRAME_HEADER.pack(len(body), flags) + body
+
+# Encode one message for the wire in the given framing
+def encode_frame(payload, framing=FRAMING_NEWLINE):
+    if framing == FRAMING_BINARY:
+        return frame_body(encode_body(payload))
+    return (json.dumps(payload, default=_json_default) + '\n').encode('utf-8')
+
+# Outgoing side of a connection. serialize() is stateless and can be shared between
+# recipients; frame() owns the compression stream, so it must be called by a single
+# writer in the order the frames go out.
+class FrameEncoder:
+    def __init__(self, framing=FRAMING_NEWLINE, compression=None, threshold=COMPRESSION_THRESHOLD):
+        self.framing = framing
+        self.threshold = threshold
+        self.compressor = None
+        if compression:
+            self.enable_compression(compression)
+
+    def enable_compression(self, compression):
+        if compression != COMPRESSION_ZLIB:
+            raise ProtocolError(f"Unsupported compression {compression!r}")
+        self.compressor = zlib.compressobj(COMPRESSION_LEVEL)
+
+    def serialize(self, payload):
+        if self.framing == FRAMING_BINARY:
+            return encode_body(payload)
+        return encode_frame(payload, FRAMING_NEWLINE)
+
+    # Turn serialized output into wire bytes; 'framing' is the framing it was serialized for
+    def frame(self, serialized, framing=None):
+        if (framing or self.framing) != FRAMING_BINARY:
+            return serialized
+        if self.compressor is not None and len(serialized) > self.threshold:
+            compressed = self.compressor.compress(serialized) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            return frame_body(compressed, FLAG_COMPRESSED)
+        return frame_body(serialized)
+
+    def encode(self, payload):
+        return self.frame(self.serialize(payload))
+
+# Incremental decoder: feed() raw bytes as they arrive and pull complete messages
+# with next_message(). The framing can be switched between messages, which is how
+# the hello exchange upgrades a connection mid-stream.
+class FrameDecoder:
+    def __init__(self, framing=FRAMING_NEWLINE, max_frame_bytes=MAX_FRAME_BYTES):
+        self.framing = framing
+        self.max_frame_bytes = max_frame_bytes
+        self.buffer = bytearray()
+        self.decompressor = None
+
+    def enable_compression(self, compression):
+        if compression != COMPRESSION_ZLIB:
+            raise ProtocolError(f"Unsupported compression {compression!r}")
+        self.decompressor = zlib.decompressobj()
+
+    def feed(self, data):
+        self.buffer += data
+
+    # Next complete message, or None if more bytes are needed.
+    # Raises json.JSONDecodeError for a bad newline JSON line (which is skipped)
+    # and ProtocolError when the stream cannot be recovered.
+    def next_message(self):
+        if self.framing == FRAMING_BINARY:
+            return self._next_binary()
+        return self._next_line()
+
+    def _next_line(self):
+        end = self.buffer.find(b'\n')
+        if end < 0:
+            if len(self.buffer) > self.max_frame_bytes:
+                raise ProtocolError(f"Line longer than {self.max_frame_bytes} bytes")
+            return None
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end + 1]
+        if not line.strip():
+            return self._next_line()
+        return json.loads(line)
+
+    def _next_binary(self):
+        if len(self.buffer) < FRAME_HEADER.size:
+            return None
+        length, flags = FRAME_HEADER.unpack_from(self.buffer)
+        if length > self.max_frame_bytes:
+            raise ProtocolError(f"Frame of {length} bytes exceeds {self.max_frame_bytes}")
+        end = FRAME_HEADER.size + length
+        if len(self.buffer) < end:
+            return None
+        body = bytes(self.buffer[FRAME_HEADER.size:end])
+        del self.buffer[:end]
+        return decode_body(self.unwrap(body, flags))
+
+    # Hook for frame-level transforms signalled in the flags byte
+    def unwrap(self, body, flags):
+        if flags & ~FLAG_COMPRESSED:
+            raise ProtocolError(f"Unsupported frame flags {flags:#x}")
+        if flags & FLAG_COMPRESSED:
+            if self.decompressor is None:
+                raise ProtocolError("Compressed frame on a connection without compression")
+            try:
+                body = self.decompressor.decompress(body, self.max_frame_bytes + 1)
+            except zlib.error as e:
+                raise ProtocolError(f"Corrupt compressed frame: {e}")
+            if self.decompressor.unconsumed_tail or len(body) > self.max_frame_bytes:
+                raise ProtocolError(f"Decompressed frame exceeds {self.max_frame_bytes} bytes")
+        return body
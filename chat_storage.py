@@ -0,0 +1,1797 @@
+import threading
+import time
+import datetime
+import bisect
+import re
+import secrets
+import sqlite3
+import uuid
+from contextlib import contextmanager
+
+# mysql-connector-python is only needed by the MySQL backend
+try:
+    import mysql.connector
+except ImportError:
+    mysql = None
+
+# Persistence behind the chat server. Every backend implements Storage; the server
+# only ever talks to one through the module-level functions in socket_server.py.
+#   MySQLStorage   the production database, pooled connections
+#   SQLiteStorage  a single file in WAL mode, for small deployments and benchmarks
+#   MemoryStorage  plain dicts, nothing survives a restart
+#
+# Conventions shared by all backends:
+#   - passwords arrive already hashed, ids already generated (see new_id())
+#   - ids are UUID strings in and out; the SQL backends store them as 16 bytes
+#   - datetimes go in as datetime objects and come out as ISO strings
+#   - a position in a message stream is (sent_at datetime, message id)
+#   - messages between two users share a conversation id (see conversation_id())
+#     and are numbered 1, 2, 3... within it in commit order: their seq
+#   - a message is delivered once the receiver's client acks it, read once they
+#     have seen it (read implies delivered)
+#   - failures are printed and reported through the return value, never raised
+
+BACKENDS = ('mysql', 'sqlite', 'memory')
+
+# Most ids bound into one IN (...) list
+MAX_IDS_PER_QUERY = 500
+
+# Characters of the last message kept in the inbox as a preview
+PREVIEW_LENGTH = 100
+
+# Rows read at a time while building the inbox of an existing database
+BACKFILL_CHUNK_SIZE = 5000
+
+# Columns holding ids, converted between bytes and strings at the SQL boundary
+ID_COLUMNS = ('id', 'sender_id', 'receiver_id', 'user_id', 'peer_id', 'last_message_id', 'last_sender_id',
+              'conversation_id', 'message_id')
+
+# Words indexed for search: lowercased runs of letters and digits of this many
+# characters (numbers of any length; longer runs are cut), up to
+# SEARCH_TERMS_PER_MESSAGE distinct ones per message
+SEARCH_MIN_TERM_LENGTH = 2
+SEARCH_MAX_TERM_LENGTH = 64
+SEARCH_TERMS_PER_MESSAGE = 200
+
+# Newest matches ranked per search word, so a search costs the same however
+# common the word is
+SEARCH_MATCHES_PER_TERM = 1000
+
+_word = re.compile(r'\w+')
+# Scripts written without spaces (Han, kana, Hangul) are indexed as overlapping
+# pairs of characters instead of whole runs
+_unspaced = re.compile('([\u1100-\u11ff\u3040-\u30ff\u3130-\u318f\u3400-\u4dbf'
+                       '\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+)')
+
+# Namespace of the name-based UUIDs that identify two-user conversations
+CONVERSATION_NAMESPACE = uuid.UUID('5f0e4a8c-2b7d-4c1e-9a63-6b6177616969')
+
+_id_lock = threading.Lock()
+_last_id = [0, 0]  # [milliseconds, counter] of the last id handed out
+
+# New time-ordered id: a UUID version 7 string. The first 48 bits are the Unix time
+# in milliseconds, so new rows go to the end of the primary key instead of a random
+# page. The 12 bits after the version count up within a millisecond (from a random
+# start), so ids from one process always increase.
+def new_id():
+    with _id_lock:
+        milliseconds = time.time_ns() // 1000000
+        if milliseconds <= _last_id[0]:
+            milliseconds = _last_id[0]
+            counter = _last_id[1] + 1
+            if counter > 0xFFF:
+                # Counter spent: borrow the next millisecond
+                milliseconds += 1
+                counter = secrets.randbits(11)
+        else:
+            counter = secrets.randbits(11)
+        _last_id[:] = [milliseconds, counter]
+
+    value = (milliseconds << 80) | (0x7 << 76) | (counter << 64) | (0b10 << 62) | secrets.randbits(62)
+    return str(uuid.UUID(int=value))
+
+# The nil UUID sorts below every id, as a string and as bytes, so the position
+# (sent_at, NIL_ID) comes just before every message sent at sent_at
+NIL_ID = str(uuid.UUID(int=0))
+
+# 16-byte form of an id for binding. Anything that isn't a UUID binds as NULL and
+# so matches nothing.
+def id_bytes(value):
+    try:
+        return uuid.UUID(value).bytes
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def id_text(value):
+    return str(uuid.UUID(bytes=bytes(value)))
+
+# Canonical id of the conversation between two users: the same UUID whichever way
+# round they are given, None if either isn't a UUID. Group chats can later use
+# ids of their own in the same column.
+def conversation_id(user1_id, user2_id):
+    try:
+        pair = sorted(str(uuid.UUID(user_id)) for user_id in (user1_id, user2_id))
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return str(uuid.uuid5(CONVERSATION_NAMESPACE, '/'.join(pair)))
+
+# Turn a datetime (or SQLite's text form of one) into an ISO string
+def iso_time(value):
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return value.isoformat() if value else value
+
+def now():
+    return datetime.datetime.now().replace(microsecond=0)
+
+# Delivery state of a message as shown to clients: 'sent', 'delivered' or 'read'
+def message_status(delivered, read):
+    return 'read' if read else 'delivered' if delivered else 'sent'
+
+def chunks(items, size=MAX_IDS_PER_QUERY):
+    items = list(items)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+# Split a run of letters and digits into search words: character pairs for
+# unspaced scripts, the rest as is
+def word_terms(word):
+    for i, part in enumerate(_unspaced.split(word)):
+        if i % 2:
+            if len(part) == 1:
+                yield part
+            for j in range(len(part) - 1):
+                yield part[j:j + 2]
+        elif len(part) >= SEARCH_MIN_TERM_LENGTH or part.isdigit():
+            yield part[:SEARCH_MAX_TERM_LENGTH]
+
+# Distinct search words of a text, in order of first appearance
+def search_terms(text):
+    terms = []
+    for word in _word.findall((text or '').lower()):
+        for term in word_terms(word):
+            if term not in terms:
+                terms.append(term)
+                if len(terms) == SEARCH_TERMS_PER_MESSAGE:
+                    return terms
+    return terms
+
+# Search index entries (user id, term, message id) of messages: both sides of a
+# conversation can find every word of it
+def search_rows(messages):
+    rows = set()
+    for message in messages:
+        terms = search_terms(message['message'])
+        for user_id in (message['sender_id'], message['receiver_id']):
+            rows.update((user_id, term, message['id']) for term in terms)
+    return sorted(rows)
+
+# Rank the message ids found for each search word: most words matched first, then
+# newest (ids are time-ordered). Returns up to limit (score, message id) strictly
+# after the (score, id) position 'after', and whether more follow.
+def rank_search_hits(matches, after, limit):
+    scores = {}
+    for message_ids in matches:
+        for message_id in message_ids:
+            scores[message_id] = scores.get(message_id, 0) + 1
+    ranked = sorted(((score, message_id) for message_id, score in scores.items()), reverse=True)
+    if after:
+        ranked = [hit for hit in ranked if hit < tuple(after)]
+    return ranked[:limit], len(ranked) > limit
+
+# Fold messages into pending inbox changes {(user, peer): [unread increment, newest message]}.
+# Both sides of a conversation get the newest message; the receiver's count goes up
+# unless the message is already read (only when rebuilding from existing rows).
+def merge_inbox_updates(updates, messages):
+    for message in messages:
+        unread = 0 if message.get('read_status') else 1
+        for key, increment in (((message['sender_id'], message['receiver_id']), 0),
+                               ((message['receiver_id'], message['sender_id']), unread)):
+            update = updates.setdefault(key, [0, message])
+            update[0] += increment
+            if (message['sent_at'], message['id']) > (update[1]['sent_at'], update[1]['id']):
+                update[1] = message
+    return updates
+
+class Storage:
+    # Create the schema if needed. Returns True when the backend is ready.
+    def setup(self):
+        raise NotImplementedError
+
+    # User row for these credentials, or None
+    def authenticate_user(self, username, password_hash):
+        raise NotImplementedError
+
+    # Returns True if the user was created, False if the name is taken or on error
+    def register_user(self, user_id, username, password_hash, display_name):
+        raise NotImplementedError
+
+    # last_seen defaults to now
+    def update_user_status(self, user_id, status, last_seen=None):
+        raise NotImplementedError
+
+    def get_all_users(self):
+        raise NotImplementedError
+
+    # Returns (success, message)
+    def update_username(self, user_id, new_username):
+        raise NotImplementedError
+
+    def set_profile_pic(self, user_id, avatar_hash):
+        raise NotImplementedError
+
+    # Store a batch of messages (id, sender_id, receiver_id, message, sent_at) all or
+    # nothing, setting each message's conversation_id and seq
+    def insert_messages(self, messages):
+        raise NotImplementedError
+
+    # Add stored messages (as left by insert_messages) to the search index, in a
+    # transaction of their own. Indexing a message twice is harmless. Returns success.
+    def index_messages(self, messages):
+        raise NotImplementedError
+
+    # Index the stored messages of each conversation from a seq on, {conversation
+    # id: seq}: those that could not be handed to index_messages. Returns success.
+    def index_conversations(self, starts):
+        raise NotImplementedError
+
+    # Whole conversation, oldest first. History messages carry their 'seq' and
+    # delivery 'status'.
+    def get_chat_history(self, user1_id, user2_id):
+        raise NotImplementedError
+
+    # Up to limit messages with a seq below 'before' (the latest ones without it),
+    # oldest first, and whether older ones exist: (messages, has_more)
+    def get_chat_history_page(self, user1_id, user2_id, before, limit):
+        raise NotImplementedError
+
+    # Up to limit messages with a seq above after_seq, oldest first, and whether
+    # newer ones follow: (messages, has_more)
+    def get_chat_history_since(self, user1_id, user2_id, after_seq, limit):
+        raise NotImplementedError
+
+    # {sender id: unread count}, read from the inbox
+    def get_unread_counts(self, user_id):
+        raise NotImplementedError
+
+    # The user's conversations, most recent first: one dict per peer with user_id,
+    # unread, last_message_id, last_sender_id, last_preview and last_sent_at.
+    # Kept up to date by insert_messages and apply_acks.
+    def get_inbox(self, user_id):
+        raise NotImplementedError
+
+    # Messages of the user's conversations containing any of the search terms (see
+    # search_terms()), ranked by rank_search_hits() over the newest
+    # SEARCH_MATCHES_PER_TERM matches of each term. Returns up to limit history
+    # messages with their 'score', after the (score, id) position 'after', and the
+    # position of the last ranked hit if more follow, else None: (messages, next_after).
+    # A hit whose message is gone is skipped, but next_after still moves past it.
+    def search_messages(self, user_id, terms, after, limit):
+        raise NotImplementedError
+
+    # Up to limit undelivered messages strictly after position 'after', oldest first, or None on error
+    def get_undelivered_messages_chunk(self, user_id, after, limit):
+        raise NotImplementedError
+
+    # Apply a batch of acks from receivers:
+    #   delivered   {receiver id: set of message ids}
+    #   read        {receiver id: set of message ids}
+    #   read_marks  {(receiver id, sender id): position}, everything up to and
+    #               including the position is read
+    # Only messages addressed to the acking receiver change. Returns what actually
+    # changed, for read receipts: (newly delivered [(sender, receiver, id)],
+    # newly read [(sender, receiver, id)], marks that read something
+    # [(sender, receiver, position)]), or None on error.
+    def apply_acks(self, delivered, read, read_marks):
+        raise NotImplementedError
+
+    # Counters for the metrics endpoint
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+# Bounded pool of database connections. 'connect' opens a new connection or returns
+# None; 'ping' (optional) checks one that sat idle for health_check_idle seconds.
+class ConnectionPool:
+    def __init__(self, connect, size, timeout, health_check_idle=None, ping=None):
+        self.connect = connect
+        self.ping = ping
+        self.size = size
+        self.timeout = timeout
+        self.health_check_idle = health_check_idle
+        self.condition = threading.Condition()
+        # Idle connections as (connection, released_at), most recently used last
+        self.idle = []
+        self.open_count = 0
+        self.in_use = 0
+        self.counters = {
+            'created': 0,
+            'acquired': 0,
+            'waits': 0,
+            'wait_seconds': 0.0,
+            'timeouts': 0,
+            'discarded': 0,
+            'health_check_failures': 0,
+        }
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        started = time.monotonic()
+        waited = False
+
+        with self.condition:
+            while True:
+                if self.idle:
+                    connection, released_at = self.idle.pop()
+                    break
+                if self.open_count < self.size:
+                    # Reserve a slot, the connection itself is opened outside the lock
+                    self.open_count += 1
+                    connection, released_at = None, None
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.counters['timeouts'] += 1
+                    print(f"Database pool exhausted: {self.size} connections busy for {self.timeout}s")
+                    return None
+                waited = True
+                self.condition.wait(remaining)
+
+            self.in_use += 1
+            self.counters['acquired'] += 1
+            if waited:
+                self.counters['waits'] += 1
+                self.counters['wait_seconds'] += time.monotonic() - started
+
+        if (connection is not None and self.ping is not None
+                and time.monotonic() - released_at > self.health_check_idle):
+            # Connections idle for a while may have been dropped by the server
+            try:
+                self.ping(connection)
+            except Exception as e:
+                print(f"Database pool health check failed: {e}")
+                with self.condition:
+                    self.counters['health_check_failures'] += 1
+                self._close(connection)
+                connection = None
+
+        if connection is None:
+            connection = self.connect()
+            if connection is None:
+                self._forget_slot()
+                return None
+            with self.condition:
+                self.counters['created'] += 1
+
+        return connection
+
+    def release(self, connection):
+        try:
+            # Never hand the next caller a half-finished transaction
+            if connection.in_transaction:
+                connection.rollback()
+        except Exception as e:
+            print(f"Discarding broken database connection: {e}")
+            self._close(connection)
+            with self.condition:
+                self.counters['discarded'] += 1
+            self._forget_slot()
+            return
+
+        with self.condition:
+            self.in_use -= 1
+            self.idle.append((connection, time.monotonic()))
+            self.condition.notify()
+
+    def _forget_slot(self):
+        with self.condition:
+            self.open_count -= 1
+            self.in_use -= 1
+            self.condition.notify()
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close(self):
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.open_count -= len(idle)
+        for connection, _ in idle:
+            self._close(connection)
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats['size'] = self.size
+            stats['open'] = self.open_count
+            stats['in_use'] = self.in_use
+            stats['idle'] = len(self.idle)
+            return stats
+
+# Queries shared by the SQL backends. They are written with %s placeholders and
+# subclasses translate them; every cursor returns rows as dicts.
+class SQLStorage(Storage):
+    Error = Exception
+    IntegrityError = Exception
+
+    # Add unread counts to inbox rows and move their last message forward, one row
+    # per (user, peer) with the values of inbox_row(); dialects differ
+    INBOX_UPSERT = None
+
+    # Add to conversations' last_seq, creating the rows at 0: (id, count) per row;
+    # dialects differ
+    SEQUENCE_UPSERT = None
+
+    # Add search_terms rows (user_id, term, message_id), skipping those already there;
+    # dialects differ
+    SEARCH_INSERT = None
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    # Open a connection outside the pool (used for setup)
+    def create_connection(self):
+        raise NotImplementedError
+
+    def cursor(self, connection):
+        raise NotImplementedError
+
+    def execute(self, cursor, sql, params=()):
+        cursor.execute(sql, params)
+
+    def executemany(self, cursor, sql, rows):
+        cursor.executemany(sql, rows)
+
+    # Value to bind for a datetime parameter
+    def db_time(self, value):
+        return value
+
+    # Rows with their binary ids turned back into strings
+    def from_db(self, row):
+        for field in ID_COLUMNS:
+            if row.get(field) is not None:
+                row[field] = id_text(row[field])
+        return row
+
+    def fetchone(self, cursor):
+        row = cursor.fetchone()
+        return self.from_db(row) if row else row
+
+    def fetchall(self, cursor):
+        return [self.from_db(row) for row in cursor.fetchall()]
+
+    def fetchmany(self, cursor, size):
+        return [self.from_db(row) for row in cursor.fetchmany(size)]
+
+    # Add messages to the search index. Each id is converted once, not once per word.
+    def insert_search_rows(self, cursor, messages):
+        rows = search_rows(messages)
+        if rows:
+            ids = {value: id_bytes(value) for message in messages
+                   for value in (message['id'], message['sender_id'], message['receiver_id'])}
+            self.executemany(cursor, self.SEARCH_INSERT,
+                             [(ids[user_id], term, ids[message_id]) for user_id, term, message_id in rows])
+
+    # Move each conversation's indexed_seq up to the newest of these messages. Only
+    # ever forward: another worker may have indexed later messages already.
+    def mark_indexed(self, cursor, messages):
+        newest = {}
+        for message in messages:
+            newest[message['conversation_id']] = max(newest.get(message['conversation_id'], 0), message['seq'])
+        # Sorted like insert_messages locks them, so the two never deadlock
+        self.executemany(cursor, "UPDATE conversations SET indexed_seq = %s WHERE id = %s AND indexed_seq < %s",
+                         [(seq, id_bytes(key), seq) for key, seq in sorted(newest.items())])
+
+    def inbox_row(self, key, update):
+        (user_id, peer_id), (unread, message) = key, update
+        return (id_bytes(user_id), id_bytes(peer_id), unread, id_bytes(message['id']), id_bytes(message['sender_id']),
+                message['message'][:PREVIEW_LENGTH], self.db_time(message['sent_at']))
+
+    # CREATE TABLE IF NOT EXISTS statements for users, messages, inbox,
+    # conversations and search_terms, with 'suffix' appended to the table names
+    def table_definitions(self, suffix=''):
+        raise NotImplementedError
+
+    # Whether the database predates binary ids and still keeps them as text
+    def has_text_ids(self, cursor):
+        raise NotImplementedError
+
+    # SQL expression giving the 16 bytes of a text id column
+    def id_from_text_sql(self, column):
+        raise NotImplementedError
+
+    # Put the rebuilt tables (named with 'suffix') in place of the old ones
+    def swap_tables(self, cursor, suffix):
+        raise NotImplementedError
+
+    def begin(self, cursor):
+        pass
+
+    # Convert a database with text ids: build tables with binary ids next to the old
+    # ones, copy users and messages across, then swap the new tables in. The inbox
+    # message numbering and search index are left for the backfills.
+    def migrate_ids(self, connection):
+        print("Converting ids to binary, copying users and messages...")
+        cursor = self.cursor(connection)
+        self.begin(cursor)
+        # Leftovers of an interrupted run
+        for table in ('search_terms', 'conversations', 'inbox', 'messages', 'users'):
+            self.execute(cursor, f"DROP TABLE IF EXISTS {table}_binary")
+        for statement in self.table_definitions('_binary'):
+            self.execute(cursor, statement)
+
+        id_sql = self.id_from_text_sql
+        self.execute(cursor, f'''
+            INSERT INTO users_binary (id, username, password, display_name, last_seen, status, profile_pic, created_at)
+            SELECT {id_sql('id')}, username, password, display_name, last_seen, status, profile_pic, created_at
+            FROM users
+        ''')
+        self.execute(cursor, f'''
+            INSERT INTO messages_binary (id, sender_id, receiver_id, message, sent_at, read_status, delivered)
+            SELECT {id_sql('id')}, {id_sql('sender_id')}, {id_sql('receiver_id')}, message, sent_at, read_status, delivered
+            FROM messages
+            ORDER BY sent_at, id
+        ''')
+        self.swap_tables(cursor, '_binary')
+        connection.commit()
+        cursor.close()
+
+    # Number the messages of databases that predate sequence numbers: each
+    # conversation from 1 in (sent_at, id) order, and its counter set to match
+    def backfill_sequences(self, connection):
+        cursor = self.cursor(connection)
+        self.execute(cursor, "SELECT COUNT(*) AS unnumbered FROM messages WHERE seq IS NULL")
+        if not cursor.fetchone()['unnumbered']:
+            cursor.close()
+            return
+
+        self.execute(cursor, "SELECT id, sender_id, receiver_id FROM messages ORDER BY sent_at, id")
+        last_seqs = {}
+        numbered = []
+        while True:
+            rows = self.fetchmany(cursor, BACKFILL_CHUNK_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                key = conversation_id(row['sender_id'], row['receiver_id'])
+                last_seqs[key] = last_seqs.get(key, 0) + 1
+                numbered.append((id_bytes(key), last_seqs[key], id_bytes(row['id'])))
+
+        print(f"Numbering {len(numbered)} messages in {len(last_seqs)} conversations...")
+        for batch in chunks(numbered, BACKFILL_CHUNK_SIZE):
+            self.executemany(cursor, "UPDATE messages SET conversation_id = %s, seq = %s WHERE id = %s", batch)
+        self.execute(cursor, "DELETE FROM conversations")
+        for batch in chunks(sorted(last_seqs.items()), BACKFILL_CHUNK_SIZE):
+            self.executemany(cursor, "INSERT INTO conversations (id, last_seq) VALUES (%s, %s)",
+                             [(id_bytes(key), last_seq) for key, last_seq in batch])
+        connection.commit()
+        cursor.close()
+
+    # Build the inbox from existing messages, for databases that predate it
+    def backfill_inbox(self, connection):
+        cursor = self.cursor(connection)
+        self.execute(cursor, "SELECT COUNT(*) AS conversations FROM inbox")
+        if cursor.fetchone()['conversations']:
+            cursor.close()
+            return
+
+        self.execute(cursor, "SELECT id, sender_id, receiver_id, message, sent_at, read_status FROM messages")
+        updates = {}
+        while True:
+            rows = self.fetchmany(cursor, BACKFILL_CHUNK_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                if isinstance(row['sent_at'], str):
+                    row['sent_at'] = datetime.datetime.fromisoformat(row['sent_at'])
+            merge_inbox_updates(updates, rows)
+
+        if updates:
+            print(f"Building inbox for {len(updates)} conversations...")
+            for batch in chunks(sorted(updates.items()), BACKFILL_CHUNK_SIZE):
+                self.executemany(cursor, self.INBOX_UPSERT, [self.inbox_row(key, update) for key, update in batch])
+        connection.commit()
+        cursor.close()
+
+    # Index the messages each conversation has past its indexed_seq: all of them on
+    # databases that predate search, otherwise the last few stored before a stop cut
+    # their indexing short. Walks the sequence index a chunk at a time.
+    def backfill_search(self, connection):
+        cursor = self.cursor(connection)
+        self.execute(cursor, "SELECT id, indexed_seq FROM conversations WHERE indexed_seq < last_seq")
+        behind = self.fetchall(cursor)
+        if behind:
+            print(f"Indexing messages of {len(behind)} conversations for search...")
+
+        for conversation in behind:
+            self.index_conversation(cursor, conversation['id'], conversation['indexed_seq'])
+        connection.commit()
+        cursor.close()
+
+    # Index a conversation's messages with a seq above after_seq, a chunk at a time
+    def index_conversation(self, cursor, conversation_id, after_seq):
+        while True:
+            self.execute(cursor, '''
+                SELECT id, sender_id, receiver_id, message, conversation_id, seq FROM messages
+                WHERE conversation_id = %s AND seq > %s ORDER BY seq LIMIT %s
+            ''', (id_bytes(conversation_id), after_seq, BACKFILL_CHUNK_SIZE))
+            rows = self.fetchall(cursor)
+            if not rows:
+                break
+            self.insert_search_rows(cursor, rows)
+            self.mark_indexed(cursor, rows)
+            after_seq = rows[-1]['seq']
+
+    # Shape a history row for clients: ISO time and one status in place of the two flags
+    def history_message(self, message):
+        message['sent_at'] = iso_time(message['sent_at'])
+        message['status'] = message_status(message.pop('delivered'), message.pop('read_status'))
+        return message
+
+    # Borrow a pooled connection for the duration of a with-block (None if the pool is exhausted)
+    @contextmanager
+    def connection(self):
+        connection = self.pool.acquire()
+        try:
+            yield connection
+        finally:
+            if connection is not None:
+                self.pool.release(connection)
+
+    def authenticate_user(self, username, password_hash):
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    self.execute(cursor, "SELECT * FROM users WHERE username = %s AND password = %s",
+                                 (username, password_hash))
+                    user = self.fetchone(cursor)
+                    cursor.close()
+                except self.Error as e:
+                    print(f"Error authenticating user: {e}")
+                    return None
+
+                if user:
+                    for field in ('last_seen', 'created_at'):
+                        user[field] = iso_time(user.get(field))
+                    return user
+
+        return None
+
+    def register_user(self, user_id, username, password_hash, display_name):
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    self.execute(
+                        cursor,
+                        "INSERT INTO users (id, username, password, display_name) VALUES (%s, %s, %s, %s)",
+                        (id_bytes(user_id), username, password_hash, display_name)
+                    )
+                    connection.commit()
+                    cursor.close()
+                    return True
+                except self.Error as e:
+                    print(f"Error registering user: {e}")
+                    return False
+
+        return False
+
+    def update_user_status(self, user_id, status, last_seen=None):
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    self.execute(cursor, "UPDATE users SET status = %s, last_seen = %s WHERE id = %s",
+                                 (status, self.db_time(last_seen or now()), id_bytes(user_id)))
+                    connection.commit()
+                    cursor.close()
+                    return True
+                except self.Error as e:
+                    print(f"Error updating user status: {e}")
+                    return False
+
+        return False
+
+    def get_all_users(self):
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    self.execute(cursor, '''
+                        SELECT id, username, display_name, status, last_seen, profile_pic
+                        FROM users
+                    ''')
+                    users = self.fetchall(cursor)
+                    cursor.close()
+                except self.Error as e:
+                    print(f"Error getting users: {e}")
+                    return []
+
+                for user in users:
+                    user['last_seen'] = iso_time(user['last_seen'])
+                return users
+
+        return []
+
+    def update_username(self, user_id, new_username):
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    self.execute(cursor, "UPDATE users SET username = %s WHERE id = %s", (new_username, id_bytes(user_id)))
+                    connection.commit()
+                    cursor.close()
+                    return True, 'Username updated'
+                except self.IntegrityError:
+                    return False, 'Username is already taken'
+                except self.Error as e:
+                    print(f"Error updating username: {e}")
+                    return False, 'Username update failed'
+
+        return False, 'Database unavailable'
+
+    def set_profile_pic(self, user_id, avatar_hash):
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    self.execute(cursor, "UPDATE users SET profile_pic = %s WHERE id = %s", (avatar_hash, id_bytes(user_id)))
+                    connection.commit()
+                    cursor.close()
+                    return True
+                except self.Error as e:
+                    print(f"Error updating profile picture: {e}")
+                    return False
+
+        return False
+
+    # One multi-row INSERT and a single commit. Sequence numbers are reserved by
+    # bumping each conversation's counter row, which stays locked until the commit,
+    # so concurrent writers (other workers) take turns per conversation.
+    def insert_messages(self, messages):
+        counts = {}
+        for message in messages:
+            message['conversation_id'] = conversation_id(message['sender_id'], message['receiver_id'])
+            counts[message['conversation_id']] = counts.get(message['conversation_id'], 0) + 1
+        # Sorted so concurrent writers lock counter rows in the same order
+        keys = sorted(counts, key=str)
+
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    self.executemany(cursor, self.SEQUENCE_UPSERT, [(id_bytes(key), counts[key]) for key in keys])
+                    last_seqs = {}
+                    for batch in chunks(keys):
+                        placeholders = ', '.join(['%s'] * len(batch))
+                        self.execute(cursor, f"SELECT id, last_seq FROM conversations WHERE id IN ({placeholders})",
+                                     tuple(id_bytes(key) for key in batch))
+                        last_seqs.update((row['id'], row['last_seq']) for row in self.fetchall(cursor))
+                    next_seqs = {key: last_seqs[key] - counts[key] + 1 for key in keys}
+                    for message in messages:
+                        message['seq'] = next_seqs[message['conversation_id']]
+                        next_seqs[message['conversation_id']] += 1
+
+                    self.executemany(
+                        cursor,
+                        '''INSERT INTO messages (id, sender_id, receiver_id, message, sent_at, conversation_id, seq)
+                           VALUES (%s, %s, %s, %s, %s, %s, %s)''',
+                        [(id_bytes(m['id']), id_bytes(m['sender_id']), id_bytes(m['receiver_id']), m['message'],
+                          self.db_time(m['sent_at']), id_bytes(m['conversation_id']), m['seq'])
+                         for m in messages]
+                    )
+                    # Same transaction, so the inbox never disagrees with the messages.
+                    # Sorted so concurrent writers lock inbox rows in the same order.
+                    updates = merge_inbox_updates({}, messages)
+                    self.executemany(cursor, self.INBOX_UPSERT,
+                                     [self.inbox_row(key, updates[key]) for key in sorted(updates)])
+                    connection.commit()
+                    cursor.close()
+                    return True
+                except self.Error as e:
+                    print(f"Error storing {len(messages)} messages: {e}")
+                    return False
+
+        return False
+
+    # Outside the message transaction, so the group commit doesn't pay for the index
+    def index_messages(self, messages):
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    self.insert_search_rows(cursor, messages)
+                    self.mark_indexed(cursor, messages)
+                    connection.commit()
+                    cursor.close()
+                    return True
+                except self.Error as e:
+                    print(f"Error indexing {len(messages)} messages: {e}")
+                    return False
+
+        return False
+
+    # indexed_seq is wound back first, in a commit of its own: later messages may
+    # have moved it past the missing ones, and if the server stops before they are
+    # indexed here, backfill_search() has to find them
+    def index_conversations(self, starts):
+        starts = sorted(starts.items())
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    self.executemany(cursor,
+                                     "UPDATE conversations SET indexed_seq = %s WHERE id = %s AND indexed_seq > %s",
+                                     [(seq - 1, id_bytes(key), seq - 1) for key, seq in starts])
+                    connection.commit()
+                    for key, seq in starts:
+                        self.index_conversation(cursor, key, seq - 1)
+                        connection.commit()
+                    cursor.close()
+                    return True
+                except self.Error as e:
+                    print(f"Error indexing {len(starts)} conversations: {e}")
+                    return False
+
+        return False
+
+    def get_chat_history(self, user1_id, user2_id):
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    self.execute(cursor, '''
+                        SELECT m.id, m.seq, m.message, m.sent_at, m.sender_id, m.receiver_id, m.delivered, m.read_status,
+                               u.username as sender_username, u.display_name as sender_display_name
+                        FROM messages m
+                        JOIN users u ON m.sender_id = u.id
+                        WHERE m.conversation_id = %s
+                        ORDER BY m.seq ASC
+                    ''', (id_bytes(conversation_id(user1_id, user2_id)),))
+                    messages = self.fetchall(cursor)
+                    cursor.close()
+                except self.Error as e:
+                    print(f"Error getting chat history: {e}")
+                    return []
+
+                return [self.history_message(message) for message in messages]
+
+        return []
+
+    # Both directions of the conversation are one range of idx_messages_sequence,
+    # read backwards and cut at limit + 1 rows so we know whether an older page exists
+    def get_chat_history_page(self, user1_id, user2_id, before, limit):
+        keyset = ''
+        keyset_params = ()
+        if before:
+            keyset = 'AND m.seq < %s'
+            keyset_params = (before,)
+
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    self.execute(cursor, f'''
+                        SELECT m.id, m.seq, m.message, m.sent_at, m.sender_id, m.receiver_id, m.delivered, m.read_status,
+                               u.username as sender_username, u.display_name as sender_display_name
+                        FROM messages m
+                        JOIN users u ON m.sender_id = u.id
+                        WHERE m.conversation_id = %s {keyset}
+                        ORDER BY m.seq DESC
+                        LIMIT %s
+                    ''', (id_bytes(conversation_id(user1_id, user2_id)),) + keyset_params + (limit + 1,))
+                    messages = self.fetchall(cursor)
+                    cursor.close()
+                except self.Error as e:
+                    print(f"Error getting chat history page: {e}")
+                    return [], False
+
+                has_more = len(messages) > limit
+                messages = messages[:limit]
+                messages.reverse()
+                return [self.history_message(message) for message in messages], has_more
+
+        return [], False
+
+    # The same range read forwards from after_seq
+    def get_chat_history_since(self, user1_id, user2_id, after_seq, limit):
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    self.execute(cursor, '''
+                        SELECT m.id, m.seq, m.message, m.sent_at, m.sender_id, m.receiver_id, m.delivered, m.read_status,
+                               u.username as sender_username, u.display_name as sender_display_name
+                        FROM messages m
+                        JOIN users u ON m.sender_id = u.id
+                        WHERE m.conversation_id = %s AND m.seq > %s
+                        ORDER BY m.seq ASC
+                        LIMIT %s
+                    ''', (id_bytes(conversation_id(user1_id, user2_id)), after_seq, limit + 1))
+                    messages = self.fetchall(cursor)
+                    cursor.close()
+                except self.Error as e:
+                    print(f"Error getting chat history since {after_seq}: {e}")
+                    return [], False
+
+                return [self.history_message(message) for message in messages[:limit]], len(messages) > limit
+
+        return [], False
+
+    def get_unread_counts(self, user_id):
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    self.execute(cursor, '''
+                        SELECT peer_id, unread_count FROM inbox
+                        WHERE user_id = %s AND unread_count > 0
+                    ''', (id_bytes(user_id),))
+                    counts = {row['peer_id']: row['unread_count'] for row in self.fetchall(cursor)}
+                    cursor.close()
+                    return counts
+                except self.Error as e:
+                    print(f"Error counting unread messages: {e}")
+                    return {}
+
+        return {}
+
+    # One primary key range, no message bodies
+    def get_inbox(self, user_id):
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    self.execute(cursor, '''
+                        SELECT peer_id AS user_id, unread_count AS unread, last_message_id, last_sender_id,
+                               last_preview, last_sent_at
+                        FROM inbox
+                        WHERE user_id = %s
+                        ORDER BY last_sent_at DESC
+                    ''', (id_bytes(user_id),))
+                    conversations = self.fetchall(cursor)
+                    cursor.close()
+                except self.Error as e:
+                    print(f"Error getting inbox: {e}")
+                    return []
+
+                for conversation in conversations:
+                    conversation['last_sent_at'] = iso_time(conversation['last_sent_at'])
+                return conversations
+
+        return []
+
+    # One bounded primary key range of search_terms per term, then the page's
+    # messages by id
+    def search_messages(self, user_id, terms, after, limit):
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    matches = []
+                    for term in terms:
+                        self.execute(cursor, '''
+                            SELECT message_id FROM search_terms
+                            WHERE user_id = %s AND term = %s
+                            ORDER BY message_id DESC
+                            LIMIT %s
+                        ''', (id_bytes(user_id), term, SEARCH_MATCHES_PER_TERM))
+                        matches.append([row['message_id'] for row in self.fetchall(cursor)])
+                    hits, has_more = rank_search_hits(matches, after, limit)
+
+                    rows = {}
+                    if hits:
+                        placeholders = ', '.join(['%s'] * len(hits))
+                        self.execute(cursor, f'''
+                            SELECT m.id, m.seq, m.message, m.sent_at, m.sender_id, m.receiver_id, m.delivered,
+                                   m.read_status, u.username as sender_username, u.display_name as sender_display_name
+                            FROM messages m
+                            JOIN users u ON m.sender_id = u.id
+                            WHERE m.id IN ({placeholders})
+                        ''', tuple(id_bytes(message_id) for _, message_id in hits))
+                        rows = {row['id']: row for row in self.fetchall(cursor)}
+                    cursor.close()
+                except self.Error as e:
+                    print(f"Error searching messages: {e}")
+                    return [], None
+
+                messages = [dict(self.history_message(rows[message_id]), score=score)
+                            for score, message_id in hits if message_id in rows]
+                return messages, hits[-1] if has_more and hits else None
+
+        return [], None
+
+    # Walks idx_messages_undelivered one bounded range at a time
+    def get_undelivered_messages_chunk(self, user_id, after, limit):
+        keyset = ''
+        keyset_params = ()
+        if after:
+            keyset = 'AND (m.sent_at > %s OR (m.sent_at = %s AND m.id > %s))'
+            keyset_params = (self.db_time(after[0]), self.db_time(after[0]), id_bytes(after[1]))
+
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    self.execute(cursor, f'''
+                        SELECT m.id, m.seq, m.message, m.sent_at, m.sender_id,
+                               u.username as sender_username, u.display_name as sender_display_name
+                        FROM messages m
+                        JOIN users u ON m.sender_id = u.id
+                        WHERE m.receiver_id = %s AND m.delivered = FALSE {keyset}
+                        ORDER BY m.sent_at ASC, m.id ASC
+                        LIMIT %s
+                    ''', (id_bytes(user_id),) + keyset_params + (limit,))
+                    messages = self.fetchall(cursor)
+                    cursor.close()
+                except self.Error as e:
+                    print(f"Error getting undelivered messages: {e}")
+                    return None
+
+                for message in messages:
+                    message['sent_at'] = iso_time(message['sent_at'])
+                return messages
+
+        return None
+
+    # Acked ids are primary key lookups and read marks one range of
+    # idx_messages_conversation, all applied in a single transaction
+    def apply_acks(self, delivered, read, read_marks):
+        delivered_changes = []
+        read_changes = []
+        mark_changes = []
+
+        with self.connection() as connection:
+            if connection:
+                cursor = self.cursor(connection)
+
+                try:
+                    # Current state of every acked message, to report only real changes
+                    acked = set().union(*delivered.values(), *read.values())
+                    rows = []
+                    for ids in chunks(acked):
+                        placeholders = ', '.join(['%s'] * len(ids))
+                        self.execute(cursor, f'''
+                            SELECT id, sender_id, receiver_id, delivered, read_status
+                            FROM messages WHERE id IN ({placeholders})
+                        ''', tuple(id_bytes(message_id) for message_id in ids))
+                        rows.extend(self.fetchall(cursor))
+
+                    for row in rows:
+                        receiver_id = row['receiver_id']
+                        change = (row['sender_id'], receiver_id, row['id'])
+                        if row['id'] in read.get(receiver_id, ()) and not row['read_status']:
+                            read_changes.append(change)
+                        elif row['id'] in delivered.get(receiver_id, ()) and not row['delivered']:
+                            delivered_changes.append(change)
+
+                    for changes, assignments in ((delivered_changes, 'delivered = TRUE'),
+                                                 (read_changes, 'delivered = TRUE, read_status = TRUE')):
+                        for batch in chunks(changes):
+                            placeholders = ', '.join(['%s'] * len(batch))
+                            self.execute(cursor,
+                                         f"UPDATE messages SET {assignments} WHERE id IN ({placeholders})",
+                                         tuple(id_bytes(message_id) for _, _, message_id in batch))
+
+                    # Messages newly read per (receiver, sender), taken off the inbox counts
+                    read_counts = {}
+                    for sender_id, receiver_id, _ in read_changes:
+                        read_counts[(receiver_id, sender_id)] = read_counts.get((receiver_id, sender_id), 0) + 1
+
+                    for (receiver_id, sender_id), position in read_marks.items():
+                        self.execute(cursor, '''
+                            UPDATE messages SET delivered = TRUE, read_status = TRUE
+                            WHERE sender_id = %s AND receiver_id = %s AND read_status = FALSE
+                              AND (sent_at < %s OR (sent_at = %s AND id <= %s))
+                        ''', (id_bytes(sender_id), id_bytes(receiver_id), self.db_time(position[0]),
+                              self.db_time(position[0]), id_bytes(position[1])))
+                        if cursor.rowcount:
+                            mark_changes.append((sender_id, receiver_id, position))
+                            read_counts[(receiver_id, sender_id)] = read_counts.get((receiver_id, sender_id), 0) + cursor.rowcount
+
+                    if read_counts:
+                        self.executemany(cursor, '''
+                            UPDATE inbox SET unread_count = CASE WHEN unread_count > %s THEN unread_count - %s ELSE 0 END
+                            WHERE user_id = %s AND peer_id = %s
+                        ''', [(count, count, id_bytes(receiver_id), id_bytes(sender_id))
+                              for (receiver_id, sender_id), count in sorted(read_counts.items())])
+
+                    connection.commit()
+                    cursor.close()
+                    return delivered_changes, read_changes, mark_changes
+                except self.Error as e:
+                    print(f"Error applying acks: {e}")
+                    return None
+
+        return None
+
+    def stats(self):
+        return self.pool.stats()
+
+    def close(self):
+        self.pool.close()
+
+class MySQLStorage(SQLStorage):
+    # Assignments run left to right and see earlier ones, so last_sent_at goes last
+    INBOX_UPSERT = '''
+        INSERT INTO inbox (user_id, peer_id, unread_count, last_message_id, last_sender_id, last_preview, last_sent_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            unread_count = unread_count + VALUES(unread_count),
+            last_message_id = IF(VALUES(last_sent_at) >= last_sent_at, VALUES(last_message_id), last_message_id),
+            last_sender_id = IF(VALUES(last_sent_at) >= last_sent_at, VALUES(last_sender_id), last_sender_id),
+            last_preview = IF(VALUES(last_sent_at) >= last_sent_at, VALUES(last_preview), last_preview),
+            last_sent_at = GREATEST(VALUES(last_sent_at), last_sent_at)
+    '''
+
+    SEQUENCE_UPSERT = '''
+        INSERT INTO conversations (id, last_seq) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE last_seq = last_seq + VALUES(last_seq)
+    '''
+
+    SEARCH_INSERT = "INSERT IGNORE INTO search_terms (user_id, term, message_id) VALUES (%s, %s, %s)"
+
+    # required_indexes: {table: [(index name, leading columns)]} the hot queries depend on
+    def __init__(self, config, required_indexes=None, migrate_indexes=True,
+                 pool_size=32, pool_timeout=5, health_check_idle=30):
+        if mysql is None:
+            raise RuntimeError("The mysql backend needs mysql-connector-python (pip install mysql-connector-python)")
+        self.config = config
+        self.required_indexes = required_indexes or {}
+        self.migrate_indexes_on_setup = migrate_indexes
+        self.Error = mysql.connector.Error
+        self.IntegrityError = mysql.connector.IntegrityError
+        super().__init__(ConnectionPool(self.create_connection, pool_size, pool_timeout,
+                                        health_check_idle, ping=self.ping))
+
+    def create_connection(self):
+        try:
+            return mysql.connector.connect(**self.config)
+        except self.Error as e:
+            print(f"Database connection error: {e}")
+            return None
+
+    def ping(self, connection):
+        connection.ping(reconnect=True, attempts=1, delay=0)
+
+    def cursor(self, connection):
+        return connection.cursor(dictionary=True)
+
+    # Find required indexes with no existing index covering the same leading columns
+    def find_missing_indexes(self, cursor):
+        missing = []
+        for table, indexes in self.required_indexes.items():
+            cursor.execute('''
+                SELECT index_name, column_name
+                FROM information_schema.statistics
+                WHERE table_schema = DATABASE() AND table_name = %s
+                ORDER BY index_name, seq_in_index
+            ''', (table,))
+
+            existing = {}
+            for index_name, column_name in cursor.fetchall():
+                existing.setdefault(index_name, []).append(column_name.lower())
+
+            for index_name, columns in indexes:
+                covered = any(tuple(cols[:len(columns)]) == columns for cols in existing.values())
+                if not covered:
+                    missing.append((table, index_name, columns))
+
+        return missing
+
+    # Add any missing required indexes without blocking reads and writes
+    def migrate_indexes(self, cursor):
+        for table, index_name, columns in self.find_missing_indexes(cursor):
+            print(f"Adding index {index_name} on {table} ({', '.join(columns)})...")
+            try:
+                cursor.execute(
+                    f"ALTER TABLE {table} ADD INDEX {index_name} ({', '.join(columns)}), "
+                    "ALGORITHM=INPLACE, LOCK=NONE"
+                )
+            except self.Error as e:
+                print(f"Error adding index {index_name}: {e}")
+
+    # Report required indexes that are still missing
+    def check_indexes(self, cursor):
+        try:
+            missing = self.find_missing_indexes(cursor)
+        except self.Error as e:
+            print(f"Error checking indexes: {e}")
+            return False
+
+        for table, index_name, columns in missing:
+            print(f"WARNING: missing index {index_name} on {table} ({', '.join(columns)}); "
+                  "queries on this table will scan")
+        return not missing
+
+    # Ids are BINARY(16): time-ordered ids append to the clustered index, and every
+    # secondary index entry carries 16 bytes of primary key instead of 36.
+    # conversation_id and seq are only NULL until backfill_sequences() has run.
+    def table_definitions(self, suffix=''):
+        return [f'''
+        CREATE TABLE IF NOT EXISTS users{suffix} (
+            id BINARY(16) PRIMARY KEY,
+            username VARCHAR(50) UNIQUE NOT NULL,
+            password VARCHAR(255) NOT NULL,
+            display_name VARCHAR(50),
+            last_seen DATETIME,
+            status ENUM('online', 'offline') DEFAULT 'offline',
+            profile_pic VARCHAR(255) DEFAULT 'default.png',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''', f'''
+        CREATE TABLE IF NOT EXISTS messages{suffix} (
+            id BINARY(16) PRIMARY KEY,
+            sender_id BINARY(16) NOT NULL,
+            receiver_id BINARY(16) NOT NULL,
+            message TEXT NOT NULL,
+            sent_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            read_status BOOLEAN DEFAULT FALSE,
+            delivered BOOLEAN NOT NULL DEFAULT FALSE,
+            conversation_id BINARY(16),
+            seq BIGINT,
+            UNIQUE INDEX idx_messages_sequence (conversation_id, seq),
+            INDEX idx_messages_conversation (sender_id, receiver_id, sent_at),
+            INDEX idx_messages_undelivered (receiver_id, delivered, sent_at),
+            FOREIGN KEY (sender_id) REFERENCES users{suffix}(id),
+            FOREIGN KEY (receiver_id) REFERENCES users{suffix}(id)
+        )
+        ''', f'''
+        CREATE TABLE IF NOT EXISTS inbox{suffix} (
+            user_id BINARY(16) NOT NULL,
+            peer_id BINARY(16) NOT NULL,
+            unread_count INT NOT NULL DEFAULT 0,
+            last_message_id BINARY(16),
+            last_sender_id BINARY(16),
+            last_preview VARCHAR(255),
+            last_sent_at DATETIME,
+            PRIMARY KEY (user_id, peer_id)
+        )
+        ''', f'''
+        CREATE TABLE IF NOT EXISTS conversations{suffix} (
+            id BINARY(16) PRIMARY KEY,
+            last_seq BIGINT NOT NULL DEFAULT 0,
+            indexed_seq BIGINT NOT NULL DEFAULT 0
+        )
+        ''', f'''
+        CREATE TABLE IF NOT EXISTS search_terms{suffix} (
+            user_id BINARY(16) NOT NULL,
+            term VARCHAR(64) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+            message_id BINARY(16) NOT NULL,
+            PRIMARY KEY (user_id, term, message_id)
+        )
+        ''']
+
+    def has_text_ids(self, cursor):
+        cursor.execute('''
+            SELECT data_type FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = 'users' AND column_name = 'id'
+        ''')
+        row = cursor.fetchone()
+        return bool(row) and row[0].lower() == 'varchar'
+
+    def id_from_text_sql(self, column):
+        return f"UNHEX(REPLACE({column}, '-', ''))"
+
+    # One atomic RENAME; the old tables stay as *_text until dropped by hand
+    def swap_tables(self, cursor, suffix):
+        cursor.execute(
+            "RENAME TABLE " + ', '.join(f"{table} TO {table}_text, {table}{suffix} TO {table}"
+                                         for table in ('users', 'messages', 'inbox', 'conversations', 'search_terms'))
+        )
+        print("Old tables kept as users_text, messages_text, inbox_text, conversations_text and "
+              "search_terms_text; drop them once the server runs fine")
+
+    def setup(self):
+        connection = self.create_connection()
+        if not connection:
+            return False
+
+        cursor = connection.cursor()
+
+        # Users, messages, the inbox: unread count and last message per (user, peer),
+        # so the inbox is one primary key range instead of a scan, the last sequence
+        # number handed out in each conversation, and the search index: who can find
+        # which message by which word. Binary collation, so words that differ only
+        # in accents stay apart as they do in Python.
+        for statement in self.table_definitions():
+            cursor.execute(statement)
+        connection.commit()
+
+        # Tables created before delivery tracking get the column, already-read
+        # messages counting as delivered
+        cursor.execute('''
+            SELECT COUNT(*) FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = 'messages' AND column_name = 'delivered'
+        ''')
+        if not cursor.fetchone()[0]:
+            print("Adding column delivered to messages...")
+            cursor.execute("ALTER TABLE messages ADD COLUMN delivered BOOLEAN NOT NULL DEFAULT FALSE")
+            cursor.execute("UPDATE messages SET delivered = TRUE WHERE read_status = TRUE")
+            connection.commit()
+
+        # Tables created before sequence numbers get the columns, filled in below
+        cursor.execute('''
+            SELECT COUNT(*) FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = 'messages' AND column_name = 'seq'
+        ''')
+        if not cursor.fetchone()[0]:
+            print("Adding columns conversation_id and seq to messages...")
+            cursor.execute('''
+                ALTER TABLE messages ADD COLUMN conversation_id BINARY(16), ADD COLUMN seq BIGINT,
+                ADD UNIQUE INDEX idx_messages_sequence (conversation_id, seq)
+            ''')
+
+        # Databases from before binary ids are rebuilt with them
+        if self.has_text_ids(cursor):
+            self.migrate_ids(connection)
+        self.backfill_sequences(connection)
+
+        # Conversations from before search was indexed outside the message transaction
+        # get the column. An index that exists was written with the messages, so it is
+        # complete; an empty one is filled in by backfill_search().
+        cursor.execute('''
+            SELECT COUNT(*) FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = 'conversations' AND column_name = 'indexed_seq'
+        ''')
+        if not cursor.fetchone()[0]:
+            print("Adding column indexed_seq to conversations...")
+            cursor.execute("ALTER TABLE conversations ADD COLUMN indexed_seq BIGINT NOT NULL DEFAULT 0")
+            cursor.execute("SELECT COUNT(*) FROM (SELECT 1 FROM search_terms LIMIT 1) AS indexed")
+            if cursor.fetchone()[0]:
+                cursor.execute("UPDATE conversations SET indexed_seq = last_seq")
+            connection.commit()
+
+        # Tables created before the indexes existed need them added
+        if self.migrate_indexes_on_setup:
+            self.migrate_indexes(cursor)
+        self.check_indexes(cursor)
+        cursor.close()
+
+        self.backfill_inbox(connection)
+        self.backfill_search(connection)
+        connection.close()
+        return True
+
+# One database file in WAL mode: readers never block the writer or each other, and
+# the group commit makes writes cheap. Usernames compare case-insensitively, as
+# they do under MySQL's default collation.
+class SQLiteStorage(SQLStorage):
+    Error = sqlite3.Error
+    IntegrityError = sqlite3.IntegrityError
+
+    # Milliseconds a connection waits for the write lock before failing
+    BUSY_TIMEOUT = 5000
+
+    INBOX_UPSERT = '''
+        INSERT INTO inbox (user_id, peer_id, unread_count, last_message_id, last_sender_id, last_preview, last_sent_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (user_id, peer_id) DO UPDATE SET
+            unread_count = unread_count + excluded.unread_count,
+            last_message_id = CASE WHEN excluded.last_sent_at >= last_sent_at
+                                   THEN excluded.last_message_id ELSE last_message_id END,
+            last_sender_id = CASE WHEN excluded.last_sent_at >= last_sent_at
+                                  THEN excluded.last_sender_id ELSE last_sender_id END,
+            last_preview = CASE WHEN excluded.last_sent_at >= last_sent_at
+                                THEN excluded.last_preview ELSE last_preview END,
+            last_sent_at = MAX(excluded.last_sent_at, last_sent_at)
+    '''
+
+    SEQUENCE_UPSERT = '''
+        INSERT INTO conversations (id, last_seq) VALUES (%s, %s)
+        ON CONFLICT (id) DO UPDATE SET last_seq = last_seq + excluded.last_seq
+    '''
+
+    SEARCH_INSERT = "INSERT OR IGNORE INTO search_terms (user_id, term, message_id) VALUES (%s, %s, %s)"
+
+    def __init__(self, path, pool_size=8, pool_timeout=5):
+        self.path = path
+        super().__init__(ConnectionPool(self.create_connection, pool_size, pool_timeout))
+
+    def create_connection(self):
+        try:
+            # Pooled connections move between threads, but only one uses them at a time
+            connection = sqlite3.connect(self.path, timeout=self.BUSY_TIMEOUT / 1000, check_same_thread=False)
+            connection.row_factory = lambda cursor, row: {column[0]: value for column, value in zip(cursor.description, row)}
+            connection.execute(f"PRAGMA busy_timeout = {self.BUSY_TIMEOUT}")
+            connection.execute("PRAGMA foreign_keys = ON")
+            # In WAL mode NORMAL only syncs at checkpoints; a crash can lose the last
+            # commits but never corrupts the file
+            connection.execute("PRAGMA synchronous = NORMAL")
+            return connection
+        except sqlite3.Error as e:
+            print(f"Database connection error: {e}")
+            return None
+
+    def cursor(self, connection):
+        return connection.cursor()
+
+    def execute(self, cursor, sql, params=()):
+        cursor.execute(sql.replace('%s', '?'), params)
+
+    def executemany(self, cursor, sql, rows):
+        cursor.executemany(sql.replace('%s', '?'), rows)
+
+    # Stored as text that sorts in time order
+    def db_time(self, value):
+        return value.isoformat(' ')
+
+    # Ids are 16-byte blobs, which compare in the same order as their strings.
+    # conversation_id and seq are only NULL until backfill_sequences() has run.
+    def table_definitions(self, suffix=''):
+        return [f'''
+            CREATE TABLE IF NOT EXISTS users{suffix} (
+                id BLOB PRIMARY KEY,
+                username TEXT UNIQUE NOT NULL COLLATE NOCASE,
+                password TEXT NOT NULL,
+                display_name TEXT,
+                last_seen DATETIME,
+                status TEXT DEFAULT 'offline' CHECK (status IN ('online', 'offline')),
+                profile_pic TEXT DEFAULT 'default.png',
+                created_at DATETIME DEFAULT (datetime('now', 'localtime'))
+            )
+            ''', f'''
+            CREATE TABLE IF NOT EXISTS messages{suffix} (
+                id BLOB PRIMARY KEY,
+                sender_id BLOB NOT NULL REFERENCES users{suffix}(id),
+                receiver_id BLOB NOT NULL REFERENCES users{suffix}(id),
+                message TEXT NOT NULL,
+                sent_at DATETIME DEFAULT (datetime('now', 'localtime')),
+                read_status BOOLEAN DEFAULT FALSE,
+                delivered BOOLEAN NOT NULL DEFAULT FALSE,
+                conversation_id BLOB,
+                seq INTEGER
+            )
+            ''', f'''
+            CREATE TABLE IF NOT EXISTS inbox{suffix} (
+                user_id BLOB NOT NULL,
+                peer_id BLOB NOT NULL,
+                unread_count INTEGER NOT NULL DEFAULT 0,
+                last_message_id BLOB,
+                last_sender_id BLOB,
+                last_preview TEXT,
+                last_sent_at DATETIME,
+                PRIMARY KEY (user_id, peer_id)
+            ) WITHOUT ROWID
+            ''', f'''
+            CREATE TABLE IF NOT EXISTS conversations{suffix} (
+                id BLOB PRIMARY KEY,
+                last_seq INTEGER NOT NULL DEFAULT 0,
+                indexed_seq INTEGER NOT NULL DEFAULT 0
+            ) WITHOUT ROWID
+            ''', f'''
+            CREATE TABLE IF NOT EXISTS search_terms{suffix} (
+                user_id BLOB NOT NULL,
+                term TEXT NOT NULL,
+                message_id BLOB NOT NULL,
+                PRIMARY KEY (user_id, term, message_id)
+            ) WITHOUT ROWID
+            ''']
+
+    def has_text_ids(self, cursor):
+        cursor.execute("PRAGMA table_info(users)")
+        return any(row['name'] == 'id' and row['type'].upper() == 'TEXT' for row in cursor.fetchall())
+
+    # Registered on the connection by setup() before migrating
+    def id_from_text_sql(self, column):
+        return f"id_bytes({column})"
+
+    def begin(self, cursor):
+        cursor.execute("BEGIN")
+
+    # Inside the migration's transaction: the old tables go, the new ones take their
+    # names (references to users_binary follow the rename)
+    def swap_tables(self, cursor, suffix):
+        for table in ('search_terms', 'conversations', 'inbox', 'messages', 'users'):
+            cursor.execute(f"DROP TABLE {table}")
+        for table in ('users', 'messages', 'inbox', 'conversations', 'search_terms'):
+            cursor.execute(f"ALTER TABLE {table}{suffix} RENAME TO {table}")
+
+    def setup(self):
+        connection = self.create_connection()
+        if not connection:
+            return False
+
+        try:
+            mode = connection.execute("PRAGMA journal_mode = WAL").fetchone()['journal_mode']
+            if mode != 'wal':
+                print(f"WARNING: SQLite database {self.path} is in {mode} journal mode, not WAL")
+
+            for statement in self.table_definitions():
+                connection.execute(statement)
+
+            # Databases created before delivery tracking get the column
+            columns = [row['name'] for row in connection.execute("PRAGMA table_info(messages)")]
+            if 'delivered' not in columns:
+                print("Adding column delivered to messages...")
+                connection.execute("ALTER TABLE messages ADD COLUMN delivered BOOLEAN NOT NULL DEFAULT FALSE")
+                connection.execute("UPDATE messages SET delivered = TRUE WHERE read_status = TRUE")
+            # And before sequence numbers, the columns, filled in below
+            if 'seq' not in columns:
+                print("Adding columns conversation_id and seq to messages...")
+                connection.execute("ALTER TABLE messages ADD COLUMN conversation_id BLOB")
+                connection.execute("ALTER TABLE messages ADD COLUMN seq INTEGER")
+            connection.commit()
+
+            # Databases from before binary ids are rebuilt with them
+            if self.has_text_ids(connection.cursor()):
+                connection.create_function('id_bytes', 1, id_bytes, deterministic=True)
+                self.migrate_ids(connection)
+            self.backfill_sequences(connection)
+
+            # And before search was indexed outside the message transaction, the
+            # column; an index that exists was written with the messages
+            columns = [row['name'] for row in connection.execute("PRAGMA table_info(conversations)")]
+            if 'indexed_seq' not in columns:
+                print("Adding column indexed_seq to conversations...")
+                connection.execute("ALTER TABLE conversations ADD COLUMN indexed_seq INTEGER NOT NULL DEFAULT 0")
+                if connection.execute("SELECT 1 FROM search_terms LIMIT 1").fetchone():
+                    connection.execute("UPDATE conversations SET indexed_seq = last_seq")
+                connection.commit()
+
+            # After the rebuild: index names are global, the new tables could not
+            # take them while the old ones existed
+            connection.executescript('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_sequence ON messages (conversation_id, seq);
+            CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (sender_id, receiver_id, sent_at);
+            CREATE INDEX IF NOT EXISTS idx_messages_undelivered ON messages (receiver_id, delivered, sent_at);
+            ''')
+            connection.commit()
+            self.backfill_inbox(connection)
+            self.backfill_search(connection)
+            return True
+        except sqlite3.Error as e:
+            print(f"Error setting up SQLite database {self.path}: {e}")
+            return False
+        finally:
+            connection.close()
+
+# Everything in dicts under one lock. Conversations list their message ids in seq
+# order, so a message's seq is its place in the list and history pages are a slice.
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}  # {id: user row}
+        self.by_name = {}  # {lowercased username: id}
+        self.messages = {}  # {id: message}
+        self.conversations = {}  # {conversation id: [message ids, seq 1 first]}
+        self.unread = {}  # {receiver id: set of message ids}
+        self.undelivered = {}  # {receiver id: set of message ids}
+        self.inbox = {}  # {user id: {peer id: inbox entry}}
+        self.search = {}  # {user id: {term: message ids, oldest first}}
+        self.indexed = set()  # ids of the messages in self.search
+
+    def setup(self):
+        return True
+
+    def public_user(self, user):
+        return {field: user[field] for field in ('id', 'username', 'display_name', 'status', 'last_seen', 'profile_pic')}
+
+    def with_sender(self, message, *fields):
+        sender = self.users[message['sender_id']]
+        result = {field: message[field] for field in ('id', 'message', 'sender_id') + fields}
+        result['sent_at'] = iso_time(message['sent_at'])
+        result['sender_username'] = sender['username']
+        result['sender_display_name'] = sender['display_name']
+        return result
+
+    def history_message(self, message):
+        result = self.with_sender(message, 'receiver_id', 'seq')
+        result['status'] = message_status(message['delivered'], message['read_status'])
+        return result
+
+    def authenticate_user(self, username, password_hash):
+        with self.lock:
+            user = self.users.get(self.by_name.get((username or '').lower()))
+            if user and user['password'] == password_hash:
+                return dict(user)
+        return None
+
+    def register_user(self, user_id, username, password_hash, display_name):
+        with self.lock:
+            if username.lower() in self.by_name:
+                print(f"Error registering user: username {username!r} is taken")
+                return False
+            self.users[user_id] = {
+                'id': user_id,
+                'username': username,
+                'password': password_hash,
+                'display_name': display_name,
+                'last_seen': None,
+                'status': 'offline',
+                'profile_pic': 'default.png',
+                'created_at': now().isoformat()
+            }
+            self.by_name[username.lower()] = user_id
+        return True
+
+    def update_user_status(self, user_id, status, last_seen=None):
+        with self.lock:
+            user = self.users.get(user_id)
+            if user:
+                user['status'] = status
+                user['last_seen'] = (last_seen or now()).isoformat()
+        return True
+
+    def get_all_users(self):
+        with self.lock:
+            return [self.public_user(user) for user in self.users.values()]
+
+    def update_username(self, user_id, new_username):
+        with self.lock:
+            owner = self.by_name.get(new_username.lower())
+            if owner is not None and owner != user_id:
+                return False, 'Username is already taken'
+            user = self.users.get(user_id)
+            if user:
+                del self.by_name[user['username'].lower()]
+                user['username'] = new_username
+                self.by_name[new_username.lower()] = user_id
+        return True, 'Username updated'
+
+    def set_profile_pic(self, user_id, avatar_hash):
+        with self.lock:
+            user = self.users.get(user_id)
+            if user:
+                user['profile_pic'] = avatar_hash
+        return True
+
+    def insert_messages(self, messages):
+        with self.lock:
+            # All or nothing, like a failed INSERT
+            for message in messages:
+                if message['sender_id'] not in self.users or message['receiver_id'] not in self.users:
+                    print(f"Error storing {len(messages)} messages: unknown user in message {message['id']}")
+                    return False
+                if message['id'] in self.messages:
+                    print(f"Error storing {len(messages)} messages: duplicate id {message['id']}")
+                    return False
+                if not isinstance(message['message'], str):
+                    print(f"Error storing {len(messages)} messages: no text in message {message['id']}")
+                    return False
+
+            for (user_id, peer_id), (unread, last) in merge_inbox_updates({}, messages).items():
+                entry = self.inbox.setdefault(user_id, {}).setdefault(peer_id, {
+                    'user_id': peer_id, 'unread': 0, 'last_message_id': None, 'last_sender_id': None,
+                    'last_preview': None, 'last_sent_at': None
+                })
+                entry['unread'] += unread
+                if entry['last_sent_at'] is None or last['sent_at'] >= entry['last_sent_at']:
+                    entry.update(last_message_id=last['id'], last_sender_id=last['sender_id'],
+                                 last_preview=last['message'][:PREVIEW_LENGTH], last_sent_at=last['sent_at'])
+
+            for message in messages:
+                message['conversation_id'] = conversation_id(message['sender_id'], message['receiver_id'])
+                message_ids = self.conversations.setdefault(message['conversation_id'], [])
+                message_ids.append(message['id'])
+                message['seq'] = len(message_ids)
+                self.messages[message['id']] = dict(message, delivered=False, read_status=False)
+                self.unread.setdefault(message['receiver_id'], set()).add(message['id'])
+                self.undelivered.setdefault(message['receiver_id'], set()).add(message['id'])
+        return True
+
+    def index_messages(self, messages):
+        with self.lock:
+            messages = [message for message in messages if message['id'] not in self.indexed]
+            self.indexed.update(message['id'] for message in messages)
+            for user_id, term, message_id in search_rows(messages):
+                self.search.setdefault(user_id, {}).setdefault(term, []).append(message_id)
+        return True
+
+    def index_conversations(self, starts):
+        with self.lock:
+            messages = [self.messages[message_id] for key, seq in starts.items()
+                        for message_id in self.conversations.get(key, [])[seq - 1:]]
+        return self.index_messages(messages)
+
+    def get_chat_history(self, user1_id, user2_id):
+        with self.lock:
+            message_ids = self.conversations.get(conversation_id(user1_id, user2_id), [])
+            return [self.history_message(self.messages[message_id]) for message_id in message_ids]
+
+    def get_chat_history_page(self, user1_id, user2_id, before, limit):
+        with self.lock:
+            message_ids = self.conversations.get(conversation_id(user1_id, user2_id), [])
+            end = min(max(0, before - 1), len(message_ids)) if before else len(message_ids)
+            start = max(0, end - limit)
+            page = [self.history_message(self.messages[message_id]) for message_id in message_ids[start:end]]
+            return page, start > 0
+
+    def get_chat_history_since(self, user1_id, user2_id, after_seq, limit):
+        with self.lock:
+            message_ids = self.conversations.get(conversation_id(user1_id, user2_id), [])
+            start = max(0, after_seq)
+            page = [self.history_message(self.messages[message_id]) for message_id in message_ids[start:start + limit]]
+            return page, len(message_ids) > start + limit
+
+    def get_unread_counts(self, user_id):
+        with self.lock:
+            return {peer_id: entry['unread'] for peer_id, entry in self.inbox.get(user_id, {}).items()
+                    if entry['unread']}
+
+    def get_inbox(self, user_id):
+        with self.lock:
+            conversations = sorted(self.inbox.get(user_id, {}).values(),
+                                   key=lambda entry: entry['last_sent_at'], reverse=True)
+            return [dict(entry, last_sent_at=iso_time(entry['last_sent_at'])) for entry in conversations]
+
+    def search_messages(self, user_id, terms, after, limit):
+        with self.lock:
+            index = self.search.get(user_id, {})
+            matches = [index.get(term, [])[-SEARCH_MATCHES_PER_TERM:] for term in terms]
+            hits, has_more = rank_search_hits(matches, after, limit)
+            messages = [dict(self.history_message(self.messages[message_id]), score=score)
+                        for score, message_id in hits if message_id in self.messages]
+            return messages, hits[-1] if has_more and hits else None
+
+    def get_undelivered_messages_chunk(self, user_id, after, limit):
+        with self.lock:
+            positions = sorted((self.messages[message_id]['sent_at'], message_id)
+                               for message_id in self.undelivered.get(user_id, ()))
+            start = bisect.bisect_right(positions, after) if after else 0
+            return [self.with_sender(self.messages[message_id], 'seq') for _, message_id in positions[start:start + limit]]
+
+    def mark_delivered(self, message):
+        message['delivered'] = True
+        self.undelivered.get(message['receiver_id'], set()).discard(message['id'])
+
+    def mark_read(self, message):
+        self.mark_delivered(message)
+        message['read_status'] = True
+        self.unread.get(message['receiver_id'], set()).discard(message['id'])
+        entry = self.inbox[message['receiver_id']][message['sender_id']]
+        entry['unread'] = max(0, entry['unread'] - 1)
+
+    def apply_acks(self, delivered, read, read_marks):
+        delivered_changes = []
+        read_changes = []
+        mark_changes = []
+
+        with self.lock:
+            for receiver_id, message_ids in read.items():
+                for message_id in message_ids:
+                    message = self.messages.get(message_id)
+                    if message and message['receiver_id'] == receiver_id and not message['read_status']:
+                        self.mark_read(message)
+                        read_changes.append((message['sender_id'], receiver_id, message_id))
+
+            for receiver_id, message_ids in delivered.items():
+                for message_id in message_ids:
+                    message = self.messages.get(message_id)
+                    if message and message['receiver_id'] == receiver_id and not message['delivered']:
+                        self.mark_delivered(message)
+                        delivered_changes.append((message['sender_id'], receiver_id, message_id))
+
+            for (receiver_id, sender_id), position in read_marks.items():
+                changed = False
+                for message_id in list(self.unread.get(receiver_id, ())):
+                    message = self.messages[message_id]
+                    if message['sender_id'] == sender_id and (message['sent_at'], message_id) <= position:
+                        self.mark_read(message)
+                        changed = True
+                if changed:
+                    mark_changes.append((sender_id, receiver_id, position))
+
+        return delivered_changes, read_changes, mark_changes
@@ -2,12 +2,16 @@ import socket
 import threading
 import json
 import tkinter as tk
-from tkinter import ttk, messagebox, simpledialog
+from tkinter import ttk, messagebox, simpledialog, filedialog
 import customtkinter as ctk
 from PIL import Image, ImageTk
 import os
 import datetime
 import base64
+import hashlib
+import random
+from chat_protocol import (PROTOCOL_VERSION, SUPPORTED_FRAMINGS, SUPPORTED_COMPRESSION, AVATAR_SIZES,
+                           FrameDecoder, FrameEncoder, ProtocolError, as_bytes, encode_frame)
 
 # Color scheme
 THEME_COLORS = {
@@ -28,6 +32,43 @@ FONT_HEADER = ('Comic Sans MS', 14, 'bold')
 FONT_MESSAGE = ('Comic Sans MS', 10)
 FONT_TITLE = ('Comic Sans MS', 18, 'bold')
 
+# Messages fetched per chat history page
+HISTORY_PAGE_SIZE = 50
+
+# Results fetched per message search page
+SEARCH_PAGE_SIZE = 20
+
+# Random extra delay (ms) added to each reconnect attempt so clients don't all come back at once
+RECONNECT_JITTER_MS = 5000
+
+# Seconds to wait for the server to answer 'hello' before assuming an old newline-JSON server
+HELLO_TIMEOUT = 3
+
+# Heartbeat interval (seconds) to ask the server for. The server heartbeats idle
+# connections itself, so the client only probes after that interval plus the grace
+# period has passed in silence. Servers that can't negotiate get probed every
+# LEGACY_HEARTBEAT_TIMEOUT seconds as before.
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_GRACE = 15
+LEGACY_HEARTBEAT_TIMEOUT = 10
+
+# Avatars fetched from the server are cached here by hash; a hash's content never changes
+AVATAR_CACHE_DIR = 'avatar_cache'
+
+# Delivery and read acks are collected for this long (ms) and sent as one message
+ACK_FLUSH_MS = 250
+
+# Characters of a conversation's last message shown next to the contact's name
+CONTACT_PREVIEW_CHARS = 24
+
+# Shown after the time on your own messages
+STATUS_MARKS = {
+    'sent': '✓',
+    'delivered': '✓✓',
+    'read': '💗',
+    'failed': '⚠',
+}
+
 class KawaiiChatClient:
     def __init__(self, root):
         # Main window setup
@@ -53,12 +94,40 @@ class KawaiiChatClient:
         # Socket and connection
         self.socket = None
         self.connected = False
+        self.encoder = FrameEncoder()
+        self.decoder = FrameDecoder()
+        self.heartbeat_timeout = LEGACY_HEARTBEAT_TIMEOUT
+        # The Tk thread and the listener thread both send; frames must not interleave
+        self.send_lock = threading.Lock()
         self.current_user = None
+        self.session_token = None  # lets a reconnect resume the session instead of logging in again
+        self.connecting = False  # a connection is being opened in the background
+        self.offline_cursor = None  # position of the newest message received, for resume
         self.user_list = []
+        self.users_version = None  # directory version user_list came from
         self.current_chat_user = None
         
         # Initialize chat messages dict
         self.chat_messages = {}  # {user_id: [messages]}
+        self.history_cursors = {}  # {user_id: cursor for the next older page, None when fully loaded}
+        self.displayed_counts = {}  # {user_id: number of messages currently shown}
+        
+        # Acks waiting for the next flush, and the last read mark sent per chat
+        self.pending_acks = {'delivered': [], 'read_until': {}}
+        self.ack_flush_scheduled = False
+        self.read_marks = {}  # {user_id: cursor of the newest message from them we marked read}
+        self.inbox = {}  # {user_id: unread count and last message of our conversation}
+        
+        # Message search: the results window, what it lists, and the cursor of the next page
+        self.search_window = None
+        self.search_query = ''
+        self.search_hits = []
+        self.search_cursor = None
+        
+        # Avatars
+        self.avatar_images = {}  # {(hash, size): PhotoImage}, Tk needs the references kept alive
+        self.pending_avatars = set()  # (hash, size) already requested from the server
+        self.pending_upload = None  # image bytes waiting for avatar_upload_ready
         
         # Create server config button on login screen
         self.create_login_frame()
@@ -358,6 +427,8 @@ class KawaiiChatClient:
                                    font=FONT_MAIN)
         self.search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
         self.search_entry.bind("<KeyRelease>", self.filter_contacts)
+        # Enter searches message contents on the server
+        self.search_entry.bind("<Return>", self.search_messages)
         
         # Contacts list label
         contacts_label_frame = tk.Frame(self.contacts_frame, bg=THEME_COLORS['bg_sidebar'], padx=10)
@@ -392,6 +463,11 @@ class KawaiiChatClient:
                             font=FONT_HEADER, bg=THEME_COLORS['accent'], fg=THEME_COLORS['text_light'])
         user_label.pack(side=tk.LEFT, pady=5, padx=5)
 
+        avatar_button = tk.Button(user_info_frame, text="📷", font=FONT_MAIN,
+                                bg=THEME_COLORS['secondary'], fg=THEME_COLORS['text_dark'],
+                                command=self.choose_profile_pic)
+        avatar_button.pack(side=tk.RIGHT, pady=5, padx=5)
+
         # # Add profile button
         # profile_button = tk.Button(user_info_frame, text="✏️ Profile", font=FONT_MAIN, 
         #                         bg=THEME_COLORS['secondary'], fg=THEME_COLORS['text_dark'],
@@ -448,11 +524,35 @@ class KawaiiChatClient:
             status_indicator.create_oval(2, 2, 8, 8, fill=status_color, outline="")
             status_indicator.pack(side=tk.LEFT, padx=(0, 5))
             
-            # Display name
+            # Avatar thumbnail, drawn on a canvas so filter_contacts still finds the name label first
+            avatar = self.get_avatar_image(user.get('profile_pic'), 'contact')
+            if avatar:
+                pixels = AVATAR_SIZES['contact']
+                avatar_canvas = tk.Canvas(contact_frame, width=pixels, height=pixels, bg=THEME_COLORS['bg_sidebar'],
+                                        highlightthickness=0)
+                avatar_canvas.create_image(0, 0, image=avatar, anchor='nw')
+                avatar_canvas.pack(side=tk.LEFT, padx=(0, 5))
+                avatar_canvas.bind("<Button-1>", lambda e, u=user: self.select_chat_user(u))
+            
+            # Display name, then the last message and the unread count from the inbox
             display_name = user.get('display_name') or user['username']
             name_label = tk.Label(contact_frame, text=display_name, font=FONT_MAIN, bg=THEME_COLORS['bg_sidebar'],
                                 fg=THEME_COLORS['text_dark'], anchor='w')
-            name_label.pack(side=tk.LEFT, fill=tk.X, expand=True)
+            
+            conversation = self.inbox.get(user['id'], {})
+            if conversation.get('unread'):
+                unread_badge = tk.Label(contact_frame, text=f" {conversation['unread']} ", font=('Comic Sans MS', 8, 'bold'),
+                                      bg=THEME_COLORS['button'], fg=THEME_COLORS['text_light'])
+                unread_badge.pack(side=tk.RIGHT, padx=(5, 0))
+            
+            preview = conversation.get('last_preview') or ''
+            if len(preview) > CONTACT_PREVIEW_CHARS:
+                preview = preview[:CONTACT_PREVIEW_CHARS - 1] + '…'
+            name_label.pack(side=tk.LEFT)
+            preview_label = tk.Label(contact_frame, text=preview, font=('Comic Sans MS', 8), bg=THEME_COLORS['bg_sidebar'],
+                                   fg=THEME_COLORS['text_dark'], anchor='w')
+            preview_label.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(6, 0))
+            preview_label.bind("<Button-1>", lambda e, u=user: self.select_chat_user(u))
             
             # Make entire frame clickable
             contact_frame.bind("<Button-1>", lambda e, u=user: self.select_chat_user(u))
@@ -480,6 +580,131 @@ class KawaiiChatClient:
             name_label.bind("<Enter>", on_enter)
             name_label.bind("<Leave>", on_leave)
     
+    def get_avatar_image(self, avatar_hash, size):
+        """Thumbnail for an avatar hash, fetched from the server in the background if not cached"""
+        # Accounts that never uploaded one still carry the old 'default.png' placeholder
+        if not avatar_hash or len(avatar_hash) != 64:
+            return None
+            
+        key = (avatar_hash, size)
+        if key in self.avatar_images:
+            return self.avatar_images[key]
+            
+        path = os.path.join(AVATAR_CACHE_DIR, f"{avatar_hash}_{size}.png")
+        if os.path.exists(path):
+            try:
+                image = Image.open(path)
+                pixels = AVATAR_SIZES[size]
+                if image.size != (pixels, pixels):
+                    # Server without thumbnails sent the original
+                    image = image.resize((pixels, pixels))
+                self.avatar_images[key] = ImageTk.PhotoImage(image)
+                return self.avatar_images[key]
+            except Exception as e:
+                print(f"Could not load avatar {path}: {e}")
+                return None
+                
+        if key not in self.pending_avatars:
+            self.pending_avatars.add(key)
+            self.send_to_server({'type': 'get_avatar', 'hash': avatar_hash, 'size': size})
+        return None
+    
+    def store_avatar(self, message):
+        """Cache an avatar the server sent and redraw whatever shows it"""
+        avatar_hash = message.get('hash')
+        size = message.get('size')
+        if not message.get('success') or size not in AVATAR_SIZES:
+            return
+            
+        # Only the server's own hash names the file, never a path from elsewhere
+        if not avatar_hash or len(avatar_hash) != 64 or not all(c in '0123456789abcdef' for c in avatar_hash):
+            return
+            
+        try:
+            os.makedirs(AVATAR_CACHE_DIR, exist_ok=True)
+            with open(os.path.join(AVATAR_CACHE_DIR, f"{avatar_hash}_{size}.png"), 'wb') as f:
+                f.write(as_bytes(message.get('data')))
+        except (OSError, ValueError) as e:
+            print(f"Could not cache avatar: {e}")
+            return
+            
+        self.pending_avatars.discard((avatar_hash, size))
+        if hasattr(self, 'contacts_list_inner') and self.contacts_list_inner.winfo_exists():
+            self.update_contacts_list()
+            self.filter_contacts()
+        if (size == 'header' and self.current_chat_user
+                and self.current_chat_user.get('profile_pic') == avatar_hash):
+            avatar = self.get_avatar_image(avatar_hash, size)
+            if avatar:
+                self.show_header_avatar(avatar)
+
+    def show_header_avatar(self, avatar):
+        """Put an avatar next to the status dot in the chat header"""
+        indicator = getattr(self, 'chat_status_indicator', None)
+        if indicator is None or not indicator.winfo_exists():
+            return
+        tk.Label(indicator.master, image=avatar, bg=THEME_COLORS['accent']).pack(side=tk.LEFT, padx=(0, 8),
+                                                                                 after=indicator)
+
+    def choose_profile_pic(self):
+        """Pick an image file and upload it as our profile picture"""
+        path = filedialog.askopenfilename(title="Choose a profile picture",
+                                          filetypes=[("Images", "*.png *.jpg *.jpeg *.gif")])
+        if not path:
+            return
+            
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            messagebox.showerror("Profile Picture", f"Could not read image: {e}")
+            return
+            
+        # The server answers with avatar_upload_ready, or right away if it already has this image
+        self.pending_upload = data
+        self.send_to_server({
+            'type': 'avatar_upload_begin',
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'size': len(data)
+        })
+    
+    def send_avatar_chunks(self, data, chunk_size):
+        """Stream an accepted upload off the Tk thread, then ask the server to commit it"""
+        for offset in range(0, len(data), chunk_size):
+            if not self.send_to_server({'type': 'avatar_upload_chunk', 'offset': offset,
+                                        'data': data[offset:offset + chunk_size]}):
+                return
+        self.send_to_server({'type': 'avatar_upload_commit'})
+    
+    def apply_user_delta(self, user_id, changes):
+        """Patch one user in user_list in place from a presence/profile delta"""
+        user = next((u for u in self.user_list if u['id'] == user_id), None)
+        
+        if user is None:
+            # Someone we haven't seen yet (registered after our login), fetch the directory once
+            self.request_users_list()
+            return
+            
+        user.update(changes)
+        
+        if self.current_user and user_id == self.current_user['id']:
+            self.current_user.update({k: v for k, v in changes.items() if k in self.current_user})
+            
+        self.refresh_contacts_list()
+    
+    def refresh_contacts_list(self):
+        """Redraw the sidebar, keeping the current search filter"""
+        if hasattr(self, 'contacts_list_inner') and self.contacts_list_inner.winfo_exists():
+            self.update_contacts_list()
+            self.filter_contacts()
+    
+    def update_inbox(self, user_id, content, timestamp, unread=0):
+        """Move a conversation's last message forward and add to its unread count"""
+        conversation = self.inbox.setdefault(user_id, {'user_id': user_id, 'unread': 0})
+        conversation.update(last_preview=content, last_sent_at=timestamp)
+        conversation['unread'] += unread
+        self.refresh_contacts_list()
+    
     def filter_contacts(self, event=None):
         if not hasattr(self, 'contacts_list_inner'):
             return  # Exit if the attribute doesn't exist yet
@@ -500,6 +725,62 @@ class KawaiiChatClient:
                 widget.pack(fill=tk.X, pady=2)
 
     
+    def search_messages(self, event=None, cursor=None):
+        """Search our conversations for the words in the search box, or fetch the next page"""
+        if not cursor:
+            self.search_query = self.search_entry.get().strip()
+        if not self.search_query:
+            return
+        request = {'type': 'search_messages', 'query': self.search_query, 'limit': SEARCH_PAGE_SIZE}
+        if cursor:
+            request['cursor'] = cursor
+        self.send_to_server(request)
+    
+    def show_search_results(self, message):
+        """List search results, best first; double-click one to open its chat"""
+        window_open = self.search_window is not None and self.search_window.winfo_exists()
+        if not (message.get('cursor') and window_open):
+            if window_open:
+                self.search_window.destroy()
+            self.search_window = tk.Toplevel(self.root)
+            self.search_window.title(f"Search: {message.get('query', '')}")
+            self.search_window.geometry("420x360")
+            self.search_window.configure(bg=THEME_COLORS['bg_main'])
+            self.search_window.transient(self.root)
+            
+            self.search_list = tk.Listbox(self.search_window, font=FONT_MAIN, bg=THEME_COLORS['input_bg'],
+                                          fg=THEME_COLORS['text_dark'], activestyle='none')
+            self.search_list.pack(fill=tk.BOTH, expand=True, padx=10, pady=(10, 5))
+            self.search_list.bind("<Double-Button-1>", self.open_search_result)
+            
+            self.search_more_btn = tk.Button(self.search_window, text="More results...", font=FONT_MAIN,
+                                             bg=THEME_COLORS['secondary'],
+                                             command=lambda: self.search_messages(cursor=self.search_cursor))
+            self.search_hits = []
+        
+        for msg in message.get('messages', []):
+            self.search_hits.append(msg)
+            sender = msg.get('sender_display_name') or msg.get('sender_username')
+            self.search_list.insert(tk.END, f"{sender}: {msg['message'][:60]}  ({self.format_timestamp(msg['sent_at'])})")
+        if not self.search_hits:
+            self.search_list.insert(tk.END, "No messages found")
+        
+        self.search_cursor = message.get('next_cursor')
+        if self.search_cursor:
+            self.search_more_btn.pack(pady=(0, 10))
+        else:
+            self.search_more_btn.pack_forget()
+    
+    def open_search_result(self, event=None):
+        selection = self.search_list.curselection()
+        if not selection or selection[0] >= len(self.search_hits):
+            return
+        msg = self.search_hits[selection[0]]
+        peer_id = msg['receiver_id'] if msg['sender_id'] == self.current_user['id'] else msg['sender_id']
+        user = next((u for u in self.user_list if u['id'] == peer_id), None)
+        if user:
+            self.select_chat_user(user)
+    
     def setup_empty_chat_area(self):
         # Header frame
         self.chat_header = tk.Frame(self.chat_frame, bg=THEME_COLORS['accent'], height=60)
@@ -545,6 +826,12 @@ class KawaiiChatClient:
                                   highlightthickness=0)
         status_indicator.create_oval(2, 2, 10, 10, fill=status_color, outline="")
         status_indicator.pack(side=tk.LEFT, padx=(0, 8))
+        self.chat_status_indicator = status_indicator
+
+        # Avatar, or added by show_header_avatar once it has been fetched
+        avatar = self.get_avatar_image(user.get('profile_pic'), 'header')
+        if avatar:
+            self.show_header_avatar(avatar)
         
         # User name
         tk.Label(header_content, text=user['display_name'], font=FONT_HEADER,
@@ -671,7 +958,7 @@ class KawaiiChatClient:
             frame.bind("<Button-4>", _on_mousewheel_linux_up)
             frame.bind("<Button-5>", _on_mousewheel_linux_down)
         
-    def display_messages(self, user_id):
+    def display_messages(self, user_id, count=None):
         # Clear previous messages
         for widget in self.messages_frame.winfo_children():
             widget.destroy()
@@ -682,8 +969,9 @@ class KawaiiChatClient:
             
         # Get messages, limit to most recent MAX_MESSAGES if there are too many
         MAX_MESSAGES = 50  
+        count = count or MAX_MESSAGES
         messages = self.chat_messages[user_id]
-        if len(messages) > MAX_MESSAGES:
+        if len(messages) > count or self.history_cursors.get(user_id):
             # Add a "load more" button at the top
             load_more_frame = tk.Frame(self.messages_frame, bg=THEME_COLORS['bg_main'])
             load_more_frame.pack(fill=tk.X, pady=5)
@@ -694,30 +982,32 @@ class KawaiiChatClient:
             load_more_btn.pack(pady=5)
             
             # Display only the most recent messages
-            messages_to_display = messages[-MAX_MESSAGES:]
+            messages_to_display = messages[-count:]
         else:
             messages_to_display = messages
+        
+        self.displayed_counts[user_id] = len(messages_to_display)
                 
         # Display messages
         for msg in messages_to_display:
             self.display_message(msg)
         
     def load_more_messages(self, user_id):
-        current_count = len(self.messages_frame.winfo_children())
+        current_count = self.displayed_counts.get(user_id, 0)
         # Load another batch (e.g. 50 more messages)
         batch_size = 50
-        start_idx = max(0, len(self.chat_messages[user_id]) - current_count - batch_size)
-        end_idx = len(self.chat_messages[user_id]) - current_count
-        
-        # Clear existing messages
-        for widget in self.messages_frame.winfo_children():
-            widget.destroy()
-            
-        # Display older messages + current messages
-        messages_to_display = self.chat_messages[user_id][start_idx:]
         
-        for msg in messages_to_display:
-            self.display_message(msg)
+        if len(self.chat_messages[user_id]) > current_count:
+            # Older messages are already loaded locally
+            self.display_messages(user_id, current_count + batch_size)
+        elif self.history_cursors.get(user_id):
+            # Fetch the next older page from the server
+            self.send_to_server({
+                'type': 'get_chat_history',
+                'user_id': user_id,
+                'before': self.history_cursors[user_id],
+                'limit': HISTORY_PAGE_SIZE
+            })
     
     def display_message(self, msg):
         # Determine if this is sent or received message
@@ -745,16 +1035,87 @@ class KawaiiChatClient:
                           justify=tk.LEFT, wraplength=400)
         msg_text.pack(anchor='e' if is_sent else 'w')
         
-        # Timestamp
-        time_str = self.format_timestamp(msg['timestamp'])
-        time_label = tk.Label(bubble, text=time_str, font=('Comic Sans MS', 7), bg=bubble_bg,
+        # Timestamp, with the delivery status on our own messages
+        time_label = tk.Label(bubble, text=self.format_message_time(msg), font=('Comic Sans MS', 7), bg=bubble_bg,
                            fg=bubble_fg)
         time_label.pack(anchor='e', pady=(3, 0))
+        if is_sent:
+            # Kept so receipts can update the status in place
+            msg['time_label'] = time_label
         
         if not is_sent:
             spacer = tk.Frame(message_frame, width=100, bg=THEME_COLORS['bg_main'])
             spacer.pack(side=tk.RIGHT, fill=tk.X, expand=True)
     
+    def format_message_time(self, msg):
+        time_str = self.format_timestamp(msg['timestamp'])
+        if msg['sender_id'] == self.current_user['id'] and msg.get('status'):
+            time_str += ' ' + STATUS_MARKS.get(msg['status'], '')
+        return time_str
+    
+    def set_message_status(self, msg, status):
+        """Update a sent message's status, never moving it backwards"""
+        order = ['sent', 'delivered', 'read']
+        if msg.get('status') in order and status in order and order.index(status) <= order.index(msg['status']):
+            return
+        msg['status'] = status
+        label = msg.get('time_label')
+        if label is not None and label.winfo_exists():
+            label.config(text=self.format_message_time(msg))
+    
+    def apply_receipt(self, message):
+        """Mark our messages to a user delivered or read"""
+        status = message.get('status')
+        ids = set(message.get('ids') or [])
+        until = self.cursor_position(message.get('until'))
+        for msg in self.chat_messages.get(message.get('user_id'), []):
+            if msg['sender_id'] != self.current_user['id'] or not msg.get('id'):
+                continue
+            if msg['id'] in ids or (until and self.cursor_position(f"{msg['timestamp']}|{msg['id']}") <= until):
+                self.set_message_status(msg, status)
+    
+    def cursor_position(self, cursor):
+        """(time, id) of a 'time|id' cursor, comparable between messages"""
+        try:
+            timestamp, message_id = cursor.split('|', 1)
+            return datetime.datetime.fromisoformat(timestamp), message_id
+        except (AttributeError, ValueError):
+            return None
+    
+    def queue_ack(self, delivered=None, read_until=None):
+        """Collect acks and send them together a moment later"""
+        self.pending_acks['delivered'].extend(delivered or [])
+        self.pending_acks['read_until'].update(read_until or {})
+        if not self.ack_flush_scheduled:
+            self.ack_flush_scheduled = True
+            self.root.after(ACK_FLUSH_MS, self.flush_acks)
+    
+    def flush_acks(self):
+        """Send the collected delivery and read acks in one message"""
+        self.ack_flush_scheduled = False
+        acks, self.pending_acks = self.pending_acks, {'delivered': [], 'read_until': {}}
+        if not acks['delivered'] and not acks['read_until']:
+            return
+        if not self.send_to_server({'type': 'ack', 'delivered': acks['delivered'], 'read_until': acks['read_until']}):
+            # Keep them for the next flush after reconnecting
+            self.pending_acks['delivered'][:0] = acks['delivered']
+            self.pending_acks['read_until'] = dict(acks['read_until'], **self.pending_acks['read_until'])
+    
+    def mark_chat_read(self, user_id):
+        """Tell the server we've seen everything this user sent us so far"""
+        if self.inbox.get(user_id, {}).get('unread'):
+            self.inbox[user_id]['unread'] = 0
+            self.refresh_contacts_list()
+        
+        newest = next((m for m in reversed(self.chat_messages.get(user_id, []))
+                       if m['sender_id'] == user_id and m.get('id')), None)
+        if newest is None:
+            return
+        cursor = f"{newest['timestamp']}|{newest['id']}"
+        if self.read_marks.get(user_id) != cursor:
+            self.read_marks[user_id] = cursor
+            self.queue_ack(read_until={user_id: cursor})
+    
     def format_timestamp(self, timestamp):
         if isinstance(timestamp, str):
             try:
@@ -780,13 +1141,40 @@ class KawaiiChatClient:
         self.messages_canvas.update_idletasks()
         self.messages_canvas.yview_moveto(1.0)
     
+    def synced_seq(self, user_id):
+        """Newest seq up to which we hold this chat's history without gaps, or None"""
+        seqs = sorted(m['seq'] for m in self.chat_messages.get(user_id, []) if m.get('seq'))
+        # Pushed messages alone don't count until a history page was loaded
+        if not seqs or user_id not in self.history_cursors:
+            return None
+        synced = seqs[0]
+        for seq in seqs[1:]:
+            if seq > synced + 1:
+                break
+            synced = seq
+        return synced
+    
     def select_chat_user(self, user):
         self.current_chat_user = user
         self.setup_chat_area(user)
-        # Request chat history with this user
+        after_seq = self.synced_seq(user['id'])
+        if after_seq is not None:
+            # Only ask for what came after the messages we already hold
+            self.send_to_server({
+                'type': 'get_chat_history',
+                'user_id': user['id'],
+                'after_seq': after_seq,
+                'limit': HISTORY_PAGE_SIZE
+            })
+        else:
+            self.request_latest_history(user['id'])
+    
+    def request_latest_history(self, user_id):
+        # Request the latest page of chat history with this user
         self.send_to_server({
             'type': 'get_chat_history',
-            'user_id': user['id']
+            'user_id': user_id,
+            'limit': HISTORY_PAGE_SIZE
         })
     
     def send_message(self):
@@ -808,6 +1196,7 @@ class KawaiiChatClient:
             'content': message,
             'timestamp': now.isoformat()
         }
+        # Gets its id, server time and 'sent' status from message_sent
         
         # Add to local messages
         if self.current_chat_user['id'] not in self.chat_messages:
@@ -820,6 +1209,7 @@ class KawaiiChatClient:
         
         # Scroll to bottom
         self.scroll_to_bottom()
+        self.update_inbox(self.current_chat_user['id'], message, msg['timestamp'])
         
         # Send to server
         self.send_to_server({
@@ -829,13 +1219,42 @@ class KawaiiChatClient:
         })
     
       
-    def connect_to_server(self):
-        try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(60)#ncrease timeout to 60conds
-            self.socket.connect((self.server_host, self.server_port))
-            # After connection is established, set to None for blocking mode
-            self.socket.settimeout(None)
+    def open_connection(self, done):
+        """Connect and negotiate on a background thread, since both can block for seconds,
+        then call done(error) on the Tk thread (error is None on success)"""
+        if self.connecting:
+            return
+        self.connecting = True
+        
+        def run():
+            error = None
+            try:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.socket.settimeout(60)#ncrease timeout to 60conds
+                self.socket.connect((self.server_host, self.server_port))
+                self.negotiate_protocol()
+                # After connection is established, set to None for blocking mode
+                self.socket.settimeout(None)
+            except Exception as e:
+                error = e
+                try:
+                    self.socket.close()
+                except Exception:
+                    pass
+            self.root.after(0, lambda: finish(error))
+        
+        def finish(error):
+            self.connecting = False
+            done(error)
+        
+        threading.Thread(target=run, daemon=True).start()
+    
+    def connect_to_server(self, then=None):
+        """Connect in the background; then() runs once the connection is up"""
+        def done(error):
+            if error is not None:
+                messagebox.showerror("Connection Error", f"Could not connect to server: {error}")
+                return
             self.connected = True
             
             if not hasattr(self, '_listener_started'):
@@ -843,11 +1262,51 @@ class KawaiiChatClient:
                 print(f"Started message listener thread for {self.server_host}:{self.server_port}")
                 self._listener_started = True
             
-            return True
-        except Exception as e:
-            messagebox.showerror("Connection Error", f"Could not connect to server: {e}")
-            return False
+            if then:
+                then()
+        
+        self.open_connection(done)
+        
+    def negotiate_protocol(self):
+        """Offer compact binary framing and compression, falling back to newline JSON for old servers"""
+        self.encoder = FrameEncoder()
+        self.decoder = FrameDecoder()
+        self.heartbeat_timeout = LEGACY_HEARTBEAT_TIMEOUT
         
+        try:
+            self.socket.settimeout(HELLO_TIMEOUT)
+            self.socket.sendall(encode_frame({
+                'type': 'hello',
+                'protocol_version': PROTOCOL_VERSION,
+                'framing': SUPPORTED_FRAMINGS,
+                'compression': SUPPORTED_COMPRESSION,
+                'heartbeat_interval': HEARTBEAT_INTERVAL,
+                'acks': True
+            }))
+            
+            message = None
+            while message is None:
+                data = self.socket.recv(4096)
+                if not data:
+                    return
+                self.decoder.feed(data)
+                message = self.decoder.next_message()
+                
+            if message.get('type') == 'hello_response':
+                # Anything already buffered after the response is in the new framing
+                self.encoder.framing = self.decoder.framing = message.get('framing', self.encoder.framing)
+                if message.get('compression'):
+                    self.encoder.enable_compression(message['compression'])
+                    self.decoder.enable_compression(message['compression'])
+                if message.get('heartbeat_interval'):
+                    self.heartbeat_timeout = message['heartbeat_interval'] + HEARTBEAT_GRACE
+            else:
+                self.root.after(0, lambda m=message: self.process_incoming_message(m))
+        except socket.timeout:
+            print("Server did not answer hello, using newline JSON")
+        except (ProtocolError, ValueError) as e:
+            print(f"Protocol negotiation failed: {e}")
+    
     def login(self):
         username = self.username_entry.get().strip()
         password = self.password_entry.get().strip()
@@ -859,74 +1318,66 @@ class KawaiiChatClient:
         
         self._password = password
         
-        # Connect to server if needed
-        if not self.connected and not self.connect_to_server():
-            return
-            
-        # Send login request
-        self.send_to_server({
+        request = {
             'type': 'login',
             'username': username,
             'password': password
-        })
+        }
+        # Connect to server if needed, sending the login request once connected
+        if self.connected:
+            self.send_to_server(request)
+        else:
+            self.connect_to_server(lambda: self.send_to_server(request))
     
     def register(self, username, password, display_name=None):
-        # Connect to server if needed
-        if not self.connected and not self.connect_to_server():
-            return
-            
-        # Send registration request
-        self.send_to_server({
+        request = {
             'type': 'register',
             'username': username,
             'password': password,
             'display_name': display_name
-        })
+        }
+        # Connect to server if needed, sending the registration request once connected
+        if self.connected:
+            self.send_to_server(request)
+        else:
+            self.connect_to_server(lambda: self.send_to_server(request))
     
     def request_users_list(self):
         if not self.connected:
             return
             
+        # The server skips the list when it hasn't changed since ours
         self.send_to_server({
-            'type': 'get_users'
+            'type': 'get_users',
+            'if_version': self.users_version
         })
     
     def send_to_server(self, data):
         if not self.connected or not self.socket:
             print("Cannot send data - not connected")
-            self.root.after(1000, self.attempt_reconnect)
+            self.schedule_reconnect(1000)
             return False
             
         try:
-            # Special handling for larger data like images
-            is_large_data = 'image_data' in data and len(data['image_data']) > 100000
-            
-            if is_large_data:
-                # Set a longer timeout for image uploads
-                self.socket.settimeout(60)  # 60 second timeout
-                
-            # Add newline character to properly delimit messages
-            self.socket.sendall((json.dumps(data) + '\n').encode('utf-8'))
-            
-            if is_large_data:
-                # Reset timeout to default
-                self.socket.settimeout(None)
+            # Frame the message in whatever framing was negotiated
+            with self.send_lock:
+                self.socket.sendall(self.encoder.encode(data))
                 
             return True
         except BrokenPipeError:
             print("Connection lost: broken pipe")
             self.connected = False
-            self.root.after(1000, self.attempt_reconnect)
+            self.schedule_reconnect(1000)
             return False
         except ConnectionResetError:
             print("Connection reset by peer")
             self.connected = False
-            self.root.after(1000, self.attempt_reconnect)
+            self.schedule_reconnect(1000)
             return False
         except Exception as e:
             print(f"Could not send data to server: {e}")
             self.connected = False
-            self.root.after(1000, self.attempt_reconnect)
+            self.schedule_reconnect(1000)
             return False
     
     def process_incoming_message(self, message):
@@ -935,7 +1386,10 @@ class KawaiiChatClient:
         if message_type == 'login_response':
             if message.get('success'):
                 self.current_user = message.get('user')
+                self.session_token = message.get('session_token')
                 self.user_list = message.get('users', [])               
+                self.users_version = message.get('users_version')
+                self.inbox = {entry['user_id']: entry for entry in message.get('inbox', [])}
                 
                 
                 # Initialize chat messages dictionary for all users
@@ -949,34 +1403,33 @@ class KawaiiChatClient:
                     print("Started message listener thread in login response")
                     self._listener_started = True
                 
-                # Process unread messages
-                unread_messages = message.get('unread_messages', [])
-                
-                for msg in unread_messages:
-                    sender_id = msg['sender_id']
-                    if sender_id not in self.chat_messages:
-                        self.chat_messages[sender_id] = []
-                        
-                    # Convert to our message format
-                    formatted_msg = {
-                        'sender_id': sender_id,
-                        'receiver_id': self.current_user['id'],
-                        'content': msg['message'],
-                        'timestamp': msg['sent_at']
-                    }
-                    
-                    self.chat_messages[sender_id].append(formatted_msg)
+                # Unread messages arrive afterwards in offline_messages chunks
+                unread_count = message.get('unread_count', 0)
                 
                 # Switch to main interface
                 self.create_main_interface()
                 
                 # Show notification for unread messages
-                if unread_messages:
+                if unread_count:
                     messagebox.showinfo("Unread Messages", 
-                                      f"You have {len(unread_messages)} unread messages!")
+                                      f"You have {unread_count} unread messages!")
             else:
                 messagebox.showerror("Login Failed", message.get('message', "Invalid credentials"))
                 
+        elif message_type == 'resume_response':
+            if message.get('success'):
+                # Same session as before: keep the interface, contacts and loaded chats
+                self.session_token = message.get('session_token', self.session_token)
+                print("Session resumed")
+                # Messages may have come in while we were away, and contacts may
+                # have logged in or out; an unchanged user list comes back as
+                # not_modified
+                self.send_to_server({'type': 'get_inbox'})
+                self.request_users_list()
+            else:
+                self.session_token = None
+                self.relogin()
+                
         elif message_type == 'register_response':
             if message.get('success'):
                 messagebox.showinfo("Registration Successful", 
@@ -991,27 +1444,83 @@ class KawaiiChatClient:
                                    message.get('message', "Registration failed"))
                 
         elif message_type == 'users_list':
+            if message.get('not_modified'):
+                return
             self.user_list = message.get('users', [])
+            self.users_version = message.get('version')
             self.update_contacts_list()
         
+        elif message_type == 'inbox':
+            self.inbox = {entry['user_id']: entry for entry in message.get('conversations', [])}
+            # Whatever is on screen has been seen
+            if self.current_chat_user:
+                self.inbox.get(self.current_chat_user['id'], {})['unread'] = 0
+            self.refresh_contacts_list()
+        
+        elif message_type == 'user_online':
+            self.apply_user_delta(message.get('user_id'), {'status': 'online'})
+        
+        elif message_type == 'user_offline':
+            self.apply_user_delta(message.get('user_id'), {'status': 'offline',
+                                                            'last_seen': message.get('last_seen')})
+        
+        elif message_type == 'user_updated':
+            self.apply_user_delta(message.get('user_id'), message.get('changes', {}))
+        
+        elif message_type == 'avatar_upload_ready':
+            if self.pending_upload and message.get('sha256') == hashlib.sha256(self.pending_upload).hexdigest():
+                data, self.pending_upload = self.pending_upload, None
+                threading.Thread(target=self.send_avatar_chunks,
+                                 args=(data, message.get('chunk_size', 65536)), daemon=True).start()
+        
+        elif message_type == 'profile_pic_update_response':
+            self.pending_upload = None
+            if not message.get('success'):
+                messagebox.showerror("Profile Picture", message.get('message', "Upload failed"))
+        
+        elif message_type == 'avatar':
+            self.store_avatar(message)
+        
         elif message_type == 'chat_history':
             user_id = message.get('user_id')
             messages = message.get('messages', [])
             
+            is_older_page = bool(message.get('before'))
+            is_sync = message.get('after_seq') is not None
+            
             print(f"Received {len(messages)} messages in chat history")
             
-            # Clear existing messages for this user
-            self.chat_messages[user_id] = []
+            if is_sync and message.get('has_more'):
+                # Too far behind to catch up: start over from the latest page
+                self.request_latest_history(user_id)
+                return
             
-            # Process and store all messages
+            # Process all messages
+            page = []
             for msg in messages:
                 formatted_msg = {
+                    'id': msg.get('id'),
+                    'seq': msg.get('seq'),
                     'sender_id': msg['sender_id'],
                     'receiver_id': msg['receiver_id'],
                     'content': msg['message'],
-                    'timestamp': msg['sent_at']
+                    'timestamp': msg['sent_at'],
+                    'status': msg.get('status')
                 }
-                self.chat_messages[user_id].append(formatted_msg)
+                page.append(formatted_msg)
+            
+            if is_sync:
+                # Newer messages go after what we already have
+                known = {m.get('id') for m in self.chat_messages.get(user_id, [])}
+                self.chat_messages.setdefault(user_id, []).extend(m for m in page if m['id'] not in known)
+            elif is_older_page:
+                # Older page goes in front of what we already have
+                self.chat_messages[user_id] = page + self.chat_messages.get(user_id, [])
+                self.history_cursors[user_id] = message.get('next_cursor')
+            else:
+                # Latest page replaces existing messages for this user
+                self.chat_messages[user_id] = page
+                self.history_cursors[user_id] = message.get('next_cursor')
             
             # If we're currently viewing this chat, refresh the display
             if self.current_chat_user and self.current_chat_user['id'] == user_id:
@@ -1019,8 +1528,48 @@ class KawaiiChatClient:
                 for widget in self.messages_frame.winfo_children():
                     widget.destroy()
                 # Now display messages
-                self.display_messages(user_id)
+                if is_older_page:
+                    self.display_messages(user_id, self.displayed_counts.get(user_id, 0) + len(page))
+                else:
+                    self.display_messages(user_id)
+                    self.scroll_to_bottom()
+                    self.mark_chat_read(user_id)
+            
+        elif message_type == 'offline_messages':
+            shown_senders = set()
+            if message.get('cursor'):
+                self.offline_cursor = message['cursor']
+            self.queue_ack(delivered=[msg['id'] for msg in message.get('messages', [])])
+            
+            for msg in message.get('messages', []):
+                sender_id = msg['sender_id']
+                if sender_id not in self.chat_messages:
+                    self.chat_messages[sender_id] = []
+                    
+                # The chat may already have this message from a history page
+                if msg['id'] in {m.get('id') for m in self.chat_messages[sender_id][-HISTORY_PAGE_SIZE:]}:
+                    continue
+                    
+                # Convert to our message format
+                formatted_msg = {
+                    'id': msg['id'],
+                    'seq': msg.get('seq'),
+                    'sender_id': sender_id,
+                    'receiver_id': self.current_user['id'],
+                    'content': msg['message'],
+                    'timestamp': msg['sent_at']
+                }
+                
+                self.chat_messages[sender_id].append(formatted_msg)
+                
+                if self.current_chat_user and self.current_chat_user['id'] == sender_id:
+                    self.display_message(formatted_msg)
+                    shown_senders.add(sender_id)
+            
+            if shown_senders:
                 self.scroll_to_bottom()
+                for sender_id in shown_senders:
+                    self.mark_chat_read(sender_id)
             
         elif message_type == 'new_message':
             sender = message.get('sender')
@@ -1032,6 +1581,8 @@ class KawaiiChatClient:
                 
             # Add message to chat
             msg = {
+                'id': message.get('id'),
+                'seq': message.get('seq'),
                 'sender_id': sender['id'],
                 'receiver_id': self.current_user['id'],
                 'content': content,
@@ -1039,16 +1590,41 @@ class KawaiiChatClient:
             }
             
             self.chat_messages[sender['id']].append(msg)
+            self.update_inbox(sender['id'], content, timestamp, unread=1)
+            
+            if message.get('id'):
+                self.offline_cursor = f"{timestamp}|{message['id']}"
+                self.queue_ack(delivered=[message['id']])
             
             # If we're currently chatting with this user, display the message
             if self.current_chat_user and self.current_chat_user['id'] == sender['id']:
                 self.display_message(msg)
                 # Scroll to bottom
                 self.scroll_to_bottom()
+                self.mark_chat_read(sender['id'])
             else:
                 # Show notification
                 messagebox.showinfo("New Message", f"New message from {sender['display_name']}")
         
+        elif message_type == 'message_sent':
+            # Confirmations come back in the order we sent to each user
+            receiver_id = message.get('receiver_id')
+            msg = next((m for m in self.chat_messages.get(receiver_id, [])
+                        if m['sender_id'] == self.current_user['id'] and not m.get('id')
+                        and m.get('status') != 'failed'), None)
+            if msg is not None:
+                if message.get('success'):
+                    msg['id'] = message.get('id')
+                    msg['seq'] = message.get('seq')
+                    msg['timestamp'] = message.get('sent_at', msg['timestamp'])
+                self.set_message_status(msg, 'sent' if message.get('success') else 'failed')
+        
+        elif message_type == 'search_results':
+            self.show_search_results(message)
+        
+        elif message_type == 'receipt':
+            self.apply_receipt(message)
+        
         elif message_type == 'heartbeat':
             # Respond to server heartbeat
             self.send_to_server({
@@ -1058,33 +1634,33 @@ class KawaiiChatClient:
        
             
     def listen_for_messages(self):
-        buffer = ""
-        
         while self.connected:
             try:
-                # Set a timeout for receiving data
-                self.socket.settimeout(10) # 30 second timeout
-                data = self.socket.recv(4096).decode('utf-8')
+                # Only wake up if the server has gone quieter than its own heartbeats allow
+                self.socket.settimeout(self.heartbeat_timeout)
+                data = self.socket.recv(65536)
                 # Reset timeout after successful receive
                 self.socket.settimeout(None)
                 
                 if not data:
                     self.connected = False
                     print("Connection lost: no data received")
-                    self.root.after(5000, self.attempt_reconnect)
+                    self.schedule_reconnect(5000)
                     break
                     
-                buffer += data
+                self.decoder.feed(data)
                 
                 # Process complete messages
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
+                while True:
                     try:
-                        message = json.loads(line)
-                        # Process in main thread to avoid tkinter issues
-                        self.root.after(0, lambda m=message: self.process_incoming_message(m))
+                        message = self.decoder.next_message()
                     except json.JSONDecodeError:
                         print("Error decoding JSON message")
+                        continue
+                    if message is None:
+                        break
+                    # Process in main thread to avoid tkinter issues
+                    self.root.after(0, lambda m=message: self.process_incoming_message(m))
                         
             except socket.timeout:
                 # Socket timeout - send heartbeat to check connection
@@ -1095,61 +1671,75 @@ class KawaiiChatClient:
                 except Exception as e:
                     self.connected = False
                     print(f"Connection lost during heartbeat: {e}")
-                    self.root.after(5000, self.attempt_reconnect)
+                    self.schedule_reconnect(5000)
                     break
                     
             except ConnectionResetError:
                 self.connected = False
                 print("Connection reset by server")
-                self.root.after(5000, self.attempt_reconnect)
+                self.schedule_reconnect(5000)
                 break
                 
             except ConnectionAbortedError:
                 self.connected = False
                 print("Connection aborted")
-                self.root.after(5000, self.attempt_reconnect)
+                self.schedule_reconnect(5000)
                 break
                 
             except Exception as e:
                 self.connected = False
                 print(f"Error receiving messages: {e}")
-                self.root.after(5000, self.attempt_reconnect)
+                self.schedule_reconnect(5000)
                 break
             
     def attempt_reconnect(self):
         """Attempt to reconnect to the server after connection loss"""
-        if self.connected:
-            return  # Already reconnected somehow lol
+        if self.connected or self.connecting:
+            return  # Already reconnected somehow lol, or an attempt is under way
             
         print(f"Attempting to reconnect to {self.server_host}:{self.server_port}...")
-        
-        try:
-            # Create new socket
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.server_host, self.server_port))
-            self.connected = True
-            
-            # Start new listener thread
-            threading.Thread(target=self.listen_for_messages, daemon=True).start()
-            print("Reconnected successfully. Starting new message listener.")
-            
-            # Re-authenticate if we have user credentials
-            if self.current_user:
-                print(f"Re-authenticating as {self.current_user['username']}...")
-                self.send_to_server({
-                    'type': 'login',
-                    'username': self.current_user['username'],
-                    'password': self._password if hasattr(self, '_password') else '' #fixed
-                })
-                
-                
-                messagebox.showinfo("Reconnected", 
-                                "Connection to server re-established.\nYou may need to refresh your contacts.")
-                    
-        except Exception as e:
-            print(f"Reconnection failed: {e}")
+        self.open_connection(self.finish_reconnect)
+    
+    def finish_reconnect(self, error):
+        """Second half of attempt_reconnect, on the Tk thread once the connection is open (or not)"""
+        if error is not None:
+            print(f"Reconnection failed: {error}")
             # Schedule another attempt
-            self.root.after(10000, self.attempt_reconnect)  # Try again after 10 seconds
+            self.schedule_reconnect(10000)  # Try again after 10 seconds
+            return
+        
+        self.connected = True
+        
+        # Start new listener thread
+        threading.Thread(target=self.listen_for_messages, daemon=True).start()
+        print("Reconnected successfully. Starting new message listener.")
+        
+        # Resume the session if we have a token, otherwise re-authenticate
+        if self.current_user and self.session_token:
+            print(f"Resuming session as {self.current_user['username']}...")
+            self.send_to_server({
+                'type': 'resume',
+                'session_token': self.session_token,
+                'offline_cursor': self.offline_cursor
+            })
+        elif self.current_user:
+            self.relogin()
+    
+    def relogin(self):
+        """Log in again with the cached credentials (when there is no session to resume)"""
+        print(f"Re-authenticating as {self.current_user['username']}...")
+        self.send_to_server({
+            'type': 'login',
+            'username': self.current_user['username'],
+            'password': self._password if hasattr(self, '_password') else '' #fixed
+        })
+        
+        messagebox.showinfo("Reconnected", 
+                        "Connection to server re-established.\nYou may need to refresh your contacts.")
+    
+    def schedule_reconnect(self, delay_ms):
+        """Schedule a reconnect attempt, spread out so a server restart isn't met by every client at once"""
+        self.root.after(delay_ms + random.randint(0, RECONNECT_JITTER_MS), self.attempt_reconnect)
 
 if __name__ == "__main__":
     #high dpi awareness, just to check
@@ -0,0 +1,395 @@
+import asyncio
+import argparse
+import random
+import time
+import json
+import os
+import sys
+import subprocess
+import tempfile
+
+from chat_protocol import (PROTOCOL_VERSION, SUPPORTED_FRAMINGS, FRAMING_NEWLINE, FrameDecoder, FrameEncoder,
+                           ProtocolError, encode_frame)
+
+# Headless load generator for the KawaiiChat protocol. Registers and logs in many
+# synthetic users over real sockets, has them send messages at a configurable rate,
+# fetch history and reconnect in storms, and reports throughput and latency
+# percentiles. Everything runs on one box:
+#
+#   python load_test.py --spawn-server --users 2000 --duration 60
+#
+# --spawn-server starts socket_server.py in a child process on the storage backend
+# picked with --storage (in-memory by default); leave it out to load an already
+# running server. Run it once per backend to compare them on the same workload.
+
+# Marks load-test message content: prefix, then the send time in epoch seconds
+CONTENT_PREFIX = 'lt:'
+
+# Seconds to wait for a response before counting the request as timed out
+RESPONSE_TIMEOUT = 30
+
+# Seconds to keep listening for deliveries after senders stop
+DRAIN_SECONDS = 3
+
+def percentile(samples, fraction):
+    if not samples:
+        return float('nan')
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+# Latency samples (seconds) and counts collected by all synthetic users
+class Stats:
+    def __init__(self):
+        self.latencies = {}  # {name: [seconds]}
+        self.counts = {}  # {name: n}
+
+    def observe(self, name, seconds):
+        self.latencies.setdefault(name, []).append(seconds)
+
+    def count(self, name, amount=1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def report(self, elapsed):
+        lines = [f"Run time: {elapsed:.1f}s"]
+        for name in sorted(self.counts):
+            lines.append(f"  {name:<24} {self.counts[name]:>10}  ({self.counts[name] / elapsed:,.1f}/s)")
+        lines.append("")
+        lines.append(f"  {'latency (ms)':<24} {'count':>8} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+        for name in sorted(self.latencies):
+            samples = self.latencies[name]
+            lines.append(f"  {name:<24} {len(samples):>8} "
+                         f"{percentile(samples, 0.50) * 1000:>9.2f} {percentile(samples, 0.95) * 1000:>9.2f} "
+                         f"{percentile(samples, 0.99) * 1000:>9.2f} {max(samples) * 1000:>9.2f}")
+        return '\n'.join(lines)
+
+# One synthetic user with its own connection
+class LoadUser:
+    def __init__(self, index, args, stats):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.username = f"{args.prefix}{index}"
+        self.password = 'loadtest'
+        self.user_id = None
+        self.session_token = None
+        self.reader = None
+        self.writer = None
+        self.encoder = FrameEncoder()
+        self.decoder = FrameDecoder()
+        self.listener = None
+        self.acks = False
+        self.pending = {}  # {response type: Future}
+        self.ack_times = []  # send times of messages not yet acknowledged, in order
+        # Set once the connection is negotiated and logged in; only then may drive_user send
+        self.ready = asyncio.Event()
+
+    async def connect(self):
+        self.ready.clear()
+        self.reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+        self.encoder = FrameEncoder()
+        self.decoder = FrameDecoder()
+        self.acks = False
+        self.ack_times = []
+
+        if self.args.framing != FRAMING_NEWLINE:
+            # Negotiate before the listener starts, exactly like the GUI client
+            self.writer.write(encode_frame({
+                'type': 'hello',
+                'protocol_version': PROTOCOL_VERSION,
+                'framing': [self.args.framing],
+                'compression': ['zlib'] if self.args.compression else [],
+                'acks': True
+            }))
+            message = await asyncio.wait_for(self.read_message(), RESPONSE_TIMEOUT)
+            if message and message.get('type') == 'hello_response':
+                self.acks = True
+                self.encoder.framing = self.decoder.framing = message.get('framing', FRAMING_NEWLINE)
+                if message.get('compression'):
+                    self.encoder.enable_compression(message['compression'])
+                    self.decoder.enable_compression(message['compression'])
+
+        self.listener = asyncio.ensure_future(self.listen())
+
+    async def read_message(self):
+        while True:
+            message = self.decoder.next_message()
+            if message is not None:
+                return message
+            data = await self.reader.read(65536)
+            if not data:
+                return None
+            self.decoder.feed(data)
+
+    def send(self, payload):
+        self.writer.write(self.encoder.encode(payload))
+
+    # Send a request and wait for the response of the given type
+    async def request(self, payload, response_type):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[response_type] = future
+        self.send(payload)
+        try:
+            return await asyncio.wait_for(future, RESPONSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats.count(f"{response_type}_timeouts")
+            return None
+        finally:
+            self.pending.pop(response_type, None)
+
+    async def listen(self):
+        try:
+            while True:
+                message = await self.read_message()
+                if message is None:
+                    break
+                self.handle(message)
+        except (ConnectionError, ProtocolError, json.JSONDecodeError):
+            self.stats.count('connection_errors')
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_result(None)
+
+    def handle(self, message):
+        message_type = message.get('type')
+        now = time.time()
+
+        if message_type == 'new_message':
+            content = message.get('content') or ''
+            if content.startswith(CONTENT_PREFIX):
+                sent_at = float(content[len(CONTENT_PREFIX):].split(' ', 1)[0])
+                self.stats.observe('delivery', now - sent_at)
+            self.stats.count('messages_delivered')
+            if self.acks and message.get('id'):
+                # As if the chat were open: read on arrival, the sender gets a receipt
+                self.send({'type': 'ack', 'read': [message['id']]})
+        elif message_type == 'receipt':
+            self.stats.count('receipts')
+        elif message_type == 'message_sent':
+            if self.ack_times:
+                self.stats.observe('send_ack', now - self.ack_times.pop(0))
+            self.stats.count('messages_acked' if message.get('success') else 'messages_failed')
+        elif message_type == 'heartbeat':
+            self.send({'type': 'heartbeat_response'})
+        elif message_type in self.pending:
+            future = self.pending[message_type]
+            if not future.done():
+                future.set_result(message)
+
+    async def register_and_login(self):
+        await self.request({
+            'type': 'register',
+            'username': self.username,
+            'password': self.password,
+            'display_name': f"Load {self.index}"
+        }, 'register_response')
+        return await self.login()
+
+    async def login(self):
+        start = time.perf_counter()
+        response = await self.request({
+            'type': 'login',
+            'username': self.username,
+            'password': self.password
+        }, 'login_response')
+        if not response or not response.get('success'):
+            self.stats.count('login_failures')
+            return False
+        self.stats.observe('login', time.perf_counter() - start)
+        self.user_id = response['user']['id']
+        self.session_token = response.get('session_token')
+        self.ready.set()
+        return True
+
+    # Wait up to timeout seconds for the user to be logged in on an open connection
+    async def wait_ready(self, timeout):
+        try:
+            await asyncio.wait_for(self.ready.wait(), max(0, timeout))
+        except asyncio.TimeoutError:
+            return False
+        return self.writer is not None and not self.writer.is_closing()
+
+    # Drop the connection and come back, resuming the session when the server supports it
+    async def reconnect(self):
+        start = time.perf_counter()
+        await self.close()
+        try:
+            await self.connect()
+        except OSError:
+            self.stats.count('reconnect_failures')
+            return False
+
+        if self.session_token:
+            response = await self.request({'type': 'resume', 'session_token': self.session_token},
+                                          'resume_response')
+            ok = bool(response and response.get('success'))
+            if ok:
+                self.session_token = response.get('session_token', self.session_token)
+                self.ready.set()
+        else:
+            ok = False
+        if not ok:
+            ok = await self.login()
+
+        if ok:
+            self.stats.observe('reconnect', time.perf_counter() - start)
+        else:
+            self.stats.count('reconnect_failures')
+        return ok
+
+    def send_chat(self, receiver_id):
+        padding = 'x' * max(0, self.args.message_size - 20)
+        self.ack_times.append(time.time())
+        self.send({
+            'type': 'message',
+            'receiver_id': receiver_id,
+            'content': f"{CONTENT_PREFIX}{time.time():.6f} {padding}"
+        })
+        self.stats.count('messages_sent')
+
+    async def fetch_history(self, other_id):
+        start = time.perf_counter()
+        response = await self.request({'type': 'get_chat_history', 'user_id': other_id, 'limit': 50},
+                                      'chat_history')
+        if response is not None:
+            self.stats.observe('history', time.perf_counter() - start)
+
+    async def close(self):
+        self.ready.clear()
+        if self.listener:
+            self.listener.cancel()
+            self.listener = None
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+            self.writer = None
+
+# Each user sends to random peers with exponentially distributed gaps
+async def drive_user(user, peers, args, stop_at):
+    while time.monotonic() < stop_at:
+        await asyncio.sleep(random.expovariate(args.rate))
+        if not await user.wait_ready(stop_at - time.monotonic()):
+            continue
+        peer = random.choice(peers)
+        if peer is user or peer.user_id is None:
+            continue
+        try:
+            if random.random() < args.history_ratio:
+                await user.fetch_history(peer.user_id)
+            else:
+                user.send_chat(peer.user_id)
+                await user.writer.drain()
+        except (ConnectionError, OSError):
+            user.stats.count('connection_errors')
+
+async def reconnect_storm(users, args, stats):
+    await asyncio.sleep(args.storm_at)
+    victims = random.sample(users, int(len(users) * args.storm_fraction))
+    print(f"Reconnect storm: {len(victims)} users")
+    results = await asyncio.gather(*(user.reconnect() for user in victims))
+    stats.count('storm_reconnects', sum(results))
+
+async def run_load(args):
+    stats = Stats()
+    users = [LoadUser(i, args, stats) for i in range(args.users)]
+    gate = asyncio.Semaphore(args.connect_concurrency)
+
+    async def setup(user):
+        async with gate:
+            try:
+                await user.connect()
+                return await user.register_and_login()
+            except OSError:
+                stats.count('connect_failures')
+                return False
+
+    print(f"Connecting {len(users)} users to {args.host}:{args.port}...")
+    start = time.perf_counter()
+    ready = await asyncio.gather(*(setup(user) for user in users))
+    print(f"{sum(ready)} users logged in after {time.perf_counter() - start:.1f}s")
+
+    active = [user for user, ok in zip(users, ready) if ok]
+    if len(active) < 2:
+        print("Not enough users logged in to exchange messages")
+        return stats, 0
+
+    stop_at = time.monotonic() + args.duration
+    tasks = [drive_user(user, active, args, stop_at) for user in active]
+    if args.storm_fraction > 0:
+        tasks.append(reconnect_storm(active, args, stats))
+
+    start = time.perf_counter()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    # Rates are per second of sending; deliveries still in flight are counted during the drain
+    await asyncio.sleep(DRAIN_SECONDS)
+
+    await asyncio.gather(*(user.close() for user in users))
+    return stats, elapsed
+
+# Start socket_server.py in a child process. A sqlite backend gets a fresh database
+# file in a temporary directory, removed with it.
+def spawn_server(args, workdir):
+    server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'socket_server.py')
+    command = [sys.executable, server_script, '--port', str(args.port), '--mode', args.mode,
+               '--storage', args.storage, '--sqlite-path', os.path.join(workdir, 'load_test.db'),
+               '--metrics-port', '0']
+    process = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL if args.quiet_server else None)
+    time.sleep(1.5)
+    return process
+
+def raise_file_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError) as e:
+        print(f"Could not raise open file limit: {e}")
+
+def main():
+    parser = argparse.ArgumentParser(description="KawaiiChat load generator")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--users', type=int, default=100, help="synthetic users to log in")
+    parser.add_argument('--duration', type=float, default=30, help="seconds of sending")
+    parser.add_argument('--rate', type=float, default=1.0, help="actions per second per user")
+    parser.add_argument('--history-ratio', type=float, default=0.05,
+                        help="fraction of actions that fetch chat history instead of sending")
+    parser.add_argument('--message-size', type=int, default=64, help="approximate message length in characters")
+    parser.add_argument('--storm-fraction', type=float, default=0.0,
+                        help="fraction of users that drop and reconnect at once during the run")
+    parser.add_argument('--storm-at', type=float, default=10, help="seconds into the run for the storm")
+    parser.add_argument('--framing', choices=SUPPORTED_FRAMINGS, default=FRAMING_NEWLINE)
+    parser.add_argument('--compression', action='store_true', help="negotiate zlib (binary framing only)")
+    parser.add_argument('--connect-concurrency', type=int, default=200,
+                        help="users connecting and logging in at the same time during setup")
+    parser.add_argument('--prefix', default='loaduser', help="username prefix of the synthetic users")
+    parser.add_argument('--spawn-server', action='store_true', help="start a local server to load")
+    parser.add_argument('--storage', choices=['memory', 'sqlite', 'mysql'], default='memory',
+                        help="storage backend of the spawned server")
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default='asyncio',
+                        help="engine of the spawned server")
+    parser.add_argument('--quiet-server', action='store_true', help="hide the spawned server's output")
+    args = parser.parse_args()
+
+    raise_file_limit()
+    workdir = tempfile.TemporaryDirectory(prefix='kawaii-load-')
+    server = spawn_server(args, workdir.name) if args.spawn_server else None
+    try:
+        stats, elapsed = asyncio.run(run_load(args))
+        if elapsed:
+            print()
+            print(stats.report(elapsed))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        workdir.cleanup()
+
+if __name__ == "__main__":
+    main()
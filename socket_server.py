@@ -1,19 +1,149 @@
 import socket
 import threading
 import json
-import mysql.connector
 import datetime
 import hashlib
+import hmac
+import secrets
 import uuid
-from mysql.connector import Error
 import os
 import sys
 import base64
+import io
+import time
+import queue
+import functools
+import asyncio
+import argparse
+import signal
+from concurrent.futures import ThreadPoolExecutor, Future
+import multiprocessing
+from chat_bus import LocalBus, connect_bus, open_broker_socket, serve_broker
+from chat_cache import ConversationCache
+from chat_metrics import REGISTRY as metrics, serve_metrics
+from chat_storage import (BACKENDS as STORAGE_BACKENDS, MemoryStorage, MySQLStorage, SQLiteStorage, NIL_ID,
+                          new_id, now, search_terms)
+from chat_protocol import (PROTOCOL_VERSION, AVATAR_ORIGINAL, AVATAR_SIZES, FrameDecoder, FrameEncoder,
+                           ProtocolError, as_bytes, choose_framing, choose_compression)
+
+# Pillow renders avatar thumbnails; without it only the original upload is kept
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
 
 # Server configuration
 HOST = '0.0.0.0'
 PORT = 9999
 
+# Server engine: 'threaded' (one OS thread per connection) or 'asyncio' (one task per connection)
+SERVER_MODE = 'threaded'
+
+# Worker threads the asyncio engine uses for blocking database calls
+DB_EXECUTOR_WORKERS = 32
+
+# Longest single frame or JSON line either engine will buffer (profile pictures travel inline)
+MAX_LINE_BYTES = 16 * 1024 * 1024
+
+# Group commit for chat messages: a batch is flushed when it reaches MESSAGE_BATCH_SIZE
+# or MESSAGE_BATCH_DELAY seconds after its first message, whichever comes first
+MESSAGE_BATCH_SIZE = 200
+MESSAGE_BATCH_DELAY = 0.002
+# Messages waiting for a commit before senders are made to wait
+MESSAGE_QUEUE_SIZE = 10000
+
+# Undelivered messages sent per offline_messages chunk after login
+OFFLINE_CHUNK_SIZE = 200
+
+# Delivery and read acks from clients are applied in batches like chat messages:
+# flushed at ACK_BATCH_SIZE acks or ACK_BATCH_DELAY seconds after the first one
+ACK_BATCH_SIZE = 500
+ACK_BATCH_DELAY = 0.05
+ACK_QUEUE_SIZE = 10000
+
+# Stored messages are added to the search index after their commit, in batches of
+# their own: up to SEARCH_INDEX_BATCH_SIZE messages, gathered for at most
+# SEARCH_INDEX_BATCH_DELAY seconds
+SEARCH_INDEX_BATCH_SIZE = 1000
+SEARCH_INDEX_BATCH_DELAY = 0.05
+SEARCH_INDEX_QUEUE_SIZE = 50000
+
+# Chat history page size when a client asks for a page without a limit, and the largest page served
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 200
+
+# Message search results per page when a client asks without a limit, the largest
+# page served, and how many words of a query are looked up (the rest are ignored)
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_QUERY_TERMS = 8
+
+# Conversations whose newest messages are kept in memory, and how many messages each.
+# Latest-page requests up to HISTORY_CACHE_TAIL messages are served from the cache.
+# Only used by a single node: with a bus, other nodes write to the database too.
+HISTORY_CACHE_CONVERSATIONS = 5000
+HISTORY_CACHE_TAIL = HISTORY_PAGE_SIZE
+
+# Frames that may wait in one client's outbound queue
+OUTBOUND_QUEUE_SIZE = 1000
+# Seconds a reply to the client's own request waits for queue space before overflowing
+OUTBOUND_REPLY_TIMEOUT = 10
+# What happens when pushes to a client overflow its queue: 'disconnect' closes the
+# connection (the client reconnects and catches up from its offline backlog), 'spill'
+# drops the push and leaves chat messages unread in the database
+OUTBOUND_OVERFLOW_POLICY = 'disconnect'
+
+# Offer per-connection zlib compression to clients that ask for it, applied to
+# frames larger than COMPRESSION_THRESHOLD bytes
+COMPRESSION_ENABLED = True
+COMPRESSION_THRESHOLD = 512
+
+# Directory holding uploaded avatars, largest avatar accepted, and upload chunk size offered to clients
+AVATAR_DIR = 'avatars'
+MAX_AVATAR_BYTES = 5 * 1024 * 1024
+AVATAR_CHUNK_SIZE = 256 * 1024
+
+# Resume tokens let a reconnecting client skip the full login; they are valid this many seconds
+SESSION_TOKEN_TTL = 7 * 24 * 3600
+# Where the token signing secret is kept when KAWAII_SESSION_SECRET is not set
+SESSION_SECRET_FILE = 'kawaii_session_secret'
+
+# Seconds of silence before the server sends a heartbeat; clients may ask for another
+# interval in 'hello', within the min/max bounds
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_MIN_INTERVAL = 10
+HEARTBEAT_MAX_INTERVAL = 300
+# Seconds a heartbeat may go unanswered before the connection is reaped
+HEARTBEAT_TIMEOUT = 30
+# Resolution (seconds) and number of slots of the idle timer wheel
+TIMER_TICK = 1
+TIMER_WHEEL_SLOTS = 64
+
+# Length of the kernel queue of connections waiting to be accepted
+LISTEN_BACKLOG = 128
+
+# Worker processes sharing the port through SO_REUSEPORT; 1 serves everything from
+# this process. Workers reach each other's users through a bus broker run by the
+# parent, unless BUS_URL already names one.
+SERVER_WORKERS = 1
+
+# Seconds between a worker's checks that its parent is still alive, and seconds a
+# worker gets to exit on shutdown before it is killed
+WORKER_PARENT_CHECK_INTERVAL = 1
+WORKER_STOP_TIMEOUT = 5
+
+# Pub/sub bus connecting server nodes: None for a single node, or 'tcp://host:port'
+# of a broker started with `python chat_bus.py` to run several nodes side by side
+BUS_URL = None
+
+# Where data is kept: 'mysql' (DB_CONFIG below), 'sqlite' (the SQLITE_PATH file,
+# in WAL mode) or 'memory' (lost on restart, single process only)
+STORAGE_BACKEND = 'mysql'
+
+# SQLite database file and the number of pooled connections to it
+SQLITE_PATH = 'kawaii_chat.db'
+SQLITE_POOL_SIZE = 8
+
 # Database configuration
 DB_CONFIG = {
     'host': 'localhost',
@@ -22,555 +152,2000 @@ DB_CONFIG = {
     'database': 'kawaii_chat'
 }
 
-# Create database connection
-def create_db_connection():
-    try:
-        connection = mysql.connector.connect(**DB_CONFIG)
-        return connection
-    except Error as e:
-        print(f"Database connection error: {e}")
-        return None
+# Indexes the hot queries depend on, as (name, leading columns) per table:
+# conversation history is one range of a conversation ordered by seq, read marks
+# filter on the sender/receiver pair ordered by sent_at, the offline backlog on
+# receiver and delivered ordered by sent_at. Unread counts come from the inbox
+# table's primary key.
+REQUIRED_INDEXES = {
+    'messages': [
+        ('idx_messages_sequence', ('conversation_id', 'seq')),
+        ('idx_messages_conversation', ('sender_id', 'receiver_id', 'sent_at')),
+        ('idx_messages_undelivered', ('receiver_id', 'delivered', 'sent_at')),
+    ],
+}
+
+# Create missing indexes on existing tables at startup (otherwise they are only reported)
+MIGRATE_INDEXES_ON_STARTUP = True
+
+# MySQL connection pool shared by the data-access functions
+DB_POOL_SIZE = 32
+# Seconds a caller waits for a free pooled connection before giving up
+DB_POOL_TIMEOUT = 5
+# Pooled connections idle longer than this many seconds are pinged before reuse
+DB_POOL_HEALTH_CHECK_IDLE = 30
+
+# Local Prometheus endpoint (http://METRICS_HOST:METRICS_PORT/metrics); None disables it.
+# In worker mode each worker serves its own on the following ports.
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9100
+
+# Request types reported under their own label; anything else a client sends is counted as 'other'
+MESSAGE_TYPES = (
+    'hello', 'login', 'resume', 'register', 'message', 'get_chat_history', 'get_users',
+    'update_username', 'update_password', 'update_profile_pic', 'avatar_upload_begin',
+    'avatar_upload_chunk', 'avatar_upload_commit', 'get_avatar', 'heartbeat_response',
+    'client_heartbeat', 'ack', 'get_inbox', 'search_messages',
+)
+
+request_seconds = metrics.histogram('kawaii_request_seconds', "Time to handle a client request", ['type'])
+request_errors = metrics.counter('kawaii_request_errors_total', "Client requests that raised an error", ['type'])
+db_call_seconds = metrics.histogram('kawaii_db_call_seconds', "Time spent in a database function", ['function'])
+open_connections = metrics.gauge('kawaii_connections', "Open client connections")
+
+# Record call count and latency of a database function
+def timed_db(function):
+    name = function.__name__
+    
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with db_call_seconds.time(function=name):
+            return function(*args, **kwargs)
+    return wrapper
+
+# Storage backend all the data functions below go through, see chat_storage.py
+storage = None
+
+# Build a storage backend by name ('mysql', 'sqlite' or 'memory')
+def create_storage(backend=STORAGE_BACKEND):
+    if backend == 'mysql':
+        return MySQLStorage(DB_CONFIG, REQUIRED_INDEXES, MIGRATE_INDEXES_ON_STARTUP,
+                            DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTH_CHECK_IDLE)
+    if backend == 'sqlite':
+        return SQLiteStorage(SQLITE_PATH, SQLITE_POOL_SIZE, DB_POOL_TIMEOUT)
+    if backend == 'memory':
+        return MemoryStorage()
+    raise ValueError(f"Unknown storage backend {backend!r}, expected one of {', '.join(STORAGE_BACKENDS)}")
+
+# Switch the data functions over to a backend
+def open_storage(backend=STORAGE_BACKEND):
+    global storage
+    if storage is not None:
+        storage.close()
+    storage = create_storage(backend)
+    return storage
 
 def setup_database():
-    connection = create_db_connection()
-    if connection:
-        cursor = connection.cursor()
-        
-        # Create users table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id VARCHAR(36) PRIMARY KEY,
-            username VARCHAR(50) UNIQUE NOT NULL,
-            password VARCHAR(255) NOT NULL,
-            display_name VARCHAR(50),
-            last_seen DATETIME,
-            status ENUM('online', 'offline') DEFAULT 'offline',
-            profile_pic VARCHAR(255) DEFAULT 'default.png',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        # Create messages table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id VARCHAR(36) PRIMARY KEY,
-            sender_id VARCHAR(36) NOT NULL,
-            receiver_id VARCHAR(36) NOT NULL,
-            message TEXT NOT NULL,
-            sent_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            read_status BOOLEAN DEFAULT FALSE,
-            FOREIGN KEY (sender_id) REFERENCES users(id),
-            FOREIGN KEY (receiver_id) REFERENCES users(id)
-        )
-        ''')
-        
-        connection.commit()
-        cursor.close()
-        connection.close()
+    if storage is None:
+        open_storage()
+    if storage.setup():
         print("Database setup completed.")
-    else:
-        print("Failed to setup database.")
+        return True
+    print("Failed to setup database.")
+    return False
 
 # User authentication
+@timed_db
 def authenticate_user(username, password):
-    connection = create_db_connection()
-    if connection:
-        cursor = connection.cursor(dictionary=True)
-        
-        # Hash the password
-        hashed_password = hashlib.sha256(password.encode()).hexdigest()
-        
-        # Find user
-        cursor.execute("SELECT * FROM users WHERE username = %s AND password = %s", 
-                      (username, hashed_password))
-        user = cursor.fetchone()
-        
-        cursor.close()
-        connection.close()
-        
-        if user:
-            return user
-        
-    return None
+    # Hash the password
+    hashed_password = hashlib.sha256(password.encode()).hexdigest()
+    return storage.authenticate_user(username, hashed_password)
 
 # Add these new functions for profile updates
 # Register new user
+@timed_db
 def register_user(username, password, display_name=None):
-    connection = create_db_connection()
-    if connection:
-        cursor = connection.cursor()
-        
-        # Generate UUID for user
-        user_id = str(uuid.uuid4())
-        
-        # Hash the password
-        hashed_password = hashlib.sha256(password.encode()).hexdigest()
-        
-        # Set display name if not provided
-        if not display_name:
-            display_name = username
-            
-        try:
-            cursor.execute(
-                "INSERT INTO users (id, username, password, display_name) VALUES (%s, %s, %s, %s)",
-                (user_id, username, hashed_password, display_name)
-            )
-            connection.commit()
-            cursor.close()
-            connection.close()
-            return True
-        except Error as e:
-            print(f"Error registering user: {e}")
-            return False
+    # Time-ordered id, see chat_storage.new_id
+    user_id = new_id()
     
-    return False
+    # Hash the password
+    hashed_password = hashlib.sha256(password.encode()).hexdigest()
+    
+    # Set display name if not provided
+    if not display_name:
+        display_name = username
+    
+    success = storage.register_user(user_id, username, hashed_password, display_name)
+    if success:
+        invalidate_directory()
+    return success
+
+# Build the 'sent_at|id' cursor of a message's position in a stream (offline
+# backlog, read marks)
+def encode_position_cursor(message):
+    return f"{message['sent_at']}|{message['id']}"
+
+# Split a position cursor back into (sent_at, message_id), or None if malformed.
+# Stored times are naive, so a time with a UTC offset is malformed too: it could
+# not be compared with them.
+def decode_position_cursor(cursor):
+    try:
+        sent_at, message_id = cursor.split('|', 1)
+        sent_at = datetime.datetime.fromisoformat(sent_at)
+    except (AttributeError, ValueError):
+        return None
+    if sent_at.tzinfo is not None:
+        return None
+    return sent_at, message_id
+
+# Build the opaque cursor pointing just before a history message: its seq
+def encode_history_cursor(message):
+    return str(message['seq'])
+
+# The seq in a history cursor, or None if malformed (including the 'sent_at|id'
+# cursors of older servers)
+def decode_history_cursor(cursor):
+    try:
+        return int(cursor)
+    except (TypeError, ValueError):
+        return None
+
+history_cache = ConversationCache(HISTORY_CACHE_CONVERSATIONS, HISTORY_CACHE_TAIL)
+
+# One history page from the database: (messages oldest first, has_more)
+@timed_db
+def query_chat_history_page(user1_id, user2_id, before_seq, limit):
+    return storage.get_chat_history_page(user1_id, user2_id, before_seq, limit)
+
+# Messages after a seq from the database: (messages oldest first, has_more)
+@timed_db
+def query_chat_history_since(user1_id, user2_id, after_seq, limit):
+    return storage.get_chat_history_since(user1_id, user2_id, after_seq, limit)
+
+# Get one page of chat history between two users, newest first in the database but
+# returned oldest first. Returns (messages, next_cursor); next_cursor is None on the last page.
+# The latest page comes from the history cache when the conversation is in it.
+def get_chat_history_page(user1_id, user2_id, before=None, limit=HISTORY_PAGE_SIZE):
+    limit = max(1, min(int(limit), MAX_HISTORY_PAGE_SIZE))
+    
+    if before:
+        before_seq = decode_history_cursor(before)
+        if before_seq is None:
+            return [], None
+        messages, has_more = query_chat_history_page(user1_id, user2_id, before_seq, limit)
+    elif history_cache.cacheable(limit):
+        page = history_cache.tail(user1_id, user2_id, limit)
+        if page is None:
+            # Load the whole tail so the next pages of this size are hits too
+            token = history_cache.begin_fill(user1_id, user2_id)
+            messages, has_more = query_chat_history_page(user1_id, user2_id, None, history_cache.tail_size)
+            history_cache.finish_fill(user1_id, user2_id, token, messages, has_more)
+            page = messages[-limit:], has_more or len(messages) > limit
+        messages, has_more = page
+    else:
+        messages, has_more = query_chat_history_page(user1_id, user2_id, None, limit)
+    
+    next_cursor = encode_history_cursor(messages[0]) if has_more and messages else None
+    return messages, next_cursor
+
+# Catch a client up on a conversation it already holds up to seq after_seq: the
+# messages after it, oldest first, and whether more follow (then the client is
+# better off with the latest page). Returns (messages, has_more). A cached tail
+# reaching back to after_seq answers it without the database.
+def get_chat_history_since(user1_id, user2_id, after_seq, limit=HISTORY_PAGE_SIZE):
+    limit = max(1, min(int(limit), MAX_HISTORY_PAGE_SIZE))
+    
+    page = history_cache.since(user1_id, user2_id, after_seq, limit) if history_cache.enabled else None
+    if page is None:
+        page = query_chat_history_since(user1_id, user2_id, after_seq, limit)
+    return page
+
+# Build the cursor just after a ranked search hit: its score and id
+def encode_search_cursor(hit):
+    score, message_id = hit
+    return f"{score}|{message_id}"
+
+# Split a search cursor back into (score, message_id), or None if malformed
+def decode_search_cursor(cursor):
+    try:
+        score, message_id = cursor.split('|', 1)
+        return int(score), message_id
+    except (AttributeError, ValueError):
+        return None
+
+# One page of search results from the database: (messages best first, the
+# position of the last ranked hit or None on the last page)
+@timed_db
+def query_search_messages(user_id, terms, after, limit):
+    return storage.search_messages(user_id, terms, after, limit)
+
+# Search the user's conversations for messages with the words of 'query', best
+# matches first. Returns (messages, next_cursor); next_cursor is None on the last page.
+def search_messages(user_id, query, after=None, limit=SEARCH_PAGE_SIZE):
+    limit = max(1, min(int(limit), MAX_SEARCH_PAGE_SIZE))
+    terms = search_terms(query)[:SEARCH_MAX_QUERY_TERMS]
+    
+    position = None
+    if after:
+        position = decode_search_cursor(after)
+        if position is None:
+            return [], None
+    if not terms:
+        return [], None
+    
+    messages, next_after = query_search_messages(user_id, terms, position, limit)
+    next_cursor = encode_search_cursor(next_after) if next_after else None
+    return messages, next_cursor
+
 # Add this new function to get complete chat history between two users
+@timed_db
 def get_chat_history(user1_id, user2_id):
-    connection = create_db_connection()
-    if connection:
-        cursor = connection.cursor(dictionary=True)
-        
-        try:
-            # Get all messages between the two users
-            cursor.execute('''
-                SELECT m.id, m.message, m.sent_at, m.sender_id, m.receiver_id,
-                       u.username as sender_username, u.display_name as sender_display_name
-                FROM messages m
-                JOIN users u ON m.sender_id = u.id
-                WHERE (m.sender_id = %s AND m.receiver_id = %s) 
-                   OR (m.sender_id = %s AND m.receiver_id = %s)
-                ORDER BY m.sent_at ASC
-            ''', (user1_id, user2_id, user2_id, user1_id))
-            
-            messages = cursor.fetchall()
-            
-            # Convert datetime objects to strings for JSON seri//alization
-            for message in messages:
-                if isinstance(message['sent_at'], datetime.datetime):
-                    message['sent_at'] = message['sent_at'].isoformat()
-            
-            cursor.close()
-            connection.close()
-            return messages
-        except Error as e:
-            print(f"Error getting chat history: {e}")
-            return []
-    
-    return []
+    return storage.get_chat_history(user1_id, user2_id)
 
 # Update user status
+@timed_db
 def update_user_status(user_id, status):
-    connection = create_db_connection()
-    if connection:
-        cursor = connection.cursor()
-        
+    last_seen = now()
+    result = storage.update_user_status(user_id, status, last_seen)
+    if result:
+        update_directory_status(user_id, status, last_seen.isoformat())
+    return result
+
+# Insert a batch of messages in a single transaction
+@timed_db
+def insert_messages(messages):
+    return storage.insert_messages(messages)
+
+# Add stored messages to the search index
+@timed_db
+def index_messages(messages):
+    return storage.index_messages(messages)
+
+# Add the stored messages of each conversation from a seq on to the search index
+@timed_db
+def index_conversations(starts):
+    return storage.index_conversations(starts)
+
+# Background thread that drains a queue in batches. A batch is flushed when it
+# reaches batch_size items or batch_delay seconds after its first item, whichever
+# comes first. Subclasses implement flush().
+class BatchWriter:
+    name = 'kawaii-batch-writer'
+
+    def __init__(self, batch_size, batch_delay, queue_size):
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+                self.thread.start()
+
+    def put(self, item):
+        if self.thread is None:
+            self.start()
+        # Blocks the submitting handler when the writer falls behind
+        self.queue.put(item)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            
+            # Take whatever else is already queued, lingering briefly for stragglers
+            deadline = time.monotonic() + self.batch_delay
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(self.queue.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+            
+            try:
+                self.flush(batch)
+            except Exception as e:
+                print(f"Error in {self.name}: {e}")
+
+    def flush(self, batch):
+        raise NotImplementedError
+
+    def depth(self):
+        return self.queue.qsize()
+
+# Write-behind queue that group-commits messages from every connection.
+# submit() returns a Future that resolves to the stored message once its batch
+# is committed, or to None if it could not be stored. Committed messages are
+# written through to the history cache; pass the sender's user dict for that,
+# without it the conversation is dropped from the cache instead.
+class MessageWriter(BatchWriter):
+    name = 'kawaii-message-writer'
+
+    def __init__(self, batch_size=MESSAGE_BATCH_SIZE, batch_delay=MESSAGE_BATCH_DELAY, queue_size=MESSAGE_QUEUE_SIZE):
+        super().__init__(batch_size, batch_delay, queue_size)
+        self.counters = {'batches': 0, 'messages': 0, 'failed': 0}
+
+    def submit(self, sender_id, receiver_id, message_content, sender=None):
+        # Time-ordered id, see chat_storage.new_id
+        message = {
+            'id': new_id(),
+            'sender_id': sender_id,
+            'receiver_id': receiver_id,
+            'message': message_content,
+            'sent_at': datetime.datetime.now().replace(microsecond=0)
+        }
+        future = Future()
+        self.put((message, sender, future))
+        return future
+
+    # insert_messages, with an exception counting as a failed write
+    def store(self, messages):
         try:
-            cursor.execute(
-                "UPDATE users SET status = %s, last_seen = NOW() WHERE id = %s",
-                (status, user_id)
-            )
-            connection.commit()
-            cursor.close()
-            connection.close()
-            return True
-        except Error as e:
-            print(f"Error updating user status: {e}")
+            return insert_messages(messages)
+        except Exception as e:
+            print(f"Error storing {len(messages)} messages: {e}")
             return False
-    
-    return False
 
-# Store message
-def store_message(sender_id, receiver_id, message_content):
-    connection = create_db_connection()
-    if connection:
-        cursor = connection.cursor()
+    def flush(self, batch):
+        try:
+            self.commit(batch)
+        finally:
+            # Whatever went wrong, no sender is left waiting on its Future
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    def commit(self, batch):
+        messages = [message for message, _, _ in batch]
         
-        # Generate UUID for message
-        message_id = str(uuid.uuid4())
+        if self.store(messages):
+            stored = [True] * len(batch)
+        elif len(batch) > 1:
+            # One bad row (e.g. an unknown receiver) must not sink the whole batch
+            stored = [self.store([message]) for message in messages]
+        else:
+            stored = [False]
         
+        self.counters['batches'] += 1
+        self.counters['messages'] += len(batch)
+        self.counters['failed'] += stored.count(False)
+        
+        results = []
+        cached = []
+        for (message, sender, future), ok in zip(batch, stored):
+            result = None
+            if ok:
+                result = dict(message)
+                result['sent_at'] = message['sent_at'].isoformat()
+                if sender:
+                    cached.append(dict(result, sender_username=sender['username'],
+                                       sender_display_name=sender['display_name'], status='sent'))
+                else:
+                    history_cache.forget(message['sender_id'], message['receiver_id'])
+            results.append(result)
+        
+        # Before the futures' callbacks push anything, so a client that reacts by
+        # fetching history already finds the message
+        history_cache.add(cached)
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
+        search_indexer.submit([message for message, ok in zip(messages, stored) if ok])
+
+message_writer = MessageWriter()
+
+# Applies delivery and read acks from every connection in batches, then sends
+# read receipts for whatever actually changed. Acks merge within a batch: ids
+# are unioned and each conversation keeps only its latest read mark.
+class AckWriter(BatchWriter):
+    name = 'kawaii-ack-writer'
+
+    def __init__(self, batch_size=ACK_BATCH_SIZE, batch_delay=ACK_BATCH_DELAY, queue_size=ACK_QUEUE_SIZE):
+        super().__init__(batch_size, batch_delay, queue_size)
+        self.counters = {'batches': 0, 'acks': 0, 'failed': 0}
+
+    # read_until: {sender id: position} marking the receiver's conversations read up to there
+    def submit(self, user_id, delivered=(), read=(), read_until=None):
+        if delivered or read or read_until:
+            self.put((user_id, delivered, read, read_until or {}))
+
+    def flush(self, batch):
+        delivered = {}
+        read = {}
+        read_marks = {}
+        merged = 0
+        for user_id, delivered_ids, read_ids, read_until in batch:
+            # A bad ack is dropped on its own rather than taking the batch down with it
+            try:
+                self.merge(delivered, read, read_marks, user_id, delivered_ids, read_ids, read_until)
+                merged += 1
+            except Exception as e:
+                print(f"Error merging acks of {user_id}: {e}")
+                self.counters['failed'] += 1
+
+        self.counters['batches'] += 1
+        self.counters['acks'] += len(batch)
+        if not merged:
+            return
+        changes = apply_acks(delivered, read, read_marks)
+        if changes is None:
+            self.counters['failed'] += merged
+            return
+        delivered_changes, read_changes, mark_changes = changes
+        history_cache.set_status(delivered_changes, 'delivered')
+        history_cache.set_status(read_changes, 'read')
+        history_cache.mark_read(mark_changes)
+        send_receipts(*changes)
+
+    # Fold one ack into the batch's delivered and read sets and read marks. The marks
+    # are only updated once the whole ack has been checked.
+    def merge(self, delivered, read, read_marks, user_id, delivered_ids, read_ids, read_until):
+        marks = {}
+        for sender_id, position in read_until.items():
+            key = (user_id, sender_id)
+            if key in read_marks and not position > read_marks[key]:
+                continue
+            marks[key] = position
+        if delivered_ids:
+            delivered.setdefault(user_id, set()).update(delivered_ids)
+        if read_ids:
+            read.setdefault(user_id, set()).update(read_ids)
+        read_marks.update(marks)
+
+ack_writer = AckWriter()
+
+# Adds committed messages to the search index, so the group commit doesn't wait on
+# it: a message becomes searchable a moment after it is stored. submit() never
+# blocks; when the queue is full the message is left out and only the place it
+# left in its conversation is remembered, and the indexer reads the conversation
+# back from there once it gets to it. Messages of a batch that fails, or that are
+# still queued when the server stops, are indexed by the storage's backfill on the
+# next start.
+class SearchIndexer(BatchWriter):
+    name = 'kawaii-search-indexer'
+
+    def __init__(self, batch_size=SEARCH_INDEX_BATCH_SIZE, batch_delay=SEARCH_INDEX_BATCH_DELAY,
+                 queue_size=SEARCH_INDEX_QUEUE_SIZE):
+        super().__init__(batch_size, batch_delay, queue_size)
+        self.counters = {'batches': 0, 'messages': 0, 'failed': 0, 'dropped': 0}
+        self.dropped = {}  # {conversation id: lowest seq left out}
+
+    def submit(self, messages):
+        if self.thread is None:
+            self.start()
+        for message in messages:
+            try:
+                self.queue.put_nowait(message)
+            except queue.Full:
+                with self.lock:
+                    key = message['conversation_id']
+                    self.dropped[key] = min(self.dropped.get(key, message['seq']), message['seq'])
+                    self.counters['dropped'] += 1
+
+    def flush(self, batch):
         try:
-            cursor.execute(
-                "INSERT INTO messages (id, sender_id, receiver_id, message) VALUES (%s, %s, %s, %s)",
-                (message_id, sender_id, receiver_id, message_content)
-            )
-            connection.commit()
-            cursor.close()
-            connection.close()
-            return True
-        except Error as e:
-            print(f"Error storing message: {e}")
-            return False
-    
-    return False
+            indexed = index_messages(batch)
+        except Exception as e:
+            print(f"Error indexing {len(batch)} messages: {e}")
+            indexed = False
 
-# Get unread messages for user
-def get_unread_messages(user_id):
-    connection = create_db_connection()
-    if connection:
-        cursor = connection.cursor(dictionary=True)
+        self.counters['batches'] += 1
+        self.counters['messages'] += len(batch)
+        if not indexed:
+            self.counters['failed'] += len(batch)
+
+        # A drop means the queue was full, so another batch always follows one that
+        # misses it
+        with self.lock:
+            dropped, self.dropped = self.dropped, {}
+        if dropped and not index_conversations(dropped):
+            with self.lock:
+                for key, seq in dropped.items():
+                    self.dropped[key] = min(self.dropped.get(key, seq), seq)
+
+search_indexer = SearchIndexer()
+
+# Store message, waiting until it is durable. Returns the stored message or None.
+@timed_db
+def store_message(sender_id, receiver_id, message_content):
+    return message_writer.submit(sender_id, receiver_id, message_content).result()
+
+# Count unread messages for user, per sender
+@timed_db
+def get_unread_counts(user_id):
+    return storage.get_unread_counts(user_id)
+
+# Unread count and last message of each of the user's conversations, most recent first
+@timed_db
+def get_inbox(user_id):
+    return storage.get_inbox(user_id)
+
+# Get the next chunk of undelivered messages for user, oldest first, strictly after
+# the (sent_at, id) position 'after'. Returns None if the backend failed.
+@timed_db
+def get_undelivered_messages_chunk(user_id, after=None, limit=OFFLINE_CHUNK_SIZE):
+    return storage.get_undelivered_messages_chunk(user_id, after, limit)
+
+# Apply a batch of merged acks, see AckWriter. Returns the changes or None.
+@timed_db
+def apply_acks(delivered, read, read_marks):
+    return storage.apply_acks(delivered, read, read_marks)
+
+# Stream a user's undelivered backlog in bounded chunks. Clients that ack mark
+# messages delivered themselves; for the others everything sent counts as read.
+def stream_undelivered_messages(session, user_id, after=None):
+    delivered = 0
+    
+    while True:
+        messages = get_undelivered_messages_chunk(user_id, after)
+        if messages is None:
+            break
         
-        try:
-            # Get messages and sender info
-            cursor.execute('''
-                SELECT m.id, m.message, m.sent_at, m.sender_id, 
-                       u.username as sender_username, u.display_name as sender_display_name
-                FROM messages m
-                JOIN users u ON m.sender_id = u.id
-                WHERE m.receiver_id = %s AND m.read_status = FALSE
-                ORDER BY m.sent_at ASC
-            ''', (user_id,))
-            
-            messages = cursor.fetchall()
-            
-            # Convert datetime objects to strings for JSON serialization
-            for message in messages:
-                if isinstance(message['sent_at'], datetime.datetime):
-                    message['sent_at'] = message['sent_at'].isoformat()
-            
-            # Mark messages as read
-            if messages:
-                cursor.execute(
-                    "UPDATE messages SET read_status = TRUE WHERE receiver_id = %s AND read_status = FALSE",
-                    (user_id,)
-                )
-                connection.commit()
-            
-            cursor.close()
-            connection.close()
-            return messages
-        except Error as e:
-            print(f"Error getting unread messages: {e}")
-            return []
+        if messages:
+            after = (datetime.datetime.fromisoformat(messages[-1]['sent_at']), messages[-1]['id'])
+        
+        done = len(messages) < OFFLINE_CHUNK_SIZE
+        # Waits for room in the outbound queue, so a slow client paces the stream
+        if not session.reply({
+            'type': 'offline_messages',
+            'messages': messages,
+            'done': done,
+            'cursor': encode_position_cursor(messages[-1]) if messages else None
+        }):
+            break
+        
+        if not session.acks:
+            ack_writer.submit(user_id, read=[message['id'] for message in messages])
+        delivered += len(messages)
+        
+        if done:
+            break
     
-    return []
-
+    return delivered
 
 # Get all users
+@timed_db
 def get_all_users():
-    connection = create_db_connection()
-    if connection:
-        cursor = connection.cursor(dictionary=True)
-        
+    return storage.get_all_users()
+
+# The user list as one versioned snapshot, loaded once per change instead of once
+# per request and kept serialized per framing, so every users_list reply shares
+# the same bytes. Logins and logouts patch the user's status into a new snapshot
+# (update_directory_status()); anything else that changes a user calls
+# invalidate_directory() and the next reader reloads. Versions are opaque strings, unique to this node and
+# snapshot, which clients send back as if_version to skip an unchanged list.
+class UserDirectory:
+    def __init__(self):
+        self.node = secrets.token_hex(4)
+        self.generation = 0
+        self.snapshot = None
+        self.lock = threading.Lock()
+        self.counters = {'loads': 0, 'hits': 0, 'not_modified': 0, 'patches': 0}
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.snapshot = None
+
+    # Replace the snapshot with a copy carrying the user's new status under a new
+    # version. Readers still holding the old snapshot keep a consistent one.
+    def update_status(self, user_id, status, last_seen):
+        with self.lock:
+            self.generation += 1
+            snapshot = self.snapshot
+            if snapshot is None:
+                return
+            users = list(snapshot['users'])
+            for i, user in enumerate(users):
+                if user['id'] == user_id:
+                    users[i] = dict(user, status=status, last_seen=last_seen)
+                    break
+            else:
+                # Not in this snapshot (registered elsewhere a moment ago), so reload
+                self.snapshot = None
+                return
+            self.snapshot = {'version': f"{self.node}.{self.generation}", 'users': users, 'serialized': {}}
+            self.counters['patches'] += 1
+
+    # {'version', 'users', 'serialized': {framing: users_list bytes}}
+    def current(self):
+        with self.lock:
+            if self.snapshot is not None:
+                self.counters['hits'] += 1
+                return self.snapshot
+            generation = self.generation
+
+        users = get_all_users()
+        snapshot = {'version': f"{self.node}.{generation}", 'users': users, 'serialized': {}}
+        with self.lock:
+            self.counters['loads'] += 1
+            # A change that landed while loading makes this load stale; serve it but don't keep it
+            if self.generation == generation:
+                self.snapshot = snapshot
+        return snapshot
+
+    # The users_list reply for a session, serialized once per framing
+    def serialized(self, snapshot, session):
+        serialized = snapshot['serialized'].get(session.framing)
+        if serialized is None:
+            serialized = session.serialize({'type': 'users_list', 'version': snapshot['version'],
+                                            'users': snapshot['users']})
+            snapshot['serialized'][session.framing] = serialized
+        return serialized
+
+user_directory = UserDirectory()
+
+# Change a user's username, returns (success, message)
+@timed_db
+def update_username(user_id, new_username):
+    new_username = (new_username or '').strip()
+    if not new_username:
+        return False, 'Username cannot be empty'
+    if len(new_username) > 50:
+        return False, 'Username is too long'
+    success, message = storage.update_username(user_id, new_username)
+    if success:
+        invalidate_directory()
+    return success, message
+
+# Point a user's profile picture at a stored avatar
+@timed_db
+def set_profile_pic(user_id, avatar_hash):
+    success = storage.set_profile_pic(user_id, avatar_hash)
+    if success:
+        invalidate_directory()
+    return success
+
+# Content-addressed avatar store. Each image is kept once under its SHA-256,
+# next to pre-rendered square thumbnails for every size in AVATAR_SIZES:
+#   AVATAR_DIR/ab/abcdef...            original upload
+#   AVATAR_DIR/ab/abcdef..._contact.png  thumbnail
+def avatar_path(avatar_hash, size=AVATAR_ORIGINAL):
+    name = avatar_hash if size == AVATAR_ORIGINAL else f"{avatar_hash}_{size}.png"
+    return os.path.join(AVATAR_DIR, avatar_hash[:2], name)
+
+def is_avatar_hash(value):
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+def avatar_exists(avatar_hash):
+    return is_avatar_hash(avatar_hash) and os.path.exists(avatar_path(avatar_hash))
+
+# Magic numbers accepted when Pillow isn't installed to inspect the image
+IMAGE_SIGNATURES = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff', b'GIF87a', b'GIF89a')
+
+# Store an uploaded image and its thumbnails, returns (success, message, avatar_hash)
+def store_avatar(image_bytes):
+    if not image_bytes:
+        return False, 'No image data', None
+    if len(image_bytes) > MAX_AVATAR_BYTES:
+        return False, 'Image is too large', None
+    
+    avatar_hash = hashlib.sha256(image_bytes).hexdigest()
+    if avatar_exists(avatar_hash):
+        # Someone already uploaded this exact image
+        return True, 'Profile picture updated', avatar_hash
+    
+    thumbnails = {}
+    if Image is not None:
         try:
-            cursor.execute('''
-                SELECT id, username, display_name, status, last_seen, profile_pic
-                FROM users
-            ''')
-            
-            users = cursor.fetchall()
-            
-            # Convert datetime objects to strings
-            for user in users:
-                if 'last_seen' in user and isinstance(user['last_seen'], datetime.datetime):
-                    user['last_seen'] = user['last_seen'].isoformat()
-            
-            cursor.close()
-            connection.close()
-            return users
-        except Error as e:
-            print(f"Error getting users: {e}")
-            return []
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                image.load()
+                image = image.convert('RGBA')
+                for name, pixels in AVATAR_SIZES.items():
+                    thumbnail = ImageOps.fit(image, (pixels, pixels))
+                    output = io.BytesIO()
+                    thumbnail.save(output, format='PNG', optimize=True)
+                    thumbnails[name] = output.getvalue()
+        except Exception as e:
+            print(f"Rejected avatar upload: {e}")
+            return False, 'Not a valid image', None
+    elif not image_bytes.startswith(IMAGE_SIGNATURES):
+        return False, 'Not a valid image', None
     
-    return []
+    try:
+        os.makedirs(os.path.dirname(avatar_path(avatar_hash)), exist_ok=True)
+        # Thumbnails first, the original last: its presence marks the avatar complete
+        for name, data in thumbnails.items():
+            write_file_atomic(avatar_path(avatar_hash, name), data)
+        write_file_atomic(avatar_path(avatar_hash), image_bytes)
+    except OSError as e:
+        print(f"Error storing avatar: {e}")
+        return False, 'Could not store image', None
+    
+    return True, 'Profile picture updated', avatar_hash
 
-# Active clients dictionary {user_id: (client_socket, username)}
-active_clients = {}
+def write_file_atomic(path, data):
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
 
-# Client handler function
-def handle_client(client_socket, client_address):
-    print(f"New connection from {client_address}")
-    current_user = None
-    buffer = ""
+# Read a stored avatar at one of AVATAR_SIZES (or the original). Without Pillow no
+# thumbnails exist, so the original is served instead.
+def load_avatar(avatar_hash, size=AVATAR_ORIGINAL):
+    if not is_avatar_hash(avatar_hash):
+        return None
+    for path in (avatar_path(avatar_hash, size), avatar_path(avatar_hash)):
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except (FileNotFoundError, ValueError):
+            continue
+    return None
+
+# Legacy single-message upload (base64 image inside the JSON line), kept for older clients
+def update_profile_pic(user_id, image_data, file_extension=None):
+    try:
+        image_bytes = as_bytes(image_data)
+    except (ValueError, TypeError):
+        return False, 'Invalid image data', None
+    
+    success, message_text, avatar_hash = store_avatar(image_bytes)
+    if success and not set_profile_pic(user_id, avatar_hash):
+        return False, 'Profile picture update failed', None
+    return success, message_text, avatar_hash
+
+# Secret used to sign session tokens. It must survive restarts (and be shared by every
+# server instance) for tokens to stay valid, so it comes from KAWAII_SESSION_SECRET or
+# is generated once into SESSION_SECRET_FILE.
+def load_session_secret():
+    secret = os.environ.get('KAWAII_SESSION_SECRET')
+    if secret:
+        return secret.encode('utf-8')
     
-    # Initialize last activity timestamp
-    last_activity = datetime.datetime.now()
+    try:
+        with open(SESSION_SECRET_FILE, 'rb') as f:
+            secret = f.read().strip()
+        if secret:
+            return secret
+    except FileNotFoundError:
+        pass
     
+    secret = base64.urlsafe_b64encode(secrets.token_bytes(32))
     try:
-        # Set a reasonable timeout for socket operations
-        client_socket.settimeout(60)  # 60 second timeout
+        fd = os.open(SESSION_SECRET_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(secret)
+    except FileExistsError:
+        # Another process created it first, use theirs
+        with open(SESSION_SECRET_FILE, 'rb') as f:
+            return f.read().strip()
+    except OSError as e:
+        print(f"Could not save session secret, tokens will not survive a restart: {e}")
+    return secret
+
+session_secret = None
+
+def _sign(data):
+    global session_secret
+    if session_secret is None:
+        session_secret = load_session_secret()
+    return hmac.new(session_secret, data, hashlib.sha256).digest()
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+# Issue a signed, self-contained resume token for a logged-in user. Verifying it needs
+# no database round trip, so a reconnect storm after a restart never touches MySQL for auth.
+def issue_session_token(user):
+    claims = {
+        'id': user['id'],
+        'username': user['username'],
+        'display_name': user['display_name'],
+        'exp': int(time.time()) + SESSION_TOKEN_TTL
+    }
+    body = json.dumps(claims, separators=(',', ':')).encode('utf-8')
+    return f"{_b64(body)}.{_b64(_sign(body))}"
+
+# Check a resume token, returning the user it was issued to or None
+def verify_session_token(token):
+    try:
+        body_text, signature_text = token.split('.', 1)
+        body = _unb64(body_text)
+        if not hmac.compare_digest(_sign(body), _unb64(signature_text)):
+            return None
+        claims = json.loads(body)
+    except (AttributeError, ValueError, TypeError):
+        return None
+    
+    if claims.get('exp', 0) < time.time():
+        return None
+    return {
+        'id': claims['id'],
+        'username': claims['username'],
+        'display_name': claims['display_name']
+    }
+
+# Active clients dictionary {user_id: (session, username)}
+active_clients = {}
+
+# A connected client, independent of the server engine that serves it.
+# Everything sent to the client goes through a bounded outbound queue drained
+# by a single writer, so frames never interleave and a slow reader only ever
+# fills its own queue.
+class ClientSession:
+    def __init__(self, client_address):
+        self.address = client_address
+        self.user = None
+        # Monotonic time of the last bytes received; the idle timer reads it, readers bump it
+        self.last_activity = time.monotonic()
+        self.heartbeat_interval = HEARTBEAT_INTERVAL
+        self.heartbeat_sent_at = None
+        self.timer_due = None
+        # Chunked avatar upload in progress, if any
+        self.avatar_upload = None
+        # Whether the client acks deliveries and reads (announced in 'hello')
+        self.acks = False
+        self.outbound = queue.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        self.closed = False
+        # Newline JSON until the client negotiates something else with 'hello'
+        self.encoder = FrameEncoder(threshold=COMPRESSION_THRESHOLD)
+        self.decoder = FrameDecoder(max_frame_bytes=MAX_LINE_BYTES)
+
+    @property
+    def framing(self):
+        return self.encoder.framing
+
+    # Serialization is shared work; framing and compression happen later in the writer
+    def serialize(self, payload):
+        return self.encoder.serialize(payload)
+
+    # Push to the client without ever blocking the caller; applies the overflow policy when full
+    def send(self, payload):
+        return self.send_serialized(self.serialize(payload))
+
+    # Answer the client's own request, waiting for queue space if the client is behind
+    def reply(self, payload):
+        return self.send_serialized(self.serialize(payload), block=True)
+
+    def send_serialized(self, serialized, block=False):
+        if self.closed:
+            return False
         
+        item = (self.encoder.framing, serialized)
+        try:
+            if block:
+                self.outbound.put(item, timeout=OUTBOUND_REPLY_TIMEOUT)
+            else:
+                self.outbound.put_nowait(item)
+        except queue.Full:
+            self.overflow()
+            return False
+        
+        self.wake_writer()
+        return True
+
+    def overflow(self):
+        if OUTBOUND_OVERFLOW_POLICY == 'disconnect':
+            print(f"Outbound queue full for {self.address}, disconnecting")
+            self.close()
+        else:
+            # 'spill': drop the push. Chat messages are already stored unread,
+            # so they reach the client with its next offline backlog.
+            print(f"Outbound queue full for {self.address}, spilling push to offline storage")
+
+    # Everything queued right now, framed (and compressed, in queue order) as one buffer
+    # for a single write. Only the session's writer calls this.
+    def drain_outbound(self, first=None):
+        chunks = []
+        if first is not None:
+            chunks.append(self.encoder.frame(first[1], first[0]))
+        while True:
+            try:
+                item = self.outbound.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return b''.join(chunks), True
+            chunks.append(self.encoder.frame(item[1], item[0]))
+        return b''.join(chunks), False
+
+    def wake_writer(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+# Session served by a reader thread and a writer thread over a blocking socket
+class ThreadedSession(ClientSession):
+    def __init__(self, client_socket, client_address):
+        super().__init__(client_address)
+        self.socket = client_socket
+        self.writer_thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer_thread.start()
+
+    def wake_writer(self):
+        # The writer thread blocks on the queue itself
+        pass
+
+    def write_loop(self):
         while True:
-            # Check if we need to send a heartbeat (every 30 seconds)
-            now = datetime.datetime.now()
-            if (now - last_activity).total_seconds() > 30:
+            item = self.outbound.get()
+            if item is None:
+                break
+            
+            # Coalesce whatever else is queued into the same sendall
+            data, stop = self.drain_outbound(item)
+            try:
+                self.socket.sendall(data)
+            except Exception as e:
+                # After close() the shutdown socket refusing data is expected
+                if not self.closed:
+                    print(f"Error sending to {self.address}: {e}")
+                self.close()
+                break
+            if stop:
+                break
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            # Wakes the reader thread blocked in recv, and the writer blocked in sendall
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        try:
+            self.outbound.put_nowait(None)
+        except queue.Full:
+            pass
+
+    # The socket is only closed once the writer thread is done with it, so the
+    # descriptor is never closed under a sendall in progress
+    def release(self):
+        self.close()
+        if threading.current_thread() is not self.writer_thread:
+            self.writer_thread.join()
+        try:
+            self.socket.close()
+        except:
+            pass
+
+# Session served by tasks on the asyncio event loop
+class AsyncSession(ClientSession):
+    def __init__(self, writer, client_address, loop):
+        super().__init__(client_address)
+        self.writer = writer
+        self.loop = loop
+        self.ready = asyncio.Event()
+        self.writer_task = loop.create_task(self.write_loop())
+
+    def wake_writer(self):
+        # Senders run on executor and writer threads, so signal the loop safely
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+    async def write_loop(self):
+        while not self.closed:
+            await self.ready.wait()
+            self.ready.clear()
+            
+            data, stop = self.drain_outbound()
+            if data:
                 try:
-                    # Send heartbeat
-                    heartbeat = {"type": "heartbeat"}
-                    client_socket.sendall((json.dumps(heartbeat) + '\n').encode('utf-8'))
-                    print(f"Sent heartbeat to {client_address}")
-                    last_activity = now
+                    self.writer.write(data)
+                    # Only this connection's task waits for a slow reader
+                    await self.writer.drain()
                 except Exception as e:
-                    print(f"Error sending heartbeat to {client_address}: {e}")
+                    print(f"Error sending to {self.address}: {e}")
+                    self.close()
                     break
-            
+            if stop:
+                break
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        self.ready.set()
+        self.writer.close()
+
+# One thread watches every connection for idleness instead of each reader waking
+# up to check its own. Sessions sit in a hashed timer wheel under the tick they are
+# next due; receiving data only bumps last_activity, and a session whose slot comes
+# up is checked then and simply rescheduled if it has been busy. A session silent
+# for its heartbeat interval gets a single heartbeat, and is reaped if that goes
+# unanswered for HEARTBEAT_TIMEOUT.
+class IdleTimer:
+    def __init__(self, tick=TIMER_TICK, slots=TIMER_WHEEL_SLOTS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.lock = threading.Lock()
+        self.origin = time.monotonic()
+        self.current_tick = 0
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True, name='kawaii-idle-timer')
+            self.thread.start()
+
+    def watch(self, session):
+        self.schedule(session, session.last_activity + session.heartbeat_interval)
+
+    def schedule(self, session, when):
+        with self.lock:
+            due_tick = max(int((when - self.origin) / self.tick) + 1, self.current_tick + 1)
+            # Entries due more than a full turn away stay put until their round comes.
+            # Rescheduling leaves the old entry behind; it is skipped as stale when reached.
+            session.timer_due = due_tick
+            self.slots[due_tick % len(self.slots)].append((due_tick, session))
+
+    def run(self):
+        while True:
+            next_tick_at = self.origin + (self.current_tick + 1) * self.tick
+            time.sleep(max(0, next_tick_at - time.monotonic()))
+
+            due = []
+            with self.lock:
+                # Catch up on every tick that has passed, in case a pass ran long
+                now_tick = int((time.monotonic() - self.origin) / self.tick)
+                while self.current_tick < now_tick:
+                    self.current_tick += 1
+                    index = self.current_tick % len(self.slots)
+                    waiting = []
+                    for entry in self.slots[index]:
+                        (due if entry[0] <= self.current_tick else waiting).append(entry)
+                    self.slots[index] = waiting
+
+            for due_tick, session in due:
+                if session.timer_due != due_tick:
+                    continue
+                try:
+                    self.check(session)
+                except Exception as e:
+                    print(f"Error checking idle connection {session.address}: {e}")
+
+    def check(self, session):
+        if session.closed:
+            # Dropped from the wheel by not rescheduling it
+            return
+
+        now = time.monotonic()
+        if now - session.last_activity < session.heartbeat_interval:
+            # Busy since it was scheduled
+            self.schedule(session, session.last_activity + session.heartbeat_interval)
+        elif session.heartbeat_sent_at is None or session.heartbeat_sent_at < session.last_activity:
+            session.send({"type": "heartbeat"})
+            session.heartbeat_sent_at = now
+            self.schedule(session, now + HEARTBEAT_TIMEOUT)
+        elif now - session.heartbeat_sent_at < HEARTBEAT_TIMEOUT:
+            self.schedule(session, session.heartbeat_sent_at + HEARTBEAT_TIMEOUT)
+        else:
+            print(f"No answer to heartbeat from {session.address}, closing connection")
+            session.close()
+
+idle_timer = IdleTimer()
+
+# Heartbeat interval for a session, from what the client asked for in 'hello'
+def choose_heartbeat_interval(requested):
+    if not isinstance(requested, (int, float)) or isinstance(requested, bool):
+        return HEARTBEAT_INTERVAL
+    return max(HEARTBEAT_MIN_INTERVAL, min(HEARTBEAT_MAX_INTERVAL, int(requested)))
+
+# Cross-node routing. Every node subscribes to BROADCAST_CHANNEL and to the channel
+# of each user it holds a session for; pushes for anyone else are published on the
+# bus and delivered by whichever node holds them (or by nobody, if they're offline).
+BROADCAST_CHANNEL = 'broadcast'
+# Tells other nodes a user's new status, or that their user directory snapshot is
+# out of date
+DIRECTORY_CHANNEL = 'directory'
+
+def user_channel(user_id):
+    return f"user:{user_id}"
+
+# Deliver something another node published. User channels carry either a push for
+# the client or a claim: the user logged in on another node, which now owns them.
+def on_bus_message(channel, payload):
+    if channel == BROADCAST_CHANNEL:
+        broadcast_local(payload['message'], payload.get('exclude_user_id'))
+    elif channel == DIRECTORY_CHANNEL:
+        if payload.get('status'):
+            user_directory.update_status(payload['user_id'], payload['status'], payload['last_seen'])
+        else:
+            user_directory.invalidate()
+    elif channel and channel.startswith('user:'):
+        user_id = channel[len('user:'):]
+        entry = active_clients.get(user_id)
+        if not entry:
+            return
+        if payload.get('claimed'):
+            # Forget our session without reporting the user offline, they are online elsewhere
+            unregister_client(user_id)
+        else:
+            push_to_session(entry[0], payload['push'])
+
+# Replaced in start_server when BUS_URL points at a broker
+message_bus = LocalBus(on_bus_message)
+
+# A user was added or changed: drop the directory snapshot here and on every other node
+def invalidate_directory():
+    user_directory.invalidate()
+    message_bus.publish(DIRECTORY_CHANNEL, {})
+
+# A user logged in or out: patch the directory snapshot here and on every other node
+def update_directory_status(user_id, status, last_seen):
+    user_directory.update_status(user_id, status, last_seen)
+    message_bus.publish(DIRECTORY_CHANNEL, {'user_id': user_id, 'status': status, 'last_seen': last_seen})
+
+# Make a logged-in session the one that receives the user's pushes, on every node
+def register_client(session, username):
+    channel = user_channel(session.user['id'])
+    message_bus.publish(channel, {'claimed': True})
+    active_clients[session.user['id']] = (session, username)
+    message_bus.subscribe(channel)
+
+def unregister_client(user_id):
+    del active_clients[user_id]
+    message_bus.unsubscribe(user_channel(user_id))
+
+# Push a payload to a session on this node. Clients that don't ack get no receipts,
+# and chat messages pushed to them count as delivered once queued.
+def push_to_session(session, payload):
+    if payload.get('type') == 'receipt' and not session.acks:
+        return
+    if session.send(payload) and payload.get('type') == 'new_message' and not session.acks:
+        ack_writer.submit(session.user['id'], delivered=[payload['id']])
+
+# Push a payload to a user wherever they are connected; True if they are on this node
+def push_to_user(user_id, payload):
+    entry = active_clients.get(user_id)
+    if entry:
+        push_to_session(entry[0], payload)
+        return True
+    message_bus.publish(user_channel(user_id), {'push': payload})
+    return False
+
+# Send a payload to every connected client, on this node and all others
+def broadcast(payload, exclude_user_id=None):
+    broadcast_local(payload, exclude_user_id)
+    message_bus.publish(BROADCAST_CHANNEL, {'message': payload, 'exclude_user_id': exclude_user_id})
+
+# Send a payload to every client connected to this node
+def broadcast_local(payload, exclude_user_id=None):
+    # Serialize once per framing, every recipient on that framing shares the same bytes
+    serialized = {}
+    for uid, (session, _) in list(active_clients.items()):
+        if uid == exclude_user_id:
+            continue
+        try:
+            if session.framing not in serialized:
+                serialized[session.framing] = session.serialize(payload)
+            session.send_serialized(serialized[session.framing])
+        except:
+            pass
+
+# Presence and profile deltas, so clients can patch their user list in place
+def broadcast_user_online(user_id):
+    broadcast({'type': 'user_online', 'user_id': user_id}, exclude_user_id=user_id)
+
+def broadcast_user_offline(user_id):
+    broadcast({
+        'type': 'user_offline',
+        'user_id': user_id,
+        'last_seen': datetime.datetime.now().isoformat()
+    }, exclude_user_id=user_id)
+
+def broadcast_user_updated(user_id, changes):
+    broadcast({'type': 'user_updated', 'user_id': user_id, 'changes': changes})
+
+# Push a stored message to its receiver and confirm it to the sender
+def deliver_message(session, sender, receiver_id, stored):
+    if stored is None:
+        session.send({
+            'type': 'message_sent',
+            'success': False,
+            'receiver_id': receiver_id
+        })
+        return
+    
+    # Push to the receiver, on whichever node they are connected to
+    message_to_send = {
+        'type': 'new_message',
+        'id': stored['id'],
+        'seq': stored['seq'],
+        'sender': sender,
+        'content': stored['message'],
+        'timestamp': stored['sent_at']
+    }
+    
+    try:
+        push_to_user(receiver_id, message_to_send)
+    except Exception as e:
+        print(f"Error delivering message to {receiver_id}: {e}")
+    
+    # Send confirmation to sender
+    try:
+        session.send({
+            'type': 'message_sent',
+            'success': True,
+            'receiver_id': receiver_id,
+            'id': stored['id'],
+            'seq': stored['seq'],
+            'sent_at': stored['sent_at']
+        })
+    except Exception as e:
+        print(f"Error confirming message to {sender['id']}: {e}")
+
+# Tell senders what became of their messages: one receipt per sender, receiver and
+# status listing the ids, or naming the position a read mark reached
+def send_receipts(delivered_changes, read_changes, mark_changes):
+    grouped = {}
+    for status, changes in (('delivered', delivered_changes), ('read', read_changes)):
+        for sender_id, receiver_id, message_id in changes:
+            grouped.setdefault((sender_id, receiver_id, status), []).append(message_id)
+    
+    for (sender_id, receiver_id, status), message_ids in grouped.items():
+        push_to_user(sender_id, {'type': 'receipt', 'status': status, 'user_id': receiver_id, 'ids': message_ids})
+    
+    for sender_id, receiver_id, position in mark_changes:
+        push_to_user(sender_id, {
+            'type': 'receipt',
+            'status': 'read',
+            'user_id': receiver_id,
+            'until': f"{position[0].isoformat()}|{position[1]}"
+        })
+
+# Message ids from a client ack, ignoring anything that isn't one
+def ack_ids(value):
+    if not isinstance(value, list):
+        return []
+    return [message_id for message_id in value if isinstance(message_id, str)]
+
+# Point the user at a stored avatar, answer the uploader and tell everyone else
+def finish_avatar_update(session, success, message_text, avatar_hash):
+    if success and not set_profile_pic(session.user['id'], avatar_hash):
+        success, message_text = False, 'Profile picture update failed'
+
+    session.reply({
+        'type': 'profile_pic_update_response',
+        'success': success,
+        'message': message_text,
+        'filename': avatar_hash if success else None
+    })
+
+    if success:
+        broadcast_user_updated(session.user['id'], {'profile_pic': avatar_hash})
+
+# Handle a single decoded request from a client, recording how long it took
+def process_message(session, message):
+    message_type = message.get('type')
+    label = message_type if message_type in MESSAGE_TYPES else 'other'
+    
+    with request_seconds.time(type=label):
+        try:
+            dispatch_message(session, message)
+        except Exception:
+            request_errors.inc(type=label)
+            raise
+
+def dispatch_message(session, message):
+    message_type = message.get('type')
+    current_user = session.user
+
+    # Handle heartbeat response
+    if message_type == 'heartbeat_response' or message_type == 'client_heartbeat':
+        # Receiving it already refreshed last_activity
+        return
+
+    # Protocol negotiation, sent by newer clients before anything else
+    if message_type == 'hello':
+        framing = choose_framing(message.get('framing'))
+        compression = choose_compression(message.get('compression'), framing) if COMPRESSION_ENABLED else None
+        session.heartbeat_interval = choose_heartbeat_interval(message.get('heartbeat_interval'))
+        session.acks = bool(message.get('acks'))
+        idle_timer.watch(session)
+        session.reply({
+            'type': 'hello_response',
+            'protocol_version': PROTOCOL_VERSION,
+            'framing': framing,
+            'compression': compression,
+            'heartbeat_interval': session.heartbeat_interval
+        })
+        # The response above still goes out in the old framing, everything after in the new one
+        session.encoder.framing = framing
+        session.decoder.framing = framing
+        if compression:
+            session.encoder.enable_compression(compression)
+            session.decoder.enable_compression(compression)
+        return
+
+    # Handle different message types
+    if message_type == 'login':
+        username = message.get('username')
+        password = message.get('password')
+
+        user = authenticate_user(username, password)
+        if user:
+            session.user = user
+
+            # Ensure any datetime objects in the user dict are converted to strings
+            user_data = {
+                'id': user['id'],
+                'username': user['username'],
+                'display_name': user['display_name']
+            }
+            # Only include these specific fields to avoid datetime fields
+
+            register_client(session, username)
+            update_user_status(user['id'], 'online')
+            broadcast_user_online(user['id'])
+
+            # Only the inbox goes in the response, the messages follow in chunks
+            inbox = get_inbox(user['id'])
+            unread_counts = {entry['user_id']: entry['unread'] for entry in inbox if entry['unread']}
+
+            # Get all users; already includes this user as online
+            directory = user_directory.current()
+
+            # Send successful login response
+            response = {
+                'type': 'login_response',
+                'success': True,
+                'user': user_data,
+                'session_token': issue_session_token(user_data),
+                'unread_count': sum(unread_counts.values()),
+                'unread_counts': unread_counts,
+                'inbox': inbox,
+                'users': directory['users'],
+                'users_version': directory['version']
+            }
+            session.reply(response)
+
+            if unread_counts:
+                stream_undelivered_messages(session, user['id'])
+        else:
+            # Send failed login response
+            response = {
+                'type': 'login_response',
+                'success': False,
+                'message': 'Invalid username or password'
+            }
+            session.reply(response)
+
+    elif message_type == 'resume':
+        # Fast reconnect: no password check, no directory reload, no unread recount
+        user = verify_session_token(message.get('session_token'))
+        if user:
+            session.user = user
+            register_client(session, user['username'])
+            update_user_status(user['id'], 'online')
+            broadcast_user_online(user['id'])
+
+            session.reply({
+                'type': 'resume_response',
+                'success': True,
+                'user': user,
+                'session_token': issue_session_token(user)
+            })
+
+            # Pick the offline stream up where the client says it got to. The whole second
+            # of the cursor is replayed because ids do not order messages within it; the
+            # client drops the ones it already has.
+            position = decode_position_cursor(message.get('offline_cursor') or '')
+            stream_undelivered_messages(session, user['id'], (position[0], NIL_ID) if position else None)
+        else:
+            session.reply({
+                'type': 'resume_response',
+                'success': False,
+                'message': 'Session expired, please log in again'
+            })
+
+    elif message_type == 'register':
+        username = message.get('username')
+        password = message.get('password')
+        display_name = message.get('display_name')
+
+        success = register_user(username, password, display_name)
+
+        # Send registration response
+        response = {
+            'type': 'register_response',
+            'success': success,
+            'message': 'Registration successful' if success else 'Registration failed'
+        }
+
+        session.reply(response)
+
+    elif message_type == 'message' and current_user:
+        receiver_id = message.get('receiver_id')
+        content = message.get('content')
+
+        if not isinstance(receiver_id, str) or not isinstance(content, str):
+            session.send({
+                'type': 'message_sent',
+                'success': False,
+                'receiver_id': receiver_id
+            })
+            return
+
+        # Queue the message for the next group commit; delivery and the
+        # sender's confirmation happen once its batch is durable
+        sender = {
+            'id': current_user['id'],
+            'username': current_user['username'],
+            'display_name': current_user['display_name']
+        }
+        future = message_writer.submit(current_user['id'], receiver_id, content, sender)
+        future.add_done_callback(lambda f: deliver_message(session, sender, receiver_id, f.result()))
+
+    elif message_type == 'ack' and current_user:
+        # Delivered and read ids, and/or per-conversation read marks {sender id: cursor}.
+        # Applied in the next ack batch; no reply, the senders get receipts.
+        read_until = {}
+        marks = message.get('read_until')
+        for sender_id, cursor in (marks.items() if isinstance(marks, dict) else []):
+            position = decode_position_cursor(cursor)
+            if position:
+                read_until[sender_id] = position
+        ack_writer.submit(current_user['id'], ack_ids(message.get('delivered')), ack_ids(message.get('read')), read_until)
+
+    elif message_type == 'get_chat_history' and current_user:
+        other_user_id = message.get('user_id')
+
+        try:
+            limit = int(message.get('limit') or HISTORY_PAGE_SIZE)
+        except (TypeError, ValueError):
+            limit = HISTORY_PAGE_SIZE
+
+        if 'after_seq' in message:
+            # Sync: whatever the client is missing after the newest seq it holds
             try:
-                # Try to receive data with timeout
-                data = client_socket.recv(4096)
-                
-                if not data:
-                    print(f"No data received from {client_address}, closing connection")
+                after_seq = max(0, int(message.get('after_seq')))
+            except (TypeError, ValueError):
+                after_seq = 0
+            chat_history, has_more = get_chat_history_since(current_user['id'], other_user_id, after_seq, limit)
+
+            response = {
+                'type': 'chat_history',
+                'user_id': other_user_id,
+                'messages': chat_history,
+                'after_seq': after_seq,
+                'has_more': has_more
+            }
+        elif 'limit' in message or 'before' in message:
+            # Paginated: one page older than the 'before' cursor (latest page without one)
+            before = message.get('before')
+            chat_history, next_cursor = get_chat_history_page(current_user['id'], other_user_id, before, limit)
+
+            response = {
+                'type': 'chat_history',
+                'user_id': other_user_id,
+                'messages': chat_history,
+                'before': before,
+                'next_cursor': next_cursor
+            }
+        else:
+            # Get chat history between the two users
+            chat_history = get_chat_history(current_user['id'], other_user_id)
+
+            response = {
+                'type': 'chat_history',
+                'user_id': other_user_id,
+                'messages': chat_history
+            }
+
+        session.reply(response)
+
+    elif message_type == 'search_messages' and current_user:
+        query = message.get('query') if isinstance(message.get('query'), str) else ''
+        try:
+            limit = int(message.get('limit') or SEARCH_PAGE_SIZE)
+        except (TypeError, ValueError):
+            limit = SEARCH_PAGE_SIZE
+        results, next_cursor = search_messages(current_user['id'], query, message.get('cursor'), limit)
+
+        session.reply({
+            'type': 'search_results',
+            'query': query,
+            'messages': results,
+            'cursor': message.get('cursor'),
+            'next_cursor': next_cursor
+        })
+
+    elif message_type == 'get_users' and current_user:
+        directory = user_directory.current()
+
+        if message.get('if_version') == directory['version']:
+            user_directory.counters['not_modified'] += 1
+            session.reply({'type': 'users_list', 'version': directory['version'], 'not_modified': True})
+        else:
+            session.send_serialized(user_directory.serialized(directory, session), block=True)
+
+    elif message_type == 'get_inbox' and current_user:
+        session.reply({
+            'type': 'inbox',
+            'conversations': get_inbox(current_user['id'])
+        })
+
+    elif message_type == 'update_username' and current_user:
+        new_username = message.get('new_username')
+        success, message_text = update_username(current_user['id'], new_username)
+
+        if success:
+            # Update current_user data
+            current_user['username'] = new_username
+            # Update active clients entry
+            active_clients[current_user['id']] = (session, new_username)
+            # Cached history carries the old name
+            history_cache.forget_user(current_user['id'])
+
+        response = {
+            'type': 'username_update_response',
+            'success': success,
+            'message': message_text,
+            'new_username': new_username if success else None
+        }
+        if success:
+            # Tokens carry the username, hand out one with the new name
+            response['session_token'] = issue_session_token(current_user)
+
+        session.reply(response)
+
+        # If successful, tell all clients about the changed field
+        if success:
+            broadcast_user_updated(current_user['id'], {'username': new_username})
+
+    elif message_type == 'update_password' and current_user:
+        current_password = message.get('current_password')
+        new_password = message.get('new_password')
+
+        success, message_text = update_password(current_user['id'], current_password, new_password)
+
+        response = {
+            'type': 'password_update_response',
+            'success': success,
+            'message': message_text
+        }
+
+        session.reply(response)
+
+    elif message_type == 'update_profile_pic' and current_user:
+        image_data = message.get('image_data')
+        file_extension = message.get('file_extension')
+
+        success, message_text, filename = update_profile_pic(current_user['id'], image_data, file_extension)
+
+        response = {
+            'type': 'profile_pic_update_response',
+            'success': success,
+            'message': message_text,
+            'filename': filename
+        }
+
+        session.reply(response)
+
+        # If successful, tell all clients about the changed field
+        if success:
+            broadcast_user_updated(current_user['id'], {'profile_pic': filename})
+
+    elif message_type == 'avatar_upload_begin' and current_user:
+        avatar_hash = str(message.get('sha256', '')).lower()
+        size = message.get('size')
+
+        if not is_avatar_hash(avatar_hash) or not isinstance(size, int) or not 0 < size <= MAX_AVATAR_BYTES:
+            session.reply({
+                'type': 'profile_pic_update_response',
+                'success': False,
+                'message': 'Invalid upload'
+            })
+        elif avatar_exists(avatar_hash):
+            # Already stored, nothing to upload
+            session.avatar_upload = None
+            finish_avatar_update(session, True, 'Profile picture updated', avatar_hash)
+        else:
+            session.avatar_upload = {'sha256': avatar_hash, 'size': size, 'data': bytearray()}
+            session.reply({
+                'type': 'avatar_upload_ready',
+                'sha256': avatar_hash,
+                'chunk_size': AVATAR_CHUNK_SIZE
+            })
+
+    elif message_type == 'avatar_upload_chunk' and current_user:
+        upload = session.avatar_upload
+        try:
+            chunk = as_bytes(message.get('data')) or b''
+        except (ValueError, TypeError):
+            chunk = None
+
+        # Chunks must arrive in order and stay within the announced size
+        if (upload is None or chunk is None or message.get('offset') != len(upload['data'])
+                or len(upload['data']) + len(chunk) > upload['size']):
+            session.avatar_upload = None
+            session.reply({
+                'type': 'profile_pic_update_response',
+                'success': False,
+                'message': 'Upload out of sequence'
+            })
+        else:
+            upload['data'] += chunk
+
+    elif message_type == 'avatar_upload_commit' and current_user:
+        upload = session.avatar_upload
+        session.avatar_upload = None
+
+        if upload is None or hashlib.sha256(upload['data']).hexdigest() != upload['sha256']:
+            finish_avatar_update(session, False, 'Upload incomplete or corrupted', None)
+        else:
+            success, message_text, avatar_hash = store_avatar(bytes(upload['data']))
+            finish_avatar_update(session, success, message_text, avatar_hash)
+
+    elif message_type == 'get_avatar' and current_user:
+        avatar_hash = message.get('hash')
+        size = message.get('size', AVATAR_ORIGINAL)
+        if not isinstance(size, str):
+            session.reply({'type': 'avatar', 'hash': avatar_hash, 'size': size, 'success': False, 'data': None})
+            return
+        if size not in AVATAR_SIZES:
+            size = AVATAR_ORIGINAL
+        data = load_avatar(avatar_hash, size)
+
+        # Content never changes for a hash, so clients cache these forever
+        session.reply({
+            'type': 'avatar',
+            'hash': avatar_hash,
+            'size': size,
+            'success': data is not None,
+            'data': data
+        })
+
+# Clean up after a client disconnects
+def end_session(session):
+    current_user = session.user
+    if current_user:
+        entry = active_clients.get(current_user['id'])
+        # A newer connection for the same user may already have replaced this one
+        if entry and entry[0] is session:
+            unregister_client(current_user['id'])
+            update_user_status(current_user['id'], 'offline')
+            broadcast_user_offline(current_user['id'])
+
+# Client handler function (threaded engine)
+def handle_client(client_socket, client_address):
+    print(f"New connection from {client_address}")
+    session = ThreadedSession(client_socket, client_address)
+    idle_timer.watch(session)
+    open_connections.inc()
+
+    try:
+        while True:
+            # Block until data arrives; the idle timer handles heartbeats and
+            # shuts the socket down (waking this recv) if the client goes dead
+            data = client_socket.recv(65536)
+
+            if not data:
+                print(f"No data received from {client_address}, closing connection")
+                break
+
+            # Update activity timestamp on receiving data
+            session.last_activity = time.monotonic()
+            session.decoder.feed(data)
+
+            # Process complete messages
+            while True:
+                try:
+                    message = session.decoder.next_message()
+                except json.JSONDecodeError as e:
+                    # The bad line is dropped, carry on with the next one
+                    print(f"JSON decode error from {client_address}: {e}")
+                    continue
+                if message is None:
                     break
-                    
-                # Update activity timestamp on receiving data
-                last_activity = datetime.datetime.now()
-                
-                # Handle message
-                buffer += data.decode('utf-8')
-                
-                # Process complete messages
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    message = json.loads(line)
-                    message_type = message.get('type')
-                    
-                    # Handle heartbeat response
-                    if message_type == 'heartbeat_response' or message_type == 'client_heartbeat':
-                        # Just acknowledge and continue
-                        last_activity = datetime.datetime.now()
-                        continue
-                    
-                    # Handle different message types
-                    if message_type == 'login':
-                        username = message.get('username')
-                        password = message.get('password')
-                        
-                        user = authenticate_user(username, password)
-                        if user:
-                            current_user = user
-                            
-                            # Ensure any datetime objects in the user dict are converted to strings
-                            user_data = {
-                                'id': user['id'],
-                                'username': user['username'],
-                                'display_name': user['display_name']
-                            }
-                            # Only include these specific fields to avoid datetime fields
-                            
-                            active_clients[user['id']] = (client_socket, username)
-                            update_user_status(user['id'], 'online')
-                            
-                            # Get unread messages
-                            unread_messages = get_unread_messages(user['id'])
-                            
-                            # Get all users
-                            all_users = get_all_users()
-                            
-                            # Send successful login response
-                            response = {
-                                'type': 'login_response',
-                                'success': True,
-                                'user': user_data,
-                                'unread_messages': unread_messages,
-                                'users': all_users
-                            }
-                        else:
-                            # Send failed login response
-                            response = {
-                                'type': 'login_response',
-                                'success': False,
-                                'message': 'Invalid username or password'
-                            }
-                        
-                        client_socket.sendall((json.dumps(response) + '\n').encode('utf-8'))
-                        
-                    elif message_type == 'register':
-                        username = message.get('username')
-                        password = message.get('password')
-                        display_name = message.get('display_name')
-                        
-                        success = register_user(username, password, display_name)
-                        
-                        # Send registration response
-                        response = {
-                            'type': 'register_response',
-                            'success': success,
-                            'message': 'Registration successful' if success else 'Registration failed'
-                        }
-                        
-                        client_socket.sendall((json.dumps(response) + '\n').encode('utf-8'))
-                        
-                    elif message_type == 'message' and current_user:
-                        receiver_id = message.get('receiver_id')
-                        content = message.get('content')
-                        
-                        # Store message in database
-                        store_message(current_user['id'], receiver_id, content)
-                        
-                        # If receiver is active, send the message
-                        if receiver_id in active_clients:
-                            receiver_socket, _ = active_clients[receiver_id]
-                            
-                            message_to_send = {
-                                'type': 'new_message',
-                                'sender': {
-                                    'id': current_user['id'],
-                                    'username': current_user['username'],
-                                    'display_name': current_user['display_name']
-                                },
-                                'content': content,
-                                'timestamp': datetime.datetime.now().isoformat()
-                            }
-                            
-                            receiver_socket.sendall((json.dumps(message_to_send) + '\n').encode('utf-8'))
-                        
-                        # Send confirmation to sender
-                        response = {
-                            'type': 'message_sent',
-                            'success': True,
-                            'receiver_id': receiver_id
-                        }
-                        
-                        client_socket.sendall((json.dumps(response) + '\n').encode('utf-8'))
-                    
-                    elif message_type == 'get_chat_history' and current_user:
-                        other_user_id = message.get('user_id')
-                        
-                        # Get chat history between the two users
-                        chat_history = get_chat_history(current_user['id'], other_user_id)
-                        
-                        response = {
-                            'type': 'chat_history',
-                            'user_id': other_user_id,
-                            'messages': chat_history
-                        }
-                        
-                        client_socket.sendall((json.dumps(response) + '\n').encode('utf-8'))
-                        
-                    elif message_type == 'get_users' and current_user:
-                        # Get all users
-                        all_users = get_all_users()
-                        
-                        response = {
-                            'type': 'users_list',
-                            'users': all_users
-                        }
-                        
-                        client_socket.sendall((json.dumps(response) + '\n').encode('utf-8'))
-                        
-                    elif message_type == 'update_username' and current_user:
-                        new_username = message.get('new_username')
-                        success, message_text = update_username(current_user['id'], new_username)
-                        
-                        if success:
-                            # Update current_user data
-                            current_user['username'] = new_username
-                            # Update active clients entry
-                            active_clients[current_user['id']] = (client_socket, new_username)
-                        
-                        response = {
-                            'type': 'username_update_response',
-                            'success': success,
-                            'message': message_text,
-                            'new_username': new_username if success else None
-                        }
-                        
-                        client_socket.sendall((json.dumps(response) + '\n').encode('utf-8'))
-                        
-                        # If successful, broadcast updated users list to all clients
-                        if success:
-                            all_users = get_all_users()
-                            users_update = {
-                                'type': 'users_list',
-                                'users': all_users
-                            }
-                            
-                            for uid, (sock, _) in active_clients.items():
-                                try:
-                                    sock.sendall((json.dumps(users_update) + '\n').encode('utf-8'))
-                                except:
-                                    pass
-                        
-                    elif message_type == 'update_password' and current_user:
-                        current_password = message.get('current_password')
-                        new_password = message.get('new_password')
-                        
-                        success, message_text = update_password(current_user['id'], current_password, new_password)
-                        
-                        response = {
-                            'type': 'password_update_response',
-                            'success': success,
-                            'message': message_text
-                        }
-                        
-                        client_socket.sendall((json.dumps(response) + '\n').encode('utf-8'))
-                        
-                    elif message_type == 'update_profile_pic' and current_user:
-                        image_data = message.get('image_data')
-                        file_extension = message.get('file_extension')
-                        
-                        success, message_text, filename = update_profile_pic(current_user['id'], image_data, file_extension)
-                        
-                        response = {
-                            'type': 'profile_pic_update_response',
-                            'success': success,
-                            'message': message_text,
-                            'filename': filename
-                        }
-                        
-                        client_socket.sendall((json.dumps(response) + '\n').encode('utf-8'))
-                        
-                        # If successful, broadcast updated users list
-                        if success:
-                            all_users = get_all_users()
-                            users_update = {
-                                'type': 'users_list',
-                                'users': all_users
-                            }
-                            
-                            for uid, (sock, _) in active_clients.items():
-                                try:
-                                    sock.sendall((json.dumps(users_update) + '\n').encode('utf-8'))
-                                except:
-                                    pass
-                    
-            except socket.timeout:
-                # Socket timeout - this is expected, just continue the loop
-                continue
-            except json.JSONDecodeError as e:
-                print(f"JSON decode error from {client_address}: {e}")
-                # Don't break, just continue and try to recover
-                buffer = ""
-                continue
-            
+                process_message(session, message)
+
+    except ProtocolError as e:
+        print(f"Protocol error from {client_address}: {e}")
     except Exception as e:
         print(f"Error handling client: {e}")
     finally:
         # Clean up when client disconnects
-        if current_user:
-            if current_user['id'] in active_clients:
-                del active_clients[current_user['id']]
-            update_user_status(current_user['id'], 'offline')
-        
+        end_session(session)
+        session.release()
+        open_connections.dec()
+        print(f"Connection closed for {client_address}")
+
+# Client handler coroutine (asyncio engine)
+async def handle_client_async(reader, writer):
+    client_address = writer.get_extra_info('peername')
+    print(f"New connection from {client_address}")
+    loop = asyncio.get_running_loop()
+    session = AsyncSession(writer, client_address, loop)
+    idle_timer.watch(session)
+    open_connections.inc()
+
+    try:
+        while True:
+            # Idle connections only cost a pending read on the event loop;
+            # closing the session from the idle timer ends it with EOF
+            data = await reader.read(65536)
+
+            if not data:
+                print(f"No data received from {client_address}, closing connection")
+                break
+
+            session.last_activity = time.monotonic()
+            session.decoder.feed(data)
+
+            while True:
+                try:
+                    message = session.decoder.next_message()
+                except json.JSONDecodeError as e:
+                    print(f"JSON decode error from {client_address}: {e}")
+                    continue
+                if message is None:
+                    break
+
+                # Database work happens on the bounded executor, one request at a time per connection
+                await loop.run_in_executor(db_executor, process_message, session, message)
+
+    except ProtocolError as e:
+        print(f"Protocol error from {client_address}: {e}")
+    except Exception as e:
+        print(f"Error handling client: {e}")
+    finally:
         try:
-            client_socket.close()
-        except:
-            pass
+            await loop.run_in_executor(db_executor, end_session, session)
+        except Exception as e:
+            print(f"Error ending session for {client_address}: {e}")
+        session.close()
+        open_connections.dec()
         print(f"Connection closed for {client_address}")
 
-# Main server function
-def start_server():
-    # Setup database
-    setup_database()
-    
-    # Create socket
+# Executor for blocking database calls made by the asyncio engine
+db_executor = None
+
+# Read at scrape time
+def outbound_depths():
+    return sum(session.outbound.qsize() for session, _ in list(active_clients.values()))
+
+# Backends without a connection pool report nothing
+def db_pool_gauge():
+    stats = storage.stats() if storage else {}
+    return {(state,): stats[state] for state in ('open', 'in_use', 'idle') if state in stats}
+
+def db_pool_counters():
+    stats = storage.stats() if storage else {}
+    return {(name,): stats[name] for name in ('created', 'acquired', 'waits', 'timeouts', 'discarded',
+                                               'health_check_failures') if name in stats}
+
+def executor_depth():
+    # Queued jobs not yet picked up by a worker thread
+    return db_executor._work_queue.qsize() if db_executor else 0
+
+metrics.gauge('kawaii_logged_in_users', "Users logged in on this node", callback=lambda: len(active_clients))
+metrics.gauge('kawaii_threads', "Live threads in this process", callback=threading.active_count)
+metrics.gauge('kawaii_message_queue_depth', "Chat messages waiting for the group commit",
+              callback=lambda: message_writer.depth())
+metrics.gauge('kawaii_outbound_queue_depth', "Frames waiting in client outbound queues", callback=outbound_depths)
+metrics.gauge('kawaii_db_executor_queue_depth', "Requests waiting for a database executor thread",
+              callback=executor_depth)
+metrics.gauge('kawaii_db_pool_connections', "Pooled database connections by state", ['state'],
+              callback=db_pool_gauge)
+metrics.counter('kawaii_db_pool_events_total', "Connection pool events since startup", ['event'],
+                callback=db_pool_counters)
+metrics.gauge('kawaii_search_index_queue_depth', "Stored messages waiting to be added to the search index",
+              callback=lambda: search_indexer.depth())
+metrics.counter('kawaii_search_indexer_events_total', "Search index batches, indexed and failed messages", ['event'],
+                callback=lambda: {(name,): value for name, value in search_indexer.counters.items()})
+metrics.gauge('kawaii_ack_queue_depth', "Client acks waiting to be applied", callback=lambda: ack_writer.depth())
+metrics.counter('kawaii_ack_writer_events_total', "Ack batches, acks and failed acks", ['event'],
+                callback=lambda: {(name,): value for name, value in ack_writer.counters.items()})
+metrics.gauge('kawaii_history_cache_conversations', "Conversations held in the history cache",
+              callback=lambda: history_cache.size())
+metrics.counter('kawaii_history_cache_events_total', "History cache hits, misses, fills and evictions", ['event'],
+                callback=lambda: {(name,): value for name, value in history_cache.counters.items()})
+metrics.counter('kawaii_user_directory_events_total', "User directory loads, cached reads and not-modified replies",
+                ['event'], callback=lambda: {(name,): value for name, value in user_directory.counters.items()})
+metrics.counter('kawaii_message_writer_events_total', "Group commit batches, messages and failed messages",
+                ['event'], callback=lambda: {(name,): value for name, value in message_writer.counters.items()})
+
+# Raise the open file limit so a single process can hold many idle connections
+def raise_file_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            print(f"Raised open file limit from {soft} to {hard}")
+    except (ImportError, ValueError, OSError) as e:
+        print(f"Could not raise open file limit: {e}")
+
+async def run_async_server(server_socket):
+    server = await asyncio.start_server(handle_client_async, sock=server_socket)
+    print(f"KawaiiChat server started on {HOST}:{PORT} (asyncio engine)")
+    async with server:
+        await server.serve_forever()
+
+# Listening socket. With reuse_port every worker binds its own socket on the same
+# port and the kernel spreads new connections between them.
+def create_server_socket(reuse_port=False):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((HOST, PORT))
+    server_socket.listen(LISTEN_BACKLOG)
+    return server_socket
+
+# Main server function. Workers skip database setup, their parent has done it.
+def start_server(mode=SERVER_MODE, bus_url=BUS_URL, worker=False, metrics_port=METRICS_PORT,
+                 storage_backend=STORAGE_BACKEND):
+    global message_bus
+
+    # Setup database
+    try:
+        open_storage(storage_backend)
+    except (RuntimeError, ValueError) as e:
+        print(f"Server error: {e}")
+        return
+    if not worker and not setup_database():
+        return
+    try:
+        server_socket = create_server_socket(reuse_port=worker)
+    except Exception as e:
+        print(f"Server error: {e}")
+        return
+
+    if bus_url:
+        message_bus = connect_bus(bus_url, on_bus_message)
+        # Messages and acks handled by other nodes would never reach this node's cache
+        history_cache.enabled = False
+    message_bus.subscribe(BROADCAST_CHANNEL)
+    message_bus.subscribe(DIRECTORY_CHANNEL)
+    idle_timer.start()
+    if metrics_port:
+        try:
+            serve_metrics(METRICS_HOST, metrics_port)
+        except OSError as e:
+            print(f"Could not start metrics endpoint on port {metrics_port}: {e}")
+
+    if mode == 'asyncio':
+        global db_executor
+        raise_file_limit()
+        db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='kawaii-db')
+        try:
+            asyncio.run(run_async_server(server_socket))
+        except Exception as e:
+            print(f"Server error: {e}")
+        finally:
+            db_executor.shutdown(wait=False)
+        return
+
     try:
-        server_socket.bind((HOST, PORT))
-        server_socket.listen(5)
         print(f"KawaiiChat server started on {HOST}:{PORT}")
-        
+
         while True:
             client_socket, client_address = server_socket.accept()
             client_thread = threading.Thread(target=handle_client, args=(client_socket, client_address))
             client_thread.daemon = True
             client_thread.start()
-            
+
     except Exception as e:
         print(f"Server error: {e}")
     finally:
         server_socket.close()
 
+# Entry point of a worker process; settings are passed in because a spawned
+# process re-imports this module with its defaults
+def run_worker(mode, bus_url, port, backlog, metrics_port, storage_backend, sqlite_path, parent_pid):
+    global PORT, LISTEN_BACKLOG, SQLITE_PATH
+    # The supervisor's shutdown handlers are inherited on fork; a worker just dies
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    threading.Thread(target=watch_parent, args=(parent_pid,), daemon=True).start()
+    PORT = port
+    LISTEN_BACKLOG = backlog
+    SQLITE_PATH = sqlite_path
+    start_server(mode, bus_url, worker=True, metrics_port=metrics_port, storage_backend=storage_backend)
+
+# Exits the worker once its supervisor is gone (the worker gets re-parented), so an
+# orphaned worker never keeps holding the shared port
+def watch_parent(parent_pid):
+    while os.getppid() == parent_pid:
+        time.sleep(WORKER_PARENT_CHECK_INTERVAL)
+    print("Supervisor exited, stopping worker")
+    os._exit(0)
+
+# Signal handler of the supervisor; unwinds the supervise loop so workers get stopped
+def stop_workers(signum, frame):
+    raise SystemExit(0)
+
+# Pre-fork mode: set up the database once, then run and supervise worker processes
+# that share the listening port
+def start_workers(count=SERVER_WORKERS, mode=SERVER_MODE, bus_url=BUS_URL, metrics_port=METRICS_PORT,
+                  storage_backend=STORAGE_BACKEND):
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        print("SO_REUSEPORT is not available on this platform, running a single process")
+        start_server(mode, bus_url, metrics_port=metrics_port, storage_backend=storage_backend)
+        return
+    if storage_backend == 'memory':
+        print("The memory backend cannot be shared between worker processes, running a single process")
+        start_server(mode, bus_url, metrics_port=metrics_port, storage_backend=storage_backend)
+        return
+
+    try:
+        open_storage(storage_backend)
+    except (RuntimeError, ValueError) as e:
+        print(f"Server error: {e}")
+        return
+    if not setup_database():
+        return
+    # Workers open their own connections
+    storage.close()
+
+    if not bus_url:
+        # Cross-worker delivery and the user registry go through a broker on loopback
+        broker_socket = open_broker_socket('127.0.0.1', 0)
+        bus_url = f"tcp://127.0.0.1:{broker_socket.getsockname()[1]}"
+        threading.Thread(target=serve_broker, args=(broker_socket,), daemon=True).start()
+
+    # Worker i serves metrics on metrics_port + i + 1
+    def spawn(index):
+        worker_metrics_port = metrics_port + index + 1 if metrics_port else None
+        worker = multiprocessing.Process(target=run_worker,
+                                         args=(mode, bus_url, PORT, LISTEN_BACKLOG, worker_metrics_port,
+                                               storage_backend, SQLITE_PATH, os.getpid()),
+                                         daemon=True)
+        worker.start()
+        return worker
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGHUP, stop_workers)
+    workers = [spawn(i) for i in range(count)]
+    print(f"Started {count} workers on {HOST}:{PORT}")
+    try:
+        while True:
+            time.sleep(1)
+            for i, worker in enumerate(workers):
+                if not worker.is_alive():
+                    print(f"Worker {worker.pid} exited with code {worker.exitcode}, restarting")
+                    workers[i] = spawn(i)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join(WORKER_STOP_TIMEOUT)
+            if worker.is_alive():
+                worker.kill()
+                worker.join()
+
 if __name__ == "__main__":
-    start_server()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="KawaiiChat server")
+    parser.add_argument('--mode', choices=['threaded', 'asyncio'], default=SERVER_MODE,
+                        help="connection engine to run")
+    parser.add_argument('--port', type=int, default=PORT, help="port to listen on")
+    parser.add_argument('--bus', default=BUS_URL,
+                        help="pub/sub broker linking several server nodes, e.g. tcp://127.0.0.1:9998")
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS,
+                        help="worker processes sharing the port (SO_REUSEPORT)")
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG,
+                        help="queue length for connections waiting to be accepted")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help="port of the local Prometheus metrics endpoint, 0 to disable")
+    parser.add_argument('--storage', choices=STORAGE_BACKENDS, default=STORAGE_BACKEND,
+                        help="where users and messages are kept")
+    parser.add_argument('--sqlite-path', default=SQLITE_PATH, help="database file of the sqlite backend")
+    args = parser.parse_args()
+    PORT = args.port
+    LISTEN_BACKLOG = args.backlog
+    SQLITE_PATH = args.sqlite_path
+    if args.workers > 1:
+        start_workers(args.workers, args.mode, args.bus, args.metrics_port, args.storage)
+    else:
+        start_server(args.mode, args.bus, metrics_port=args.metrics_port, storage_backend=args.storage)
\ No newline at end of file